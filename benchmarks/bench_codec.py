@@ -0,0 +1,72 @@
+"""
+Compares the codecs of the wire protocol: bytes per message and the cost of
+encoding and decoding it.
+
+    python -m benchmarks.bench_codec
+"""
+
+from timeit import timeit
+from uuid import uuid4
+
+from card_game_server.codec import CODECS
+
+
+def sample_messages() -> dict:
+    """
+    Messages representative of the traffic handled by the server.
+    """
+    player_id = str(uuid4())
+    room_id = str(uuid4())
+    return {
+        "register": {
+            "action": "register",
+            "payload": {"udp_port": 1235, "codecs": ["binary"]},
+            "request_id": 1,
+        },
+        "join": {
+            "action": "join",
+            "payload": room_id,
+            "identifier": player_id,
+            "request_id": 42,
+        },
+        "send": {
+            "action": "send",
+            "payload": {"message": "play 7H"},
+            "room_id": room_id,
+            "identifier": player_id,
+        },
+        "sendto": {
+            "action": "sendto",
+            "payload": {"message": "play 7H", "recipients": [str(uuid4()), str(uuid4())]},
+            "room_id": room_id,
+            "identifier": player_id,
+        },
+        "broadcast": {player_id: "play 7H"},
+        "get_rooms (100 rooms)": {
+            "success": True,
+            "message": [
+                {"id": str(uuid4()), "name": f"room {i}", "n_players": i % 3, "capacity": 2}
+                for i in range(100)
+            ],
+            "request_id": 7,
+        },
+    }
+
+
+def main(number: int = 20000):
+    """
+    Runs the benchmark and prints one line per message and codec.
+    """
+    print(f"{'message':<24}{'codec':<8}{'bytes':>8}{'encode (us)':>14}{'decode (us)':>14}")
+    for label, message in sample_messages().items():
+        runs = number if "rooms" not in label else number // 100
+        for name, codec in CODECS.items():
+            encoded = codec.encode(message)
+            assert codec.decode(encoded) == message
+            encode = timeit(lambda: codec.encode(message), number=runs) / runs  # pylint: disable=cell-var-from-loop
+            decode = timeit(lambda: codec.decode(encoded), number=runs) / runs  # pylint: disable=cell-var-from-loop
+            print(f"{label:<24}{name:<8}{len(encoded):>8}{encode * 1e6:>14.2f}{decode * 1e6:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
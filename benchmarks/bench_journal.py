@@ -0,0 +1,100 @@
+"""
+Measures the journal of the registry (see `card_game_server.journal`): what
+journaling costs every registration and join, how long a snapshot takes to
+write, and how long a restarted server takes to recover, from the snapshot
+alone and from the journal alone.
+
+    python -m benchmarks.bench_journal --players 10000 100000 1000000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+from typing import List
+
+from card_game_server.journal import Journal
+from card_game_server.models.rooms import Rooms
+
+PLAYERS = (10000, 100000)
+
+# Seats of every room
+CAPACITY = 4
+
+
+def fill(rooms: Rooms, n_players: int) -> float:
+    """
+    Registers players and seats each of them, and returns the seconds spent.
+    """
+    start = perf_counter()
+    for port in range(n_players):
+        player = rooms.register(("127.0.0.1", port % 65536), None, batching=True)
+        rooms.join(player.identifier)
+    return perf_counter() - start
+
+
+def directory_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def run(n_players: int, fsync: str) -> List[float]:
+    """
+    Returns the seconds per change without and with a journal, the seconds
+    to recover from the journal alone, to write a snapshot and to recover
+    from it, along with the bytes of the journal and of the snapshot.
+    """
+    plain = fill(Rooms(CAPACITY), n_players) / n_players
+    directory = tempfile.mkdtemp(prefix="bench-journal-")
+    try:
+        rooms = Rooms(CAPACITY, journal=Journal(directory, fsync))
+        journaled = fill(rooms, n_players)
+        start = perf_counter()
+        rooms.journal.close()
+        journaled = (journaled + perf_counter() - start) / n_players
+        journal_bytes = directory_size(directory)
+        del rooms
+
+        start = perf_counter()
+        rooms = Rooms(CAPACITY, journal=Journal(directory, fsync))
+        replay = perf_counter() - start
+        assert rooms.n_players == n_players
+
+        start = perf_counter()
+        rooms.checkpoint()
+        snapshot = perf_counter() - start
+        rooms.journal.close()
+        snapshot_bytes = directory_size(directory)
+        del rooms
+
+        start = perf_counter()
+        rooms = Rooms(CAPACITY, journal=Journal(directory, fsync))
+        recover = perf_counter() - start
+        assert rooms.n_players == n_players
+        rooms.journal.close()
+    finally:
+        shutil.rmtree(directory)
+    return [plain, journaled, replay, snapshot, recover, journal_bytes, snapshot_bytes]
+
+
+def main(argv: List[str] = None):
+    """
+    Runs the benchmark and prints one line per number of players.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--players", type=int, nargs="+", default=list(PLAYERS))
+    parser.add_argument("--fsync", default="batch")
+    args = parser.parse_args(argv)
+    print(f"{'players':>9}{'change (us)':>13}{'journaled':>11}{'replay (s)':>12}"
+          f"{'snapshot (s)':>14}{'recover (s)':>13}{'journal (MB)':>14}{'snapshot (MB)':>15}")
+    for n_players in args.players:
+        plain, journaled, replay, snapshot, recover, journal_bytes, snapshot_bytes = run(
+            n_players, args.fsync)
+        print(f"{n_players:>9}{plain * 1e6:>13.2f}{journaled * 1e6:>11.2f}{replay:>12.2f}"
+              f"{snapshot:>14.2f}{recover:>13.2f}{journal_bytes / 1e6:>14.1f}"
+              f"{snapshot_bytes / 1e6:>15.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
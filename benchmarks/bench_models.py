@@ -0,0 +1,280 @@
+"""
+Micro-benchmarks for the model layer (`Rooms`, `Room` and `Player`), without
+any socket involved: fan-out goes to a `sendto` that drops every datagram.
+
+At each scale, `Rooms` is populated with that many players and that many
+rooms (half of the rooms full, half empty) before measuring the average time
+and peak memory of each operation:
+
+- `register`, `create`, `join` (to a given room), `autojoin`, `leave`
+- `get_player`, `get_room`
+- `send` and `sendto` fan-out resolution, in a full room
+- `clear_empty_rooms`, whose time is reported per room removed
+
+Each time is the best of several repeats, which filters out most of the
+noise of a busy machine. Results can be saved as a baseline and later runs
+compared against it. A run fails (exit status 1) if an operation got slower
+than the baseline by more than the threshold, or if its cost at the largest
+scale is more than the growth threshold times its cost at the smallest one.
+The first check only applies to operations whose batch took at least
+`MIN_BATCH_SECONDS` in the baseline, since shorter ones are mostly noise.
+The second check does not depend on the machine, and catches an O(1) path
+turning into O(n): cache misses alone make lookups about 10 times slower at
+1M than at 10, while a linear scan would be about 100000 times slower.
+
+    python -m benchmarks.bench_models --save benchmarks/baselines/bench_models.json
+    python -m benchmarks.bench_models --compare benchmarks/baselines/bench_models.json
+"""
+
+import argparse
+import gc
+import json
+import random
+import sys
+import tracemalloc
+from functools import partial
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+from card_game_server.models.rooms import Rooms
+
+SCALES = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+# Operations performed for each measurement
+BATCH = 1_000
+
+# Lookups performed for each measurement
+LOOKUPS = 20_000
+
+CAPACITY = 2
+
+# Timed passes of each measurement, of which the fastest is kept
+REPEATS = 5
+
+# Shortest batch, in the baseline, compared against the baseline at all
+MIN_BATCH_SECONDS = 0.002
+
+# Operations measured over `LOOKUPS` runs rather than `BATCH` ones
+LOOKUP_OPERATIONS = ("get_player", "get_room")
+
+# Each measurement is a (seconds per operation, peak bytes per operation)
+Measurement = Tuple[float, float]
+
+
+def populate(scale: int) -> Rooms:
+    """
+    Registers `scale` players and creates `scale` rooms. The players fill the
+    first half of the rooms, the other half stays empty.
+    """
+    rooms = Rooms(capacity=CAPACITY)
+    rooms.fanout.bind(lambda data, address: None)
+    players = [rooms.register(("127.0.0.1", i), 1235) for i in range(scale)]
+    created = [rooms.create() for _ in range(scale)]
+    for i, player in enumerate(players):
+        rooms.join(player.identifier, created[i // CAPACITY].identifier)
+    return rooms
+
+
+def measure(
+    operation: Callable[[], None],
+    count: int,
+    setup: Callable[[], None] = None,
+    repeats: int = REPEATS,
+):
+    """
+    Measures the average time and peak memory of `count` runs of an
+    operation, done by `operation` in one go. The time is the best of
+    `repeats` passes. When given, `setup` prepares a fresh state before each
+    pass.
+    """
+    elapsed = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        gc.disable()
+        start = perf_counter()
+        operation()
+        duration = perf_counter() - start
+        gc.enable()
+        elapsed = duration if elapsed is None else min(elapsed, duration)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / count, max(0, peak - before) / count
+
+
+def bench_scale(  # pylint: disable=too-many-locals
+    scale: int,
+    repeats: int = REPEATS,
+) -> Dict[str, Measurement]:
+    """
+    Runs every benchmark at a given scale.
+    """
+    rooms = populate(scale)
+    batch = BATCH
+    results: Dict[str, Measurement] = {}
+    timed = partial(measure, repeats=repeats)
+
+    player_ids = [player.identifier for player in rooms.players]
+    room_ids = list(rooms.room_ids)
+    lookups_players = [random.choice(player_ids) for _ in range(LOOKUPS)]
+    lookups_rooms = [random.choice(room_ids) for _ in range(LOOKUPS)]
+
+    def get_player():
+        for player_id in lookups_players:
+            rooms.get_player(player_id)
+
+    def get_room():
+        for room_id in lookups_rooms:
+            rooms.get_room(room_id)
+
+    results["get_player"] = timed(get_player, LOOKUPS)
+    results["get_room"] = timed(get_room, LOOKUPS)
+
+    # Players and rooms made by the last call to `register` and `create`
+    state: Dict[str, List[str]] = {"players": [], "rooms": []}
+
+    def register():
+        state["players"] = [
+            rooms.register(("127.0.0.1", i), 1235).identifier for i in range(batch)]
+
+    results["register"] = timed(register, batch)
+
+    def create():
+        state["rooms"] = [rooms.create().identifier for _ in range(batch)]
+
+    results["create"] = timed(create, batch)
+
+    def join():
+        for player_id, room_id in zip(state["players"], state["rooms"]):
+            rooms.join(player_id, room_id)
+
+    def leave():
+        for player_id, room_id in zip(state["players"], state["rooms"]):
+            rooms.leave(player_id, room_id)
+
+    results["join"] = timed(join, batch, setup=lambda: (create(), register()))
+    results["leave"] = timed(leave, batch, setup=lambda: (create(), register(), join()))
+
+    def autojoin():
+        for player_id in state["players"]:
+            rooms.join(player_id)
+
+    results["autojoin"] = timed(autojoin, batch, setup=register)
+
+    full_rooms = [rooms.get_room(room_id) for room_id in room_ids[:max(1, scale // CAPACITY)]]
+    senders = [
+        (room.players[0].identifier, room.identifier, room.players[-1].identifier)
+        for room in random.choices(full_rooms, k=batch)
+    ]
+
+    def send():
+        for player_id, room_id, _ in senders:
+            rooms.send(player_id, room_id, "play 7H")
+
+    def sendto():
+        for player_id, room_id, recipient_id in senders:
+            rooms.sendto(player_id, room_id, [recipient_id], "play 7H")
+
+    results["send"] = timed(send, len(senders))
+    results["sendto"] = timed(sendto, len(senders))
+
+    def clear_empty_rooms():
+        rooms.clear_empty_rooms()
+
+    def add_empty_rooms():
+        for _ in range(batch):
+            rooms.create()
+
+    def setup_empty_rooms():
+        rooms.clear_empty_rooms()
+        add_empty_rooms()
+
+    results["clear_empty_rooms"] = timed(clear_empty_rooms, batch, setup=setup_empty_rooms)
+    return results
+
+
+def check(
+    results: Dict[int, Dict[str, Measurement]],
+    baseline: Dict[int, Dict[str, Measurement]],
+    threshold: float,
+    growth_threshold: float,
+) -> List[str]:
+    """
+    Returns a description of every regression found.
+    """
+    failures = []
+    for scale, operations in results.items():
+        for operation, (seconds, _) in operations.items():
+            reference = baseline.get(scale, {}).get(operation)
+            if reference is None:
+                continue
+            count = LOOKUPS if operation in LOOKUP_OPERATIONS else BATCH
+            if reference[0] * count < MIN_BATCH_SECONDS:
+                continue
+            if seconds > reference[0] * threshold:
+                failures.append(
+                    f"{operation} at {scale}: {seconds * 1e9:.0f}ns/op, "
+                    f"baseline {reference[0] * 1e9:.0f}ns/op")
+    scales = sorted(results)
+    if len(scales) > 1:
+        smallest, largest = results[scales[0]], results[scales[-1]]
+        for operation, (seconds, _) in largest.items():
+            reference = smallest[operation][0]
+            if seconds > reference * growth_threshold:
+                failures.append(
+                    f"{operation} grows from {reference * 1e9:.0f}ns/op at {scales[0]} "
+                    f"to {seconds * 1e9:.0f}ns/op at {scales[-1]}")
+    return failures
+
+
+def main(argv: List[str] = None):
+    """
+    Runs the benchmarks and prints the time and peak memory of each
+    operation per scale.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=list(SCALES))
+    parser.add_argument("--save", help="save the results to this file")
+    parser.add_argument("--compare", help="compare the results to this baseline")
+    parser.add_argument("--threshold", type=float, default=3.0,
+                        help="largest slowdown allowed against the baseline")
+    parser.add_argument("--growth-threshold", type=float, default=50.0,
+                        help="largest slowdown allowed from the smallest to the largest scale")
+    parser.add_argument("--repeats", type=int, default=REPEATS,
+                        help="timed passes of each measurement, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    results: Dict[int, Dict[str, Measurement]] = {}
+    print(f"{'scale':>10}  {'operation':<18}{'time (ns/op)':>14}{'peak (B/op)':>14}")
+    for scale in args.scales:
+        results[scale] = bench_scale(scale, args.repeats)
+        for operation, (seconds, peak) in results[scale].items():
+            print(f"{scale:>10}  {operation:<18}{seconds * 1e9:>14.0f}{peak:>14.0f}")
+        gc.collect()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump({str(scale): ops for scale, ops in results.items()}, file, indent=2)
+            file.write("\n")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = {int(scale): ops for scale, ops in json.load(file).items()}
+    failures = check(results, baseline, args.threshold, args.growth_threshold)
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,48 @@
+"""
+Shows that looking up players and rooms in `Rooms` costs the same no matter
+how many of them are registered.
+
+    python -m benchmarks.bench_rooms
+"""
+
+from random import choice
+from timeit import timeit
+
+from card_game_server.models.rooms import Rooms
+
+SCALES = (1_000, 10_000, 100_000)
+
+
+def populate(n_players: int) -> Rooms:
+    """
+    Registers `n_players` players, two per room.
+    """
+    rooms = Rooms(capacity=2)
+    for first in range(0, n_players, 2):
+        room = rooms.create()
+        for i in range(first, min(first + 2, n_players)):
+            player = rooms.register(("127.0.0.1", i), 1235)
+            rooms.join(player.identifier, room.identifier)
+    return rooms
+
+
+def main(number: int = 100_000):
+    """
+    Runs the benchmark and prints the cost of each lookup per scale.
+    """
+    print(f"{'players':>10}{'get_player (ns)':>18}{'get_room (ns)':>16}{'room_ids (ns)':>16}")
+    for n_players in SCALES:
+        rooms = populate(n_players)
+        player_id = choice(rooms.players).identifier
+        room_id = choice(rooms.rooms).identifier
+        get_player = timeit(lambda: rooms.get_player(player_id), number=number)  # pylint: disable=cell-var-from-loop
+        get_room = timeit(lambda: rooms.get_room(room_id), number=number)  # pylint: disable=cell-var-from-loop
+        room_ids = timeit(lambda: room_id in rooms.room_ids, number=number)  # pylint: disable=cell-var-from-loop
+        print(
+            f"{n_players:>10}{get_player / number * 1e9:>18.1f}"
+            f"{get_room / number * 1e9:>16.1f}{room_ids / number * 1e9:>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
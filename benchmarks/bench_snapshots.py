@@ -0,0 +1,95 @@
+"""
+Compares pushing the view of a game to every player as a delta from the last
+view it acknowledged (see `card_game_server.snapshots`) with pushing the
+whole view: bytes per update, and the cost of building and applying deltas.
+
+Games of crazy eights are played with a fixed seed, and every datagram, view
+or acknowledgement, is lost with the given probabilities.
+
+    python -m benchmarks.bench_snapshots
+"""
+
+from random import Random
+from time import perf_counter
+from typing import Dict, List
+
+from card_game_server.cards import rank_of, suit_of
+from card_game_server.codec import CODECS
+from card_game_server.game import EIGHT, GAME_SENDER, Game, get_rules
+from card_game_server.models.identifiers import new_identifier
+from card_game_server.snapshots import SnapshotReceiver, SnapshotSender
+
+
+def play_move(game: Game) -> None:
+    """
+    Plays the first card that matches, or draws.
+    """
+    player_id = game.turn
+    top = game.pile("discard").top
+    suit = game.state["suit"]
+    for card in game.hand(player_id):
+        if rank_of(card) == EIGHT or rank_of(card) == rank_of(top) or suit_of(card) == suit:
+            game.play(player_id, {"play": card})
+            return
+    game.play(player_id, {"draw": True})
+
+
+def run(  # pylint: disable=too-many-locals
+        n_players: int, loss: float, updates: int, seed: int = 1) -> Dict[str, List[float]]:
+    """
+    Pushes `updates` views of games to `n_players` players, and returns the
+    bytes of every codec for whole views and for deltas, along with the
+    seconds spent building and applying deltas.
+    """
+    rng = Random(seed)
+    player_ids = [new_identifier() for _ in range(n_players)]
+    sender = SnapshotSender()
+    receivers = {player_id: SnapshotReceiver() for player_id in player_ids}
+    results = {name: [0, 0] for name in CODECS}
+    full_updates = 0
+    elapsed = 0.0
+    game = None
+    for _ in range(updates):
+        if game is None or game.finished:
+            game = Game(get_rules("eights"), player_ids, rng=Random(rng.random()))
+        play_move(game)
+        for player_id in player_ids:
+            view = game.view(player_id)
+            start = perf_counter()
+            snapshot = sender.update(player_id, view)
+            elapsed += perf_counter() - start
+            full_updates += "state" in snapshot
+            for name, codec in CODECS.items():
+                results[name][0] += len(codec.encode({GAME_SENDER: view}))
+                results[name][1] += len(codec.encode({GAME_SENDER: snapshot}))
+            if rng.random() < loss:
+                continue
+            start = perf_counter()
+            state = receivers[player_id].receive(snapshot)
+            elapsed += perf_counter() - start
+            assert state is None or state == view
+            if rng.random() < loss:
+                continue
+            sender.acknowledge(player_id, snapshot["version"] if state is not None else 0)
+    pushed = updates * n_players
+    return {
+        name: [full / pushed, delta / pushed, full_updates / pushed, elapsed / pushed]
+        for name, (full, delta) in results.items()
+    }
+
+
+def main(updates: int = 2000):
+    """
+    Runs the benchmark and prints one line per scenario and codec.
+    """
+    print(f"{'players':>8}{'loss':>7}  {'codec':<8}{'full (B)':>10}{'delta (B)':>11}"
+          f"{'ratio':>8}{'whole':>8}{'delta (us)':>12}")
+    for n_players in (2, 4, 8):
+        for loss in (0.0, 0.05, 0.3):
+            for name, (full, delta, whole, elapsed) in run(n_players, loss, updates).items():
+                print(f"{n_players:>8}{loss:>7.0%}  {name:<8}{full:>10.1f}{delta:>11.1f}"
+                      f"{delta / full:>8.2f}{whole:>8.1%}{elapsed * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+"""
+Load-generation harness: simulates many clients against a running server.
+
+Every virtual client lives in a single asyncio event loop, with a persistent
+TCP session and a UDP socket of its own, so thousands of them fit in one
+process. After registering, each client performs actions picked at random
+from the scenario's mix, at a pace that keeps the whole run at the target
+rate. Only actions that make sense for the client's state are picked: a
+client in a room may `leave`, `send` or `get_rooms`, while a client out of a
+room may `autojoin`, `create`, `join` or `get_rooms`.
+
+Every broadcast (`send`) carries its sequence number and send time, and the
+harness knows which clients are in each room, so it can tell how many
+datagrams should have been delivered and how long they took. Membership
+changes racing with a broadcast make the expected count slightly off, which
+is negligible over a whole run.
+
+The report is printed as JSON (or written to `--output`) so runs can be
+compared between releases:
+
+    python run_server.py --engine asyncio  # in another terminal
+    python -m benchmarks.loadtest benchmarks/scenarios/default.json
+
+A scenario is a JSON object, where every key is optional:
+
+    {
+        "host": "127.0.0.1",
+        "tcp_port": 1234,
+        "udp_port": 1234,
+        "clients": 200,
+        "ramp_up": 2.0,
+        "duration": 10.0,
+        "rate": 500,
+        "codec": "json",
+        "message_size": 32,
+        "mix": {"autojoin": 2, "create": 1, "join": 1, "leave": 1, "get_rooms": 1, "send": 10}
+    }
+
+`rate` is the total number of actions per second, across every client.
+`register` may also appear in the mix, in which case the client registers
+again under a new identifier.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import resource
+import sys
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Set
+
+from card_game_server.codec import decode, get_codec
+from card_game_server.protocol import SESSION_MAGIC, FrameDecoder, encode_frame
+
+DEFAULT_SCENARIO: Dict[str, Any] = {
+    "host": "127.0.0.1",
+    "tcp_port": 1234,
+    "udp_port": 1234,
+    "clients": 200,
+    "ramp_up": 2.0,
+    "duration": 10.0,
+    "rate": 500,
+    "codec": "json",
+    "message_size": 32,
+    "mix": {
+        "autojoin": 2,
+        "create": 1,
+        "join": 1,
+        "leave": 1,
+        "get_rooms": 1,
+        "send": 10,
+    },
+}
+
+ACTIONS = ("register", "autojoin", "create", "join", "leave", "get_rooms", "send")
+IN_ROOM_ACTIONS = ("register", "leave", "get_rooms", "send")
+OUT_OF_ROOM_ACTIONS = ("register", "autojoin", "create", "join", "get_rooms")
+
+# Seconds to wait for datagrams still in flight once the run is over
+DRAIN_TIME = 1.0
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Summarizes latencies, in seconds, as milliseconds.
+    """
+    values = sorted(latencies)
+
+    def milliseconds(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "p50_ms": milliseconds(percentile(values, 0.50)),
+        "p95_ms": milliseconds(percentile(values, 0.95)),
+        "p99_ms": milliseconds(percentile(values, 0.99)),
+        "mean_ms": milliseconds(sum(values) / len(values) if values else None),
+        "max_ms": milliseconds(values[-1] if values else None),
+    }
+
+
+class Stats:
+
+    def __init__(self):
+        """
+        Everything measured during a run.
+        """
+        self.latencies: Dict[str, List[float]] = {action: [] for action in ACTIONS}
+        self.failures: Dict[str, int] = {action: 0 for action in ACTIONS}
+        self.datagrams_sent: int = 0
+        self.datagrams_expected: int = 0
+        self.datagrams_received: int = 0
+        self.members: Dict[str, Set[str]] = {}
+        self.open_rooms: List[str] = []
+
+    def report(self, scenario: Dict[str, Any], elapsed: float) -> Dict[str, Any]:
+        """
+        Builds the JSON report of the run.
+        """
+        actions = {}
+        total = 0
+        for action in ACTIONS:
+            latencies = self.latencies[action]
+            # Broadcasts get no reply, so their latency is the delivery time
+            count = self.datagrams_sent if action == "send" else len(latencies)
+            if not count and not self.failures[action]:
+                continue
+            total += count
+            actions[action] = {
+                "count": count,
+                "failures": self.failures[action],
+                "throughput": round(count / elapsed, 1),
+                **summarize(latencies),
+            }
+        expected = self.datagrams_expected
+        received = min(self.datagrams_received, expected)
+        return {
+            "scenario": scenario,
+            "elapsed_s": round(elapsed, 3),
+            "throughput": round(total / elapsed, 1),
+            "actions": actions,
+            "udp": {
+                "sent": self.datagrams_sent,
+                "expected": expected,
+                "received": self.datagrams_received,
+                "loss_rate": round(1 - received / expected, 6) if expected else None,
+            },
+        }
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, client: "VirtualClient"):
+        self._client: VirtualClient = client
+
+    def datagram_received(self, data: bytes, addr):
+        self._client.on_datagram(data)
+
+
+class VirtualClient:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, index: int, scenario: Dict[str, Any], stats: Stats):
+        """
+        A single simulated player.
+        """
+        self._index: int = index
+        self._scenario: Dict[str, Any] = scenario
+        self._stats: Stats = stats
+        self._codec = get_codec(scenario["codec"])
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        self._transport: asyncio.DatagramTransport = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_request_id: int = 1
+        self._reader_task: asyncio.Task = None
+        self._sequence: int = 0
+        self.identifier: str = None
+        self.room_id: str = None
+
+    async def connect(self):
+        """
+        Opens the TCP session and the UDP socket of the client.
+        """
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UdpProtocol(self), local_addr=("0.0.0.0", 0))
+        self._reader, self._writer = await asyncio.open_connection(
+            self._scenario["host"], self._scenario["tcp_port"])
+        self._writer.write(SESSION_MAGIC)
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._transport is not None:
+            self._transport.close()
+
+    async def _read_replies(self):
+        decoder = FrameDecoder()
+        while True:
+            data = await self._reader.read(65536)
+            if not data:
+                break
+            for frame, _ in decoder.feed(data):
+                future = self._pending.pop(frame.get("request_id"), None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Session closed"))
+
+    async def request(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Sends a request through the session and waits for its reply.
+        """
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        message["request_id"] = request_id
+        self._writer.write(encode_frame(message, self._codec))
+        return await future
+
+    def on_datagram(self, data: bytes):
+        try:
+            message = decode(data)
+        except Exception:  # pylint: disable=broad-except
+            return
+        for payload in message.values():
+            if isinstance(payload, dict) and "sent_at" in payload:
+                self._stats.datagrams_received += 1
+                self._stats.latencies["send"].append(perf_counter() - payload["sent_at"])
+
+    async def timed(self, action: str, message: Dict[str, Any]) -> Optional[Any]:
+        """
+        Performs a request and records its latency. Returns the reply's
+        message, or `None` if the request failed.
+        """
+        start = perf_counter()
+        try:
+            reply = await self.request(message)
+        except ConnectionError:
+            self._stats.failures[action] += 1
+            return None
+        if not reply.get("success"):
+            self._stats.failures[action] += 1
+            return None
+        self._stats.latencies[action].append(perf_counter() - start)
+        return reply.get("message")
+
+    def _entered(self, room_id: str):
+        self.room_id = room_id
+        members = self._stats.members.setdefault(room_id, set())
+        members.add(self.identifier)
+
+    def _left(self):
+        members = self._stats.members.get(self.room_id)
+        if members is not None:
+            members.discard(self.identifier)
+        self.room_id = None
+
+    async def register(self):
+        if self.room_id is not None:
+            self._left()
+        reply = await self.timed("register", {
+            "action": "register",
+            "payload": {
+                "udp_port": self._transport.get_extra_info("sockname")[1],
+                "codecs": [self._codec.name],
+            },
+        })
+        if reply is not None:
+            self.identifier = reply["identifier"]
+
+    async def perform(self, action: str):  # pylint: disable=too-many-branches
+        """
+        Performs a single action of the mix.
+        """
+        if action == "register":
+            await self.register()
+        elif action == "autojoin":
+            room_id = await self.timed(
+                "autojoin", {"action": "autojoin", "identifier": self.identifier})
+            if room_id is not None:
+                self._entered(room_id)
+        elif action == "create":
+            room_id = await self.timed("create", {
+                "action": "create",
+                "payload": f"room {self._index}",
+                "identifier": self.identifier,
+            })
+            if room_id is not None:
+                self._entered(room_id)
+                self._stats.open_rooms.append(room_id)
+        elif action == "join":
+            if not self._stats.open_rooms:
+                return await self.perform("autojoin")
+            room_id = random.choice(self._stats.open_rooms)
+            if await self.timed("join", {
+                "action": "join",
+                "payload": room_id,
+                "identifier": self.identifier,
+            }) is not None:
+                self._entered(room_id)
+            elif room_id in self._stats.open_rooms:
+                # Most likely full or gone, so stop picking it
+                self._stats.open_rooms.remove(room_id)
+        elif action == "leave":
+            if await self.timed("leave", {
+                "action": "leave",
+                "room_id": self.room_id,
+                "identifier": self.identifier,
+            }) is not None:
+                self._left()
+        elif action == "get_rooms":
+            rooms = await self.timed(
+                "get_rooms", {"action": "get_rooms", "identifier": self.identifier})
+            if rooms is not None:
+                self._stats.open_rooms = [
+                    room["id"] for room in rooms if room["n_players"] < room["capacity"]]
+        elif action == "send":
+            self.broadcast()
+        return None
+
+    def broadcast(self):
+        """
+        Sends a chat message to the client's room.
+        """
+        self._sequence += 1
+        self._transport.sendto(self._codec.encode({
+            "action": "send",
+            "room_id": self.room_id,
+            "identifier": self.identifier,
+            "payload": {"message": {
+                "sequence": self._sequence,
+                "sent_at": perf_counter(),
+                "text": "x" * self._scenario["message_size"],
+            }},
+        }), (self._scenario["host"], self._scenario["udp_port"]))
+        self._stats.datagrams_sent += 1
+        self._stats.datagrams_expected += len(self._stats.members.get(self.room_id, ()))
+
+    async def run(self, interval: float, deadline: float, mix: Dict[str, float]):
+        """
+        Performs actions every `interval` seconds until the deadline.
+        """
+        loop = asyncio.get_running_loop()
+        next_time = loop.time() + random.uniform(0, interval)
+        while True:
+            await asyncio.sleep(max(0.0, next_time - loop.time()))
+            if loop.time() >= deadline:
+                return
+            next_time += interval
+            if self.identifier is None:
+                await self.register()
+                continue
+            actions = IN_ROOM_ACTIONS if self.room_id is not None else OUT_OF_ROOM_ACTIONS
+            weights = [mix.get(action, 0) for action in actions]
+            if not any(weights):
+                continue
+            await self.perform(random.choices(actions, weights)[0])
+
+
+def raise_file_limit():
+    """
+    Raises the limit of open files as far as allowed, since every client
+    takes two sockets.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def run(scenario: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Runs a scenario and returns its report.
+    """
+    stats = Stats()
+    loop = asyncio.get_running_loop()
+    clients = [VirtualClient(index, scenario, stats) for index in range(scenario["clients"])]
+
+    # Ramp up: connect and register clients evenly over the ramp-up time
+    delay = scenario["ramp_up"] / max(1, len(clients))
+    for client in clients:
+        await client.connect()
+        await client.register()
+        if delay:
+            await asyncio.sleep(delay)
+
+    interval = len(clients) / scenario["rate"]
+    start = perf_counter()
+    deadline = loop.time() + scenario["duration"]
+    await asyncio.gather(*(client.run(interval, deadline, scenario["mix"]) for client in clients))
+    elapsed = perf_counter() - start
+    await asyncio.sleep(DRAIN_TIME)
+    for client in clients:
+        await client.close()
+    return stats.report(scenario, elapsed)
+
+
+def load_scenario(path: Optional[str]) -> Dict[str, Any]:
+    """
+    Loads a scenario file, filling in the defaults.
+    """
+    scenario = dict(DEFAULT_SCENARIO)
+    if path is not None:
+        with open(path, encoding="utf-8") as file:
+            scenario.update(json.load(file))
+    unknown = set(scenario["mix"]) - set(ACTIONS)
+    if unknown:
+        raise ValueError(f"Unknown actions in mix: {sorted(unknown)}")
+    return scenario
+
+
+def main(argv: List[str] = None):
+    """
+    Runs a scenario and prints or saves its report.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("scenario", nargs="?", help="scenario file (JSON)")
+    parser.add_argument("--output", help="write the report to this file")
+    parser.add_argument("--seed", type=int, help="random seed")
+    args = parser.parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    raise_file_limit()
+    report = asyncio.run(run(load_scenario(args.scenario)))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
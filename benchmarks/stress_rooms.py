@@ -0,0 +1,98 @@
+"""
+Stress test for the locking of `Rooms`: many threads send messages to a
+varying number of active rooms, and the throughput is measured both with
+the per-room locks and with a single global lock around every call, which
+is how both servers used to serialize requests.
+
+Every datagram sent also waits for a short simulated latency, standing in
+for a send that blocks on a full socket buffer. Since the GIL is released
+while waiting, this shows the effect of the locking scheme even on a single
+core. With per-room locks, throughput grows with the number of active rooms,
+since messages to different rooms are sent concurrently.
+
+    python -m benchmarks.stress_rooms
+"""
+
+import socket
+from threading import Barrier, Lock, Thread
+from time import perf_counter, sleep
+from typing import Optional
+
+from card_game_server.models.rooms import Rooms
+
+N_THREADS = 8
+PLAYERS_PER_ROOM = 8
+ACTIVE_ROOMS = (1, 2, 4, 8)
+
+
+def run(
+    n_rooms: int,
+    duration: float,
+    latency: float,
+    global_lock: Optional[Lock],
+) -> float:
+    """
+    Runs the stress test and returns the number of messages sent per second.
+    """
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def sendto(data: bytes, address):
+        sender.sendto(data, address)
+        if latency:
+            sleep(latency)
+
+    rooms = Rooms(capacity=PLAYERS_PER_ROOM)
+    rooms.fanout.bind(sendto)
+    senders = []
+    for _ in range(n_rooms):
+        room = rooms.create()
+        for _ in range(PLAYERS_PER_ROOM):
+            player = rooms.register(sink.getsockname(), sink.getsockname()[1])
+            rooms.join(player.identifier, room.identifier)
+        senders.append((player.identifier, room.identifier))
+
+    counts = [0] * N_THREADS
+    barrier = Barrier(N_THREADS + 1)
+
+    def worker(index: int):
+        player_id, room_id = senders[index % n_rooms]
+        barrier.wait()
+        deadline = perf_counter() + duration
+        sent = 0
+        while perf_counter() < deadline:
+            if global_lock is not None:
+                with global_lock:
+                    rooms.send(player_id, room_id, "play 7H")
+            else:
+                rooms.send(player_id, room_id, "play 7H")
+            sent += 1
+        counts[index] = sent
+
+    threads = [Thread(target=worker, args=(i,)) for i in range(N_THREADS)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    sink.close()
+    sender.close()
+    return sum(counts) / duration
+
+
+def main(duration: float = 1.0, latency: float = 0.0001):
+    """
+    Runs the stress test and prints the throughput for each number of rooms.
+    """
+    print(f"{N_THREADS} threads, {PLAYERS_PER_ROOM} players per room, "
+          f"{latency * 1e6:.0f}us simulated latency per datagram")
+    print(f"{'active rooms':>14}{'per-room locks (msg/s)':>26}{'global lock (msg/s)':>24}")
+    for n_rooms in ACTIVE_ROOMS:
+        striped = run(n_rooms, duration, latency, None)
+        single = run(n_rooms, duration, latency, Lock())
+        print(f"{n_rooms:>14}{striped:>26.0f}{single:>24.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,669 @@
+"""
+Asyncio client library.
+
+`AsyncClient` has the same operations as `card_game_server.client.Client`,
+as coroutines, and runs on the caller's event loop without any thread of its
+own. Requests go through a persistent TCP session (see
+`card_game_server.protocol`), where any number of them may be in flight at
+once. Sessions carry the identifier of the player in every request, so a
+single `AsyncSession` may be shared by many clients: a bot process holding
+thousands of players only needs one TCP connection, plus one UDP socket per
+player, since the server sends to each player wherever its datagrams come
+from.
+
+    async with AsyncSession("localhost") as session:
+        clients = [AsyncClient("localhost", session=session) for _ in range(1000)]
+        await asyncio.gather(*(client.connect() for client in clients))
+        await asyncio.gather(*(client.autojoin() for client in clients))
+        async for message in clients[0].messages():
+            ...
+
+Each process has a limit on open files, which every UDP socket counts
+against, so holding tens of thousands of players usually needs a higher
+`ulimit -n`.
+"""
+
+import asyncio
+from itertools import count
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from card_game_server.codec import JSON, Codec, decode, get_codec
+from card_game_server.exceptions import ProtocolError
+from card_game_server.game import GAME_SENDER
+from card_game_server.inbox import DEFAULT_MAX_MESSAGES
+from card_game_server.logger import log
+from card_game_server.protocol import (
+    SESSION_MAGIC,
+    FrameDecoder,
+    encode_frame,
+)
+from card_game_server.reliable import (
+    ACK_SENDER,
+    RELIABLE_SENDER,
+    RETRANSMIT_TICK,
+    ReliablePeer,
+    parse_sack,
+    parse_seq,
+)
+from card_game_server.snapshots import SnapshotReceiver
+from card_game_server.ticks import BATCH_SENDER
+
+# Overflow policies of the queue of incoming messages. A datagram cannot wait
+# for room in the event loop, so unlike `Inbox` there is no `block` policy
+ASYNC_OVERFLOW_POLICIES = ("drop_oldest", "drop_newest")
+
+# Put in the queue of incoming messages when the client is closed
+_CLOSED = object()
+
+
+class AsyncSession:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        server_host: str,
+        server_port_tcp: int = 1234,
+        timeout: float = 5,
+    ):
+        """
+        Persistent TCP session with the server, which may be shared by any
+        number of clients. Replies are matched to their request by ID, so
+        requests never wait on each other.
+        """
+        self._server_tcp: Tuple[str, int] = (server_host, server_port_tcp)
+        self._timeout: float = timeout
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        self._reading: asyncio.Task = None
+        self._connecting: asyncio.Lock = None
+        self._request_ids = count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def __aenter__(self) -> 'AsyncSession':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        """
+        Opens the session, if it is not open yet.
+        """
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self.is_open:
+                return
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(*self._server_tcp), self._timeout)
+            self._writer.write(SESSION_MAGIC)
+            self._reading = asyncio.ensure_future(self._read_replies(self._reader))
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        """
+        Delivers every reply to the request waiting for it, until the
+        session is closed.
+        """
+        decoder = FrameDecoder()
+        error: Exception = ConnectionError("Session closed by server")
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame, _ in decoder.feed(data):
+                    future = self._pending.pop(frame.get("request_id"), None)
+                    if future is None:
+                        log("Received reply for unknown request: {}", "warning", frame)
+                    elif not future.done():
+                        future.set_result(frame)
+        except (OSError, ProtocolError) as exc:
+            error = exc
+        except asyncio.CancelledError:
+            error = ConnectionError("Session closed")
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def request(self, message: dict, codec: Codec = JSON) -> Any:
+        """
+        Sends a request, waits for its reply and returns the parsed
+        response. Raises if the server reports a failure.
+        """
+        if not self.is_open:
+            await self.connect()
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(encode_frame({**message, "request_id": request_id}, codec))
+            reply = await asyncio.wait_for(future, self._timeout)
+        finally:
+            self._pending.pop(request_id, None)
+        if reply["success"]:
+            return reply["message"]
+        raise Exception(reply["message"])
+
+    async def close(self):
+        """
+        Closes the session, failing every request still waiting on it.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reading is not None:
+            self._reading.cancel()
+            try:
+                await self._reading
+            except asyncio.CancelledError:
+                pass
+            self._reading = None
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, client: 'AsyncClient'):
+        super().__init__()
+        self._client: 'AsyncClient' = client
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self._client.add_server_message(data)
+
+    def error_received(self, exc: Exception):
+        log("UDP socket error: {}", "error", exc)
+
+
+class AsyncClient:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        server_host: str,
+        server_port_tcp: int = 1234,
+        server_port_udp: int = 1234,
+        client_port_udp: int = 0,
+        session: AsyncSession = None,
+        timeout: float = 5,
+        codec: str = "json",
+        max_messages: int = DEFAULT_MAX_MESSAGES,
+        overflow: str = "drop_oldest",
+        reliable: bool = False,
+    ):
+        """
+        Asyncio client for communicating with the game server.
+
+        Requests go through `session`, or through a session of its own when
+        none is given. Messages from the server are received on
+        `client_port_udp`, or on any free port if it is 0, and queued in the
+        order they arrive, up to `max_messages` of them, handling overflow
+        according to one of `ASYNC_OVERFLOW_POLICIES`.
+
+        When `reliable` is set, the client asks the server for reliable
+        channels, as `Client` does. Like `Client`, the client never tells the
+        server its port: every datagram carries the token given at
+        registration, and the server replies to the address it comes from.
+
+        `connect` must be awaited before anything else, which registers the
+        client.
+        """
+        if max_messages < 1:
+            raise ValueError(f"Invalid maximum number of messages: {max_messages}")
+        if overflow not in ASYNC_OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflow}")
+        self._identifier: str = None
+        self._token: str = None
+        self._room_id: str = None
+        self._server_udp: Tuple[str, int] = (server_host, server_port_udp)
+        self._client_port_udp: int = client_port_udp
+        self._owns_session: bool = session is None
+        self._session: AsyncSession = (
+            session if session is not None
+            else AsyncSession(server_host, server_port_tcp, timeout))
+        self._preferred_codec: str = get_codec(codec).name
+        self._codec: Codec = JSON
+        self._transport: asyncio.DatagramTransport = None
+        self._messages: asyncio.Queue = asyncio.Queue()
+        self._max_messages: int = max_messages
+        self._overflow: str = overflow
+        self._dropped: int = 0
+        self._reliable_requested: bool = reliable
+        self._reliable: bool = False
+        self._batching: bool = False
+        self._game: dict = None
+        self._snapshots: SnapshotReceiver = SnapshotReceiver()
+        self._peer: ReliablePeer = ReliablePeer()
+        self._retransmitting: asyncio.Task = None
+
+    async def __aenter__(self) -> 'AsyncClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __str__(self) -> str:
+        return f"<AsyncClient {self._identifier} (udp_port={self._client_port_udp})>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @property
+    def identifier(self) -> str:
+        """
+        Returns the identifier of this client.
+        """
+        return self._identifier
+
+    @property
+    def room_id(self) -> str:
+        """
+        Returns the room id of this client.
+        """
+        return self._room_id
+
+    @property
+    def codec(self) -> Codec:
+        """
+        Returns the codec negotiated with the server.
+        """
+        return self._codec
+
+    @property
+    def reliable(self) -> bool:
+        """
+        Returns whether the server agreed to reliable channels.
+        """
+        return self._reliable
+
+    @property
+    def game(self) -> Optional[dict]:
+        """
+        Returns the latest view of the game of the room, if any.
+        """
+        return self._game
+
+    @property
+    def dropped_messages(self) -> int:
+        """
+        Returns the number of messages dropped because too many were queued.
+        """
+        return self._dropped
+
+    async def connect(self):
+        """
+        Starts listening for server messages and registers the client.
+        """
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ClientProtocol(self),
+            local_addr=("0.0.0.0", self._client_port_udp),
+        )
+        self._client_port_udp = self._transport.get_extra_info("sockname")[1]
+        await self.register()
+        if self._reliable:
+            self._retransmitting = asyncio.ensure_future(self._retransmit_loop())
+
+    async def close(self):
+        """
+        Stops listening for server messages, and closes the session if it
+        is not shared.
+        """
+        if self._retransmitting is not None:
+            self._retransmitting.cancel()
+            self._retransmitting = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+            self._messages.put_nowait(_CLOSED)
+        if self._owns_session:
+            await self._session.close()
+
+    def add_server_message(self, message: bytes):
+        """
+        Queues a message received from the server. Views of the game and
+        reliable acknowledgements are applied right away instead, reliable
+        messages are queued once they are in order, and batches one message
+        at a time.
+        """
+        if self._reliable or self._batching:
+            try:
+                data = decode(message)
+            except ProtocolError:
+                data = None
+            if isinstance(data, dict):
+                if isinstance(data.get(GAME_SENDER), dict):
+                    self.receive_game(data[GAME_SENDER])
+                    return
+                if self._reliable and ACK_SENDER in data:
+                    self.apply_ack(data[ACK_SENDER])
+                    return
+                if self._reliable and RELIABLE_SENDER in data:
+                    self.receive_reliable(data[RELIABLE_SENDER])
+                    return
+                if self._batching and isinstance(data.get(BATCH_SENDER), list):
+                    for item in data[BATCH_SENDER]:
+                        self.deliver(self._codec.encode(item))
+                    return
+        self.deliver(message)
+
+    def deliver(self, message: bytes):
+        """
+        Queues a message, dropping one if there are too many.
+        """
+        if self._messages.qsize() >= self._max_messages:
+            self._dropped += 1
+            if self._overflow == "drop_newest":
+                return
+            self._messages.get_nowait()
+        self._messages.put_nowait(message)
+
+    def receive_game(self, snapshot: dict):
+        """
+        Applies and acknowledges a view of the game pushed by the server, as
+        `Client` does.
+        """
+        try:
+            view = self._snapshots.receive(snapshot)
+        except ValueError as exc:
+            log("Invalid view of the game {}: {!r}", "error", snapshot, exc)
+            return
+        self.send_udp_message({
+            "action": "game_ack",
+            "payload": snapshot["version"] if view is not None else 0,
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        })
+        if view is not None:
+            self.apply_game(view)
+
+    def apply_game(self, view: dict):
+        """
+        Keeps the latest view of the game of the room, as `Client` does.
+        """
+        current = self._game
+        if (current is None or current["id"] != view["id"]
+                or current["version"] <= view["version"]):
+            self._game = view
+
+    def apply_ack(self, ack: dict):
+        """
+        Applies an acknowledgement of reliable messages, sending the ones
+        that were waiting for room in the window.
+        """
+        try:
+            datagrams = self._peer.acknowledge(
+                ack["channel"], parse_seq(ack["epoch"]), parse_seq(ack["seq"]),
+                parse_sack(ack.get("sack")))
+        except (KeyError, TypeError, ValueError) as exc:
+            log("Invalid acknowledgement {}: {!r}", "error", ack, exc)
+            return
+        for data in datagrams:
+            self.send_udp_message(data)
+
+    def receive_reliable(self, envelope: dict):
+        """
+        Acknowledges a reliable message, then queues every message of its
+        channel that is now in order, as if it was sent unreliably.
+        """
+        try:
+            channel = envelope["channel"]
+            delivered, ack = self._peer.receive(
+                channel, parse_seq(envelope["epoch"]), parse_seq(envelope["seq"]),
+                {envelope["sender"]: envelope["message"]})
+        except (KeyError, TypeError, ValueError) as exc:
+            log("Invalid reliable message {}: {!r}", "error", envelope, exc)
+            return
+        del ack["channel"]
+        self.send_udp_message({
+            "action": "ack",
+            "payload": ack,
+            "room_id": channel,
+            "identifier": self._identifier,
+        })
+        for message in delivered:
+            self.deliver(self._codec.encode(message))
+
+    async def _retransmit_loop(self):
+        """
+        Sends again the reliable messages that were not acknowledged in
+        time, until the client is closed.
+        """
+        while True:
+            await asyncio.sleep(RETRANSMIT_TICK)
+            datagrams, failed = self._peer.due()
+            for channel in failed:
+                log("Gave up on reliable channel {}", "error", channel)
+            for data in datagrams:
+                self.send_udp_message(data)
+
+    def decode_message(self, message: bytes) -> dict:  # pylint: disable=no-self-use
+        """
+        Decodes a message received from the server through UDP.
+        """
+        return decode(message)
+
+    def get_messages(self) -> List[bytes]:
+        """
+        Returns every message received from server since the last call,
+        oldest first, without waiting.
+        """
+        messages = []
+        while not self._messages.empty():
+            message = self._messages.get_nowait()
+            if message is _CLOSED:
+                # Later calls to `receive` must still see it
+                self._messages.put_nowait(_CLOSED)
+                break
+            messages.append(message)
+        return messages
+
+    async def receive(self, timeout: float = None) -> Optional[bytes]:
+        """
+        Returns the next message received from server, waiting up to
+        `timeout` seconds, or forever, for it. Returns `None` if none
+        arrived, or if the client was closed.
+        """
+        try:
+            message = await asyncio.wait_for(self._messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is _CLOSED:
+            self._messages.put_nowait(_CLOSED)
+            return None
+        return message
+
+    async def messages(self) -> AsyncIterator[bytes]:
+        """
+        Yields every message received from server, waiting for the next one,
+        until the client is closed.
+        """
+        while True:
+            message = await self.receive()
+            if message is None:
+                return
+            yield message
+
+    async def send_tcp_message(self, message: dict) -> Any:
+        """
+        Sends a request through the session and returns the parsed
+        response.
+        """
+        return await self._session.request(message, self._codec)
+
+    def send_udp_message(self, message: Union[bytes, dict]) -> None:
+        """
+        Sends an UDP message, through the socket messages are received on.
+        """
+        if isinstance(message, dict):
+            if self._token is not None:
+                message = {**message, "token": self._token}
+            message = self._codec.encode(message)
+        if self._transport is not None:
+            self._transport.sendto(message, self._server_udp)
+
+    def send_reliable(self, message: dict) -> None:
+        """
+        Sends an UDP message through the reliable channel of its room.
+        """
+        if not self._reliable:
+            raise ValueError("The server did not agree to reliable channels")
+        codec = self._codec
+        message = {**message, "token": self._token}
+        data = self._peer.send(
+            message["room_id"],
+            lambda epoch, seq: codec.encode({**message, "epoch": epoch, "seq": seq}),
+        )
+        if data is not None:
+            self.send_udp_message(data)
+
+    async def register(self):
+        """
+        Register the client to server and get unique identifier.
+        """
+        payload = {
+            "codecs": [self._preferred_codec],
+            "batching": True,
+        }
+        if self._reliable_requested:
+            payload["reliable"] = True
+        response = await self.send_tcp_message({
+            "action": "register",
+            "payload": payload,
+        })
+        self._identifier = response["identifier"]
+        self._codec = get_codec(response["codec"])
+        self._reliable = bool(response.get("reliable"))
+        self._batching = bool(response.get("batching"))
+        self._token = response["token"]
+        self.ping()
+
+    def ping(self):
+        """
+        Tells the server that this client is still there.
+        """
+        self.send_udp_message({
+            "action": "ping",
+            "identifier": self._identifier,
+        })
+
+    def send_all(self, message: Any, reliable: bool = False):
+        """
+        Sends a message to all players in the room, reliably if asked to.
+        """
+        message = {
+            "action": "send",
+            "payload": {"message": message},
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        }
+        if reliable:
+            self.send_reliable(message)
+        else:
+            self.send_udp_message(message)
+
+    def send_to(self, recipients: List[str], message: Any, reliable: bool = False):
+        """
+        Sends a message to a list of players, reliably if asked to.
+        """
+        message = {
+            "action": "sendto",
+            "payload": {"message": message, "recipients": recipients},
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        }
+        if reliable:
+            self.send_reliable(message)
+        else:
+            self.send_udp_message(message)
+
+    async def create_room(self, room_name: str = None, tick_rate: int = 0):
+        """
+        Creates a new room in the server, with a tick rate if given, as
+        `Client.create_room` does.
+        """
+        self._room_id = await self.send_tcp_message({
+            "action": "create",
+            "payload": {"name": room_name, "tick_rate": tick_rate} if tick_rate else room_name,
+            "identifier": self._identifier,
+        })
+        self._snapshots.reset()
+        self.ping()
+
+    async def join_room(self, room_id: str):
+        """
+        Joins an existing room in the server.
+        """
+        self._room_id = await self.send_tcp_message({
+            "action": "join",
+            "payload": room_id,
+            "identifier": self._identifier,
+        })
+        self._snapshots.reset()
+        self.ping()
+
+    async def autojoin(self):
+        """
+        Join any valid room.
+        """
+        self._room_id = await self.send_tcp_message({
+            "action": "autojoin",
+            "identifier": self._identifier,
+        })
+        self._snapshots.reset()
+        self.ping()
+
+    async def leave_room(self):
+        """
+        Leave the current room.
+        """
+        await self.send_tcp_message({
+            "action": "leave",
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        })
+        self._peer.forget(self._room_id)
+        self._snapshots.reset()
+
+    async def start_game(self, rules: str = "eights", **options) -> dict:
+        """
+        Starts a game between the players of the room, as
+        `Client.start_game` does.
+        """
+        return await self._game_request("start_game", {"rules": rules, **options})
+
+    async def play(self, move: Any) -> dict:
+        """
+        Makes a move in the game of the room, as `Client.play` does.
+        """
+        return await self._game_request("play", move)
+
+    async def get_game(self) -> dict:
+        """
+        Gets the view of the game of the room of this client.
+        """
+        return await self._game_request("get_game")
+
+    async def _game_request(self, action: str, payload: Any = None) -> dict:
+        message = {
+            "action": action,
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        }
+        if payload is not None:
+            message["payload"] = payload
+        view = await self.send_tcp_message(message)
+        self.apply_game(view)
+        return view
+
+    async def get_rooms(self) -> List[dict]:
+        """
+        Gets the list of existing rooms in the server.
+        """
+        return await self.send_tcp_message({
+            "action": "get_rooms",
+            "identifier": self._identifier,
+        })
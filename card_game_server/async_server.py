@@ -0,0 +1,303 @@
+import asyncio
+import atexit
+from threading import Thread
+from typing import TYPE_CHECKING, Awaitable, Optional, Set, Tuple, Union
+
+from card_game_server.codec import JSON, Codec, decode
+from card_game_server.exceptions import (
+    ProtocolError,
+    RoomNotFoundError,
+    UdpServerFailedToSendError,
+)
+from card_game_server.handler import Handler, encode_reply
+from card_game_server.logger import log
+from card_game_server.metrics import METRICS
+from card_game_server.models.rooms import Rooms
+from card_game_server.models.message import Message
+from card_game_server.protocol import (
+    MAX_REQUEST_SIZE,
+    SESSION_MAGIC,
+    FrameDecoder,
+    encode_frame,
+    session_preamble,
+)
+
+if TYPE_CHECKING:
+    from card_game_server.cluster import ShardRouter  # pylint: disable=cyclic-import
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(
+        self,
+        handler: Handler,
+        router: 'ShardRouter' = None,
+    ):
+        """
+        Datagram protocol for the asyncio server engine.
+        """
+        super().__init__()
+        self._handler: Handler = handler
+        self._router: 'ShardRouter' = router
+        self._transport: asyncio.DatagramTransport = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self._transport = transport
+        # Messages to players go out through this very transport
+        self._handler.rooms.fanout.bind(transport.sendto, asyncio.get_running_loop())
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        """
+        Handles a single datagram.
+        """
+        METRICS.datagrams_received.inc()
+        METRICS.bytes_received.inc(len(data))
+        try:
+            data = decode(data)
+            message: Message = Message(data)
+        except ProtocolError:
+            METRICS.decode_failures.inc(1, "udp")
+            log("Failed to decode datagram from {}", "error", addr)
+            return
+
+        log("Received message from {}: {}", "debug", addr, data,
+            room=message.room_id, player=message.identifier)
+        if self._router is not None and self._router.route_datagram(message, addr):
+            return
+        try:
+            self._handler.handle_udp(message, addr)
+        except RoomNotFoundError:
+            log("Room with id {} not found", "error", message.room_id)
+        except UdpServerFailedToSendError:
+            log("Failed to deliver message from {}", "error", addr)
+        except Exception as exc:  # pylint: disable=broad-except
+            log("Failed to handle datagram from {}: {!r}", "error", addr, exc)
+
+    def error_received(self, exc: Exception):
+        log("UDP socket error: {}", "error", exc)
+
+
+class AsyncServer(Thread):  # pylint: disable=too-many-instance-attributes
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        tcp_port: Union[str, int],
+        udp_port: Union[str, int],
+        rooms: Rooms,
+        backlog: int = 4096,
+        timeout: float = 5,
+        reuse_port: bool = False,
+        router: 'ShardRouter' = None,
+    ):
+        """
+        Server engine that serves both TCP and UDP from a single asyncio
+        event loop, so a slow client never stalls the others.
+
+        When running as one worker of a multi-process server, the ports are
+        shared with the other workers through `SO_REUSEPORT`, and the router
+        forwards whatever belongs to another worker's shard.
+        """
+        super().__init__()
+        self._tcp_port: int = int(tcp_port)
+        self._udp_port: int = int(udp_port)
+        self._rooms: Rooms = rooms
+        self._handler: Handler = Handler(rooms)
+        self._backlog: int = backlog
+        self._timeout: float = timeout
+        self._loop: asyncio.AbstractEventLoop = None
+        self._stopped: asyncio.Event = None
+        self._sessions: Set[asyncio.StreamWriter] = set()
+        self._reuse_port: bool = reuse_port
+        self._router: 'ShardRouter' = router
+        self._forwarded: Set[asyncio.Task] = set()
+        atexit.register(self.stop)
+
+    async def read_preamble(self, reader: asyncio.StreamReader) -> Tuple[bool, bytes]:
+        """
+        Reads the first bytes of a connection and tells whether it opens a
+        session. Also returns whatever was read past the preamble.
+        """
+        buffer = b""
+        is_session = None
+        while is_session is None:
+            chunk = await reader.read(4096)
+            if not chunk:
+                raise ValueError("Connection closed before any request")
+            buffer += chunk
+            is_session = session_preamble(buffer)
+        if is_session:
+            return True, buffer[len(SESSION_MAGIC):]
+        return False, buffer
+
+    async def read_request(self, reader: asyncio.StreamReader, buffer: bytes = b"") -> dict:
+        """
+        Reads a whole JSON request from a stream.
+        """
+        try:
+            return JSON.decode(buffer)
+        except ProtocolError:
+            pass
+        while len(buffer) < MAX_REQUEST_SIZE:
+            chunk = await reader.read(4096)
+            if not chunk:
+                break
+            buffer += chunk
+            try:
+                return JSON.decode(buffer)
+            except ProtocolError:
+                continue
+        raise ValueError("Incomplete request")
+
+    async def handle_session(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        address: Tuple[str, int],
+        buffer: bytes,
+    ):
+        """
+        Serves every request of a persistent session until the client
+        disconnects.
+        """
+        log("Session opened by {}", "debug", address)
+        self._sessions.add(writer)
+        decoder = FrameDecoder()
+        data = buffer
+        try:
+            while True:
+                for frame, codec in decoder.feed(data):
+                    message: Message = Message(frame)
+                    routed = self.route_request(address, message)
+                    if routed is not None:
+                        # Replies to routed requests are sent whenever they
+                        # arrive, without holding back the session
+                        task = asyncio.ensure_future(
+                            self.reply_later(writer, routed, codec))
+                        self._forwarded.add(task)
+                        task.add_done_callback(self._forwarded.discard)
+                        continue
+                    reply = self._handler.handle_request(address, message)
+                    writer.write(encode_frame(reply, codec))
+                await writer.drain()
+                data = await reader.read(65536)
+                if not data:
+                    break
+        finally:
+            self._sessions.discard(writer)
+        log("Session closed by {}", "debug", address)
+
+    def route_request(
+        self,
+        address: Tuple[str, int],
+        message: Message,
+    ) -> Optional[Awaitable[dict]]:
+        """
+        Lets the router take over a request. Returns `None` when the request
+        must be handled locally.
+        """
+        if self._router is None:
+            return None
+        return self._router.route_request(address, message)
+
+    async def reply_later(  # pylint: disable=no-self-use
+        self,
+        writer: asyncio.StreamWriter,
+        routed: Awaitable[dict],
+        codec: Codec,
+    ):
+        """
+        Waits for the reply to a routed request and sends it.
+        """
+        reply = await routed
+        if not writer.is_closing():
+            writer.write(encode_frame(reply, codec))
+
+    async def handle_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        """
+        Handles a single TCP connection, either as a persistent session or
+        as a legacy one-shot request.
+        """
+        address = writer.get_extra_info("peername")
+        try:
+            is_session, buffer = await asyncio.wait_for(
+                self.read_preamble(reader), self._timeout)
+            if is_session:
+                await self.handle_session(reader, writer, address, buffer)
+                return
+            data = await asyncio.wait_for(
+                self.read_request(reader, buffer), self._timeout)
+            if not isinstance(data, dict):
+                raise ValueError("Request is not an object")
+            message: Message = Message(data)
+            log("Received message from {}: {}", "debug", address, data,
+                room=message.room_id, player=message.identifier)
+            routed = self.route_request(address, message)
+            if routed is not None:
+                reply = await routed
+                success, data = reply['success'], reply['message']
+            else:
+                success, data = self._handler.handle_tcp(address, message)
+            writer.write(encode_reply(success, data))
+            await writer.drain()
+            log("Sent reply to {} for action {}", "debug", address, message.action,
+                player=message.identifier)
+        except (asyncio.TimeoutError, ValueError, ProtocolError) as exc:
+            if isinstance(exc, ProtocolError):
+                METRICS.decode_failures.inc(1, "tcp")
+            log("Dropping connection from {}: {!r}", "error", address, exc)
+        except ConnectionError as exc:
+            log("Connection with {} lost: {!r}", "error", address, exc)
+        except asyncio.CancelledError:
+            # The server is shutting down. This task is the last one to see
+            # the cancellation, and re-raising it would only have the stream
+            # callback log a traceback
+            log("Connection with {} closed on shutdown", "debug", address)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """
+        Starts both endpoints and serves until stopped.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: UdpProtocol(self._handler, self._router),
+            local_addr=('0.0.0.0', self._udp_port),
+            reuse_port=self._reuse_port or None,
+        )
+        server = await asyncio.start_server(
+            self.handle_connection,
+            '0.0.0.0',
+            self._tcp_port,
+            backlog=self._backlog,
+            reuse_port=self._reuse_port or None,
+        )
+        if self._router is not None:
+            await self._router.start()
+        log("Serving TCP on {} and UDP on {}", "debug", self._tcp_port, self._udp_port)
+        try:
+            await self._stopped.wait()
+        finally:
+            if self._router is not None:
+                await self._router.stop()
+            server.close()
+            for writer in list(self._sessions):
+                writer.close()
+            await server.wait_closed()
+            transport.close()
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """
+        Stop the server.
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stopped.set)
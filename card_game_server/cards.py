@@ -0,0 +1,214 @@
+"""
+Compact sets and piles of cards.
+
+Cards are small integers, from 0 to the size of the deck minus one, whose
+meaning is up to the rules of the game (see `card_game_server.game`). In the
+standard 52-card deck, card `suit * RANKS + rank` is the rank `rank` (0 for
+the ace, 12 for the king) of the suit `suit` (clubs, diamonds, hearts,
+spades).
+
+A `CardSet` is an unordered set of cards kept as the bits of a single
+integer, so that membership, union, intersection and difference are a few
+bit operations whatever the size of the set, and a whole hand goes on the
+wire as one number. A `Pile` is an ordered stack of cards kept in an `array`
+of bytes, drawn from its top in O(1) time.
+"""
+
+from array import array
+from random import Random
+from typing import Iterable, Iterator, List, Optional
+
+# Largest deck a pile can hold, as cards are stored in single bytes
+MAX_CARDS = 256
+
+SUITS = 4
+RANKS = 13
+STANDARD_DECK = SUITS * RANKS
+
+
+def make_card(rank: int, suit: int) -> int:
+    """
+    Get a card of the standard deck.
+    """
+    return suit * RANKS + rank
+
+
+def rank_of(card: int) -> int:
+    """
+    Get the rank of a card of the standard deck.
+    """
+    return card % RANKS
+
+
+def suit_of(card: int) -> int:
+    """
+    Get the suit of a card of the standard deck.
+    """
+    return card // RANKS
+
+
+class CardSet:
+
+    __slots__ = ("_bits",)
+
+    def __init__(self, cards: Iterable[int] = (), bits: int = 0):
+        """
+        Set of cards, given either as cards or as the bits of another set.
+        """
+        if bits < 0:
+            raise ValueError(f"Invalid card set: {bits}")
+        for card in cards:
+            bits |= 1 << card
+        self._bits: int = bits
+
+    def __contains__(self, card: int) -> bool:
+        return card >= 0 and bool(self._bits >> card & 1)
+
+    def __len__(self) -> int:
+        return bin(self._bits).count("1")
+
+    def __bool__(self) -> bool:
+        return self._bits != 0
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Yields the cards of the set, lowest first.
+        """
+        bits = self._bits
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    def __eq__(self, other: 'CardSet'):
+        return isinstance(other, CardSet) and self._bits == other._bits
+
+    __hash__ = None
+
+    def __or__(self, other: 'CardSet') -> 'CardSet':
+        return CardSet(bits=self._bits | other._bits)
+
+    def __and__(self, other: 'CardSet') -> 'CardSet':
+        return CardSet(bits=self._bits & other._bits)
+
+    def __sub__(self, other: 'CardSet') -> 'CardSet':
+        return CardSet(bits=self._bits & ~other._bits)
+
+    def __str__(self) -> str:
+        return f"<CardSet {self.to_list()}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @property
+    def bits(self) -> int:
+        return self._bits
+
+    def add(self, card: int) -> None:
+        self._bits |= 1 << card
+
+    def remove(self, card: int) -> None:
+        """
+        Removes a card, raising `KeyError` if it is not in the set.
+        """
+        if card not in self:
+            raise KeyError(card)
+        self._bits ^= 1 << card
+
+    def discard(self, card: int) -> None:
+        if card >= 0:
+            self._bits &= ~(1 << card)
+
+    def update(self, other: 'CardSet') -> None:
+        self._bits |= other.bits
+
+    def clear(self) -> None:
+        self._bits = 0
+
+    def to_list(self) -> List[int]:
+        return list(self)
+
+
+class Pile:
+
+    __slots__ = ("_cards",)
+
+    def __init__(self, cards: Iterable[int] = ()):
+        """
+        Ordered stack of cards, bottom first.
+        """
+        self._cards: array = array("B", cards)
+
+    def __len__(self) -> int:
+        return len(self._cards)
+
+    def __bool__(self) -> bool:
+        return len(self._cards) > 0
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Yields the cards of the pile, bottom first.
+        """
+        return iter(self._cards)
+
+    def __str__(self) -> str:
+        return f"<Pile {self.to_list()}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @property
+    def top(self) -> Optional[int]:
+        """
+        Get the card on top of the pile, or `None` if it is empty.
+        """
+        return self._cards[-1] if self._cards else None
+
+    def push(self, card: int) -> None:
+        """
+        Puts a card on top of the pile.
+        """
+        self._cards.append(card)
+
+    def draw(self) -> int:
+        """
+        Takes the card on top of the pile, raising `IndexError` if it is
+        empty.
+        """
+        return self._cards.pop()
+
+    def draw_many(self, count: int) -> CardSet:
+        """
+        Takes up to `count` cards from the top of the pile.
+        """
+        count = min(count, len(self._cards))
+        if count <= 0:
+            return CardSet()
+        drawn = CardSet(self._cards[-count:])
+        del self._cards[-count:]
+        return drawn
+
+    def take_all(self) -> List[int]:
+        """
+        Empties the pile and returns its cards, bottom first.
+        """
+        cards = self._cards.tolist()
+        del self._cards[:]
+        return cards
+
+    def extend(self, cards: Iterable[int]) -> None:
+        """
+        Puts cards on top of the pile, in order.
+        """
+        self._cards.extend(cards)
+
+    def shuffle(self, rng: Random) -> None:
+        """
+        Shuffles the pile in place.
+        """
+        cards = self._cards.tolist()
+        rng.shuffle(cards)
+        self._cards = array("B", cards)
+
+    def to_list(self) -> List[int]:
+        return self._cards.tolist()
@@ -1,9 +1,28 @@
-from threading import Lock
+from typer import BadParameter, Typer
 
-from typer import Typer
-
-from card_game_server.models.rooms import Rooms
+from card_game_server.async_server import AsyncServer
+from card_game_server.cluster import Cluster
+from card_game_server.journal import (
+    JOURNAL_FSYNC,
+    JOURNAL_INTERVAL,
+    SNAPSHOT_INTERVAL,
+    Journal,
+    JournalWriter,
+)
+from card_game_server.liveness import Liveness, Reaper
+from card_game_server.lobby import LOBBY_INTERVAL, LobbyPublisher
+from card_game_server.logger import LEVELS, configure, get_verbosity, set_verbosity
+from card_game_server.metrics import MetricsServer
+from card_game_server.models.rooms import AUTOJOIN_POLICIES, Rooms
+from card_game_server.reclaimer import (
+    RECLAIM_BATCH,
+    RECLAIM_GRACE,
+    RECLAIM_INTERVAL,
+    Reclaimer,
+)
+from card_game_server.reliable import Retransmitter
 from card_game_server.server import TcpServer, UdpServer
+from card_game_server.ticks import TickScheduler
 
 app = Typer()
 
@@ -15,16 +34,124 @@ app = Typer()
 
 
 @app.command()
-def start(capacity: int = 2, tcp_port: int = 1234, udp_port: int = 1234):
+def start(
+    capacity: int = 2,
+    tcp_port: int = 1234,
+    udp_port: int = 1234,
+    engine: str = "threads",
+    autojoin_policy: str = "fill",
+    workers: int = 1,
+    log_level: str = "info",
+    metrics_port: int = 0,
+    idle_timeout: float = 0,
+    liveness_tick: float = 1.0,
+    reclaim_interval: float = RECLAIM_INTERVAL,
+    reclaim_grace: float = RECLAIM_GRACE,
+    reclaim_batch: int = RECLAIM_BATCH,
+    lobby_interval: float = LOBBY_INTERVAL,
+    journal_dir: str = "",
+    journal_fsync: str = "batch",
+    journal_interval: float = JOURNAL_INTERVAL,
+    snapshot_interval: float = SNAPSHOT_INTERVAL,
+):
     """
     Starts the server.
+
+    The `threads` engine runs one thread for TCP and one for UDP, while the
+    `asyncio` engine serves both from a single event loop.
+
+    The autojoin policy is either `fill` (fullest open room first, so games
+    start sooner) or `spread` (emptiest open room first).
+
+    With more than one worker, the server forks that many processes sharing
+    the same ports, each owning a shard of the rooms. Workers always run the
+    `asyncio` engine, whatever the engine option says. The inspection
+    commands are not available in that mode.
+
+    When a metrics port is given, metrics are served in the Prometheus text
+    format at `http://127.0.0.1:<metrics_port>/metrics`. With more than one
+    worker, each worker serves its own metrics on the next ports.
+
+    When an idle timeout is given, players that send nothing, not even a
+    keep-alive ping, for that many seconds are removed from their rooms and
+    unregistered. Idle players are looked for once per liveness tick.
+
+    Rooms that have been empty for the reclaim grace period are removed,
+    at most a reclaim batch of them every reclaim interval. A reclaim
+    interval of 0 keeps empty rooms forever.
+
+    Players subscribed to the lobby get the changes in the rooms pushed to
+    them at most once every lobby interval. A lobby interval of 0 disables
+    the pushes.
+
+    When a journal directory is given, players, rooms and memberships are
+    journaled there, and recovered from it when the server starts again.
+    Changes are written every journal interval, and synced to disk according
+    to the journal fsync policy: `always` (before every change returns),
+    `batch` (after every write) or `never` (left to the operating system).
+    A snapshot is written every snapshot interval, unless it is 0, so that
+    recovering only replays the changes made after it.
+
+    The log level may be raised at runtime for a single room or player with
+    the `verbose` command.
     """
-    lock = Lock()
-    rooms = Rooms(capacity)
-    udp_server = UdpServer(udp_port, rooms, lock)
-    tcp_server = TcpServer(tcp_port, rooms, lock)
-    udp_server.start()
-    tcp_server.start()
+    if engine not in ("threads", "asyncio"):
+        raise BadParameter(f"Unknown engine {engine}, use 'threads' or 'asyncio'")
+    if autojoin_policy not in AUTOJOIN_POLICIES:
+        raise BadParameter(
+            f"Unknown autojoin policy {autojoin_policy}, use one of {AUTOJOIN_POLICIES}")
+    if log_level not in LEVELS:
+        raise BadParameter(f"Unknown log level {log_level}, use one of {tuple(LEVELS)}")
+    if workers < 1:
+        raise BadParameter(f"Invalid number of workers {workers}")
+    if idle_timeout < 0 or liveness_tick <= 0:
+        raise BadParameter(
+            f"Invalid idle timeout {idle_timeout} or liveness tick {liveness_tick}")
+    if reclaim_interval < 0 or reclaim_grace < 0 or reclaim_batch < 1:
+        raise BadParameter(
+            f"Invalid reclaim interval {reclaim_interval}, grace {reclaim_grace} "
+            f"or batch {reclaim_batch}")
+    if lobby_interval < 0:
+        raise BadParameter(f"Invalid lobby interval {lobby_interval}")
+    if journal_fsync not in JOURNAL_FSYNC:
+        raise BadParameter(
+            f"Unknown journal fsync policy {journal_fsync}, use one of {JOURNAL_FSYNC}")
+    if journal_interval <= 0 or snapshot_interval < 0:
+        raise BadParameter(
+            f"Invalid journal interval {journal_interval} or snapshot interval {snapshot_interval}")
+    configure(log_level)
+    if workers > 1:
+        # Every worker builds its own registry and background threads
+        rooms = None
+        servers = [Cluster(
+            workers, tcp_port, udp_port, capacity, autojoin_policy, metrics_port,
+            idle_timeout, liveness_tick, reclaim_interval, reclaim_grace, reclaim_batch,
+            lobby_interval, journal_dir, journal_fsync, journal_interval, snapshot_interval)]
+    else:
+        liveness = Liveness(idle_timeout, liveness_tick) if idle_timeout else None
+        journal = Journal(journal_dir, journal_fsync) if journal_dir else None
+        rooms = Rooms(capacity, autojoin_policy, liveness=liveness, journal=journal)
+        if engine == "asyncio":
+            servers = [AsyncServer(tcp_port, udp_port, rooms)]
+        else:
+            servers = [
+                UdpServer(udp_port, rooms),
+                TcpServer(tcp_port, rooms),
+            ]
+        if metrics_port:
+            servers.append(MetricsServer(metrics_port, rooms))
+        if liveness is not None:
+            servers.append(Reaper(rooms))
+        if reclaim_interval:
+            servers.append(Reclaimer(rooms, reclaim_interval, reclaim_grace, reclaim_batch))
+        if lobby_interval:
+            servers.append(LobbyPublisher(rooms.lobby, lobby_interval))
+        servers.append(Retransmitter(rooms.reliable))
+        servers.append(TickScheduler(rooms.ticks))
+        if journal is not None:
+            servers.append(JournalWriter(rooms, journal_interval, snapshot_interval))
+    for server in servers:
+        server.start()
     is_running = True
 
     print("Simple Game Server.")
@@ -32,12 +159,16 @@ def start(capacity: int = 2, tcp_port: int = 1234, udp_port: int = 1234):
     print("list : list rooms")
     print("room #room_id : print room information")
     print("user #user_id : print user information")
+    print("verbose #id [level] : set log level of a room or user, or reset it")
+    print("verbose : list log levels of rooms and users")
     print("quit : quit server")
     print("--------------------------------------")
 
     while is_running:
         cmd = input("cmd >")
-        if cmd == "list":
+        if workers > 1 and cmd != "quit":
+            print("Not available with multiple workers")
+        elif cmd == "list":
             if len(rooms.rooms) == 0:
                 print("No rooms.")
             else:
@@ -68,11 +199,23 @@ def start(capacity: int = 2, tcp_port: int = 1234, udp_port: int = 1234):
                 print(f"{player.identifier} : {player.address}")
             except:  # pylint: disable=bare-except
                 print("Error while getting user informations")
+        elif cmd == "verbose":
+            overrides = get_verbosity()
+            if not overrides:
+                print("No log level overrides.")
+            for identifier, level in overrides.items():
+                print(f"{identifier} : {level}")
+        elif cmd.startswith("verbose "):
+            try:
+                args = cmd[8:].split()
+                set_verbosity(args[0], args[1] if len(args) > 1 else None)
+            except:  # pylint: disable=bare-except
+                print("Error while setting log level")
         elif cmd == "quit":
             print("Shutting down  server...")
-            udp_server.stop()
-            tcp_server.stop()
+            for server in servers:
+                server.stop()
             is_running = False
 
-    udp_server.join()
-    tcp_server.join()
+    for server in servers:
+        server.join()
@@ -1,9 +1,34 @@
-import json
+from concurrent.futures import Future
+from itertools import count
 import socket
-from threading import Lock, Thread
-from typing import Any, List, Set, Tuple
+from threading import Event, Lock, Thread, current_thread
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+from card_game_server.codec import JSON, Codec, decode, get_codec
+from card_game_server.exceptions import ProtocolError
+from card_game_server.game import GAME_SENDER
+from card_game_server.inbox import DEFAULT_MAX_MESSAGES, Inbox
+from card_game_server.lobby import LOBBY_SENDER
 from card_game_server.logger import log
+from card_game_server.protocol import (
+    MAX_DATAGRAM_SIZE,
+    SESSION_MAGIC,
+    FrameDecoder,
+    encode_frame,
+)
+from card_game_server.reliable import (
+    ACK_SENDER,
+    RELIABLE_SENDER,
+    RETRANSMIT_TICK,
+    ReliablePeer,
+    parse_sack,
+    parse_seq,
+)
+from card_game_server.snapshots import SnapshotReceiver
+from card_game_server.ticks import BATCH_SENDER
+
+# Seconds `Client.close` waits for the thread reading datagrams to end
+STOP_TIMEOUT = 1.0
 
 
 class SocketThread(Thread):
@@ -11,63 +36,255 @@ class SocketThread(Thread):
         self,
         address: Tuple[str, int],
         client: 'Client',
-        lock: Lock,
     ):
         """
-        Implements a socket within a thread.
+        Implements a socket within a thread. The client sends its datagrams
+        through the same socket, so that the server replies to the address
+        it sees them come from.
         """
-        super().__init__()
+        super().__init__(daemon=True)
         self._client = client
-        self._lock = lock
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._sock.bind(address)
+        self._stopped: bool = False
+
+    @property
+    def port(self) -> int:
+        """
+        Returns the port the socket is bound to.
+        """
+        return self._sock.getsockname()[1]
 
     def run(self):
         """
         Get responses from server.
         """
-        while True:
-            data, _ = self._sock.recvfrom(1024)
-            self._lock.acquire()
+        while not self._stopped:
             try:
-                self._client.add_server_message(data)
-            finally:
-                self._lock.release()
+                data, _ = self._sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except OSError:
+                break
+            if self._stopped:
+                break
+            self._client.add_server_message(data)
+
+    def sendto(self, data: bytes, address: Tuple[str, int]):
+        """
+        Sends a datagram from the socket.
+        """
+        self._sock.sendto(data, address)
 
     def stop(self):
         """
-        Stops this thread.
+        Stops this thread, and waits for it unless called from it.
         """
+        self._stopped = True
+        # Closing the socket alone does not wake up `recvfrom` on Linux
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.is_alive() and current_thread() is not self:
+            self.join(STOP_TIMEOUT)
         self._sock.close()
 
 
-class Client:  # pylint: disable=too-many-instance-attributes
+class SessionThread(Thread):
+    def __init__(
+        self,
+        sock: socket.socket,
+        client: 'Client',
+    ):
+        """
+        Reads the replies of a persistent TCP session.
+        """
+        super().__init__(daemon=True)
+        self._sock = sock
+        self._client = client
+
+    def run(self):
+        """
+        Get replies from server.
+        """
+        decoder = FrameDecoder()
+        error: Exception = ConnectionError("Session closed by server")
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                for frame, _ in decoder.feed(data):
+                    self._client.resolve_request(frame)
+        except (OSError, ProtocolError) as exc:
+            error = exc
+        self._client.close_session(self._sock, error)
+
+
+class KeepAliveThread(Thread):
     def __init__(
+        self,
+        client: 'Client',
+        interval: float,
+    ):
+        """
+        Pings the server every `interval` seconds, so that it does not evict
+        the client while it is idle.
+        """
+        super().__init__(daemon=True)
+        self._client = client
+        self._interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        """
+        Pings the server until stopped.
+        """
+        while not self._stopped.wait(self._interval):
+            try:
+                self._client.ping()
+            except OSError as exc:
+                log("Failed to ping server: {!r}", "error", exc)
+
+    def stop(self):
+        """
+        Stops this thread.
+        """
+        self._stopped.set()
+
+
+class RetransmitThread(Thread):
+    def __init__(
+        self,
+        client: 'Client',
+        interval: float,
+    ):
+        """
+        Retransmits the reliable messages of the client that were not
+        acknowledged in time, checking every `interval` seconds.
+        """
+        super().__init__(daemon=True)
+        self._client = client
+        self._interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        """
+        Retransmits messages until stopped.
+        """
+        while not self._stopped.wait(self._interval):
+            try:
+                self._client.retransmit()
+            except OSError as exc:
+                log("Failed to retransmit messages: {!r}", "error", exc)
+
+    def stop(self):
+        """
+        Stops this thread.
+        """
+        self._stopped.set()
+
+
+class Client:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    def __init__(  # pylint: disable=too-many-arguments
         self,
         server_host: str,
         server_port_tcp: int = 1234,
         server_port_udp: int = 1234,
-        client_port_udp: int = 1235,
+        client_port_udp: int = 0,
+        persistent: bool = True,
+        timeout: float = 5,
+        codec: str = "json",
+        keepalive: float = 0,
+        max_messages: int = DEFAULT_MAX_MESSAGES,
+        overflow: str = "drop_oldest",
+        on_message: Callable[[bytes], None] = None,
+        reliable: bool = False,
     ):
         """
         Client for communicating with the game server.
+
+        When `persistent` is set, every TCP request goes through a single
+        long-lived session, where several requests may be in flight at once.
+        Otherwise, a new connection is opened for every request.
+
+        `codec` is the encoding the client would like to use for its
+        messages. The server may refuse it, in which case JSON is used.
+
+        When `keepalive` is set, the client pings the server every that many
+        seconds, which keeps it from being evicted by a server running with
+        an idle timeout.
+
+        Messages from the server are queued in the order they arrive, up to
+        `max_messages` of them, handling overflow according to `overflow`
+        (see `card_game_server.inbox`). When `on_message` is given, it is
+        called with every message instead, from the receiving thread.
+
+        When `reliable` is set, the client asks the server for reliable
+        channels (see `card_game_server.reliable`), so that `send_all` and
+        `send_to` may ask for reliable delivery. Reliable messages from other
+        players are acknowledged and queued in order, like any other message.
+
+        Datagrams are sent and received through a single socket, bound to
+        `client_port_udp`, or to any free port by default. The client does
+        not tell the server its port: the server sends to whatever address
+        the datagrams of the client come from, which works behind a NAT and
+        follows the client when that address changes. Every datagram carries
+        the token the server gave the client when it registered, and the
+        client pings the server right after registering and joining a room,
+        so that the server learns its address before it has anything to
+        send. Setting `keepalive` keeps a NAT from forgetting the mapping.
+
+        Rooms created with a tick rate send their messages in batches (see
+        `card_game_server.ticks`), which the client unpacks, so every message
+        is still queued on its own.
+
+        Views of the game of the room (see `card_game_server.game`) are not
+        queued: `game` always returns the latest one. The server pushes them
+        as deltas (see `card_game_server.snapshots`), which the client
+        applies and acknowledges.
         """
         self._identifier: str = None
-        self._server_messages: List[str] = []
+        self._inbox: Inbox = Inbox(max_messages, overflow)
+        self._on_message: Callable[[bytes], None] = on_message
         self._room_id = None
-        self._client_udp: Tuple[str, int] = ("0.0.0.0", client_port_udp)
-        self._lock = Lock()
         self._server_listener = SocketThread(
-            self._client_udp,
+            ("0.0.0.0", client_port_udp),
             self,
-            self._lock,
         )
+        self._client_udp: Tuple[str, int] = ("0.0.0.0", self._server_listener.port)
         self._server_listener.start()
+        self._token: str = None
         self._server_udp: Tuple[str, int] = (server_host, server_port_udp)
         self._server_tcp: Tuple[str, int] = (server_host, server_port_tcp)
         self._sock_tcp: socket.socket = None
+        self._persistent: bool = persistent
+        self._timeout: float = timeout
+        self._session_lock = Lock()
+        self._request_ids = count(1)
+        self._pending: Dict[int, Future] = {}
+        self._preferred_codec: str = get_codec(codec).name
+        self._codec: Codec = JSON
+        self._keepalive: KeepAliveThread = None
+        self._lobby_lock = Lock()
+        self._lobby_seq: int = None
+        self._lobby_rooms: Dict[str, dict] = {}
+        self._lobby_resyncing: bool = False
+        self._reliable_requested: bool = reliable
+        self._reliable: bool = False
+        self._batching: bool = False
+        self._peer: ReliablePeer = ReliablePeer()
+        self._retransmitter: RetransmitThread = None
+        self._game_lock = Lock()
+        self._game: dict = None
+        self._snapshots: SnapshotReceiver = SnapshotReceiver()
 
         self.register()
+        if self._reliable:
+            self._retransmitter = RetransmitThread(self, RETRANSMIT_TICK)
+            self._retransmitter.start()
+        if keepalive:
+            self._keepalive = KeepAliveThread(self, keepalive)
+            self._keepalive.start()
 
     def __str__(self) -> str:
         return f"<Client {self._identifier} (udp_port={self._client_udp[1]})>"
@@ -89,141 +306,608 @@ class Client:  # pylint: disable=too-many-instance-attributes
         """
         return self._room_id
 
-    def add_server_message(self, message: str):
+    @property
+    def codec(self) -> Codec:
+        """
+        Returns the codec negotiated with the server.
+        """
+        return self._codec
+
+    @property
+    def reliable(self) -> bool:
+        """
+        Returns whether the server agreed to reliable channels.
+        """
+        return self._reliable
+
+    @property
+    def game(self) -> Optional[dict]:
         """
-        Adds a server message to this object.
+        Returns the latest view of the game of the room, if any.
         """
-        self._server_messages.append(message)
+        return self._game
 
-    def parse_data(self, data: str) -> Any:  # pylint: disable=no-self-use
+    @property
+    def dropped_messages(self) -> int:
+        """
+        Returns the number of messages dropped because too many were queued.
+        """
+        return self._inbox.dropped
+
+    @property
+    def lobby_rooms(self) -> List[dict]:
+        """
+        Returns the rooms of the server, as kept up to date by the lobby
+        subscription.
+        """
+        with self._lobby_lock:
+            return list(self._lobby_rooms.values())
+
+    def add_server_message(self, message: bytes):
+        """
+        Adds a server message to this object. Lobby deltas, views of the
+        game and reliable acknowledgements are applied right away instead,
+        reliable messages are added once they are in order, and batches one
+        message at a time.
+        """
+        if self._lobby_seq is not None or self._reliable or self._batching:
+            try:
+                data = decode(message)
+            except ProtocolError:
+                data = None
+            if isinstance(data, dict):
+                if self._lobby_seq is not None and LOBBY_SENDER in data:
+                    self.apply_lobby_delta(data[LOBBY_SENDER])
+                    return
+                if isinstance(data.get(GAME_SENDER), dict):
+                    self.receive_game(data[GAME_SENDER])
+                    return
+                if self._reliable and ACK_SENDER in data:
+                    self.apply_ack(data[ACK_SENDER])
+                    return
+                if self._reliable and RELIABLE_SENDER in data:
+                    self.receive_reliable(data[RELIABLE_SENDER])
+                    return
+                if self._batching and isinstance(data.get(BATCH_SENDER), list):
+                    for item in data[BATCH_SENDER]:
+                        self.deliver(self._codec.encode(item))
+                    return
+        self.deliver(message)
+
+    def deliver(self, message: bytes):
+        """
+        Hands a message over to the callback, or queues it.
+        """
+        if self._on_message is None:
+            self._inbox.put(message)
+            return
+        try:
+            self._on_message(message)
+        except Exception as exc:  # pylint: disable=broad-except
+            log("Message callback failed: {!r}", "error", exc)
+
+    def apply_ack(self, ack: dict):
+        """
+        Applies an acknowledgement of reliable messages, sending the ones
+        that were waiting for room in the window.
+        """
+        try:
+            datagrams = self._peer.acknowledge(
+                ack["channel"], parse_seq(ack["epoch"]), parse_seq(ack["seq"]),
+                parse_sack(ack.get("sack")))
+        except (KeyError, TypeError, ValueError) as exc:
+            log("Invalid acknowledgement {}: {!r}", "error", ack, exc)
+            return
+        for data in datagrams:
+            self.send_udp_message(data)
+
+    def receive_reliable(self, envelope: dict):
+        """
+        Acknowledges a reliable message, then delivers every message of its
+        channel that is now in order, as if it was sent unreliably.
+        """
+        try:
+            channel = envelope["channel"]
+            delivered, ack = self._peer.receive(
+                channel, parse_seq(envelope["epoch"]), parse_seq(envelope["seq"]),
+                {envelope["sender"]: envelope["message"]})
+        except (KeyError, TypeError, ValueError) as exc:
+            log("Invalid reliable message {}: {!r}", "error", envelope, exc)
+            return
+        del ack["channel"]
+        self.send_udp_message({
+            "action": "ack",
+            "payload": ack,
+            "room_id": channel,
+            "identifier": self._identifier,
+        })
+        for message in delivered:
+            self.deliver(self._codec.encode(message))
+
+    def retransmit(self):
+        """
+        Sends again the reliable messages that were not acknowledged in time.
+        """
+        datagrams, failed = self._peer.due()
+        for channel in failed:
+            log("Gave up on reliable channel {}", "error", channel)
+        for data in datagrams:
+            self.send_udp_message(data)
+
+    def receive_game(self, snapshot: dict):
+        """
+        Applies a view of the game pushed by the server, whole or as a delta
+        from a view this client acknowledged, and acknowledges it in turn.
+        A delta from an unknown view is acknowledged as version 0, so that
+        the server sends the whole view next.
+        """
+        try:
+            view = self._snapshots.receive(snapshot)
+        except ValueError as exc:
+            log("Invalid view of the game {}: {!r}", "error", snapshot, exc)
+            return
+        self.send_udp_message({
+            "action": "game_ack",
+            "payload": snapshot["version"] if view is not None else 0,
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        })
+        if view is not None:
+            self.apply_game(view)
+
+    def apply_game(self, view: dict):
+        """
+        Keeps the latest view of the game of the room, see
+        `card_game_server.game`.
+        """
+        with self._game_lock:
+            current = self._game
+            if (current is None or current["id"] != view["id"]
+                    or current["version"] <= view["version"]):
+                self._game = view
+
+    def apply_lobby_delta(self, delta: dict):
+        """
+        Applies a lobby delta pushed by the server, or asks for a fresh
+        snapshot if a delta was missed. The snapshot is fetched by another
+        thread, so that receiving datagrams never waits on the server.
+        """
+        with self._lobby_lock:
+            if self._lobby_seq is None or delta["seq"] <= self._lobby_seq:
+                return
+            resync = delta.get("resync") or delta["seq"] != self._lobby_seq + 1
+            if resync:
+                if self._lobby_resyncing:
+                    return
+                self._lobby_resyncing = True
+            else:
+                self._lobby_seq = delta["seq"]
+                for room in delta.get("created", ()):
+                    self._lobby_rooms[room["id"]] = room
+                for room_id in delta.get("removed", ()):
+                    self._lobby_rooms.pop(room_id, None)
+                for change in delta.get("changed", ()):
+                    room = self._lobby_rooms.get(change["id"])
+                    if room is not None:
+                        room["n_players"] = change["n_players"]
+        if resync:
+            log("Missed lobby deltas, resyncing", "debug")
+            Thread(target=self.resync_lobby, daemon=True).start()
+
+    def resync_lobby(self):
+        """
+        Replaces the rooms of the lobby with a fresh snapshot.
+        """
+        try:
+            self.subscribe_lobby()
+        except Exception as exc:  # pylint: disable=broad-except
+            log("Failed to resync the lobby: {!r}", "error", exc)
+        finally:
+            with self._lobby_lock:
+                self._lobby_resyncing = False
+
+    def parse_data(self, data: str) -> Any:
         """
         Parses payload from server.
         """
         try:
-            data = json.loads(data)
-            if data["success"]:
-                return data["message"]
-            raise Exception(data["message"])
-        except ValueError:
-            log(data)
+            data = decode(data)
+            return self.parse_reply(data)
+        except ProtocolError:
+            log(data, "info")
         return None
 
-    def get_messages(self) -> Set[str]:
+    def parse_reply(self, data: dict) -> Any:  # pylint: disable=no-self-use
+        """
+        Parses a decoded reply from server.
+        """
+        if data["success"]:
+            return data["message"]
+        raise Exception(data["message"])
+
+    def decode_message(self, message: bytes) -> dict:  # pylint: disable=no-self-use
+        """
+        Decodes a message received from the server through UDP.
+        """
+        return decode(message)
+
+    def get_messages(self) -> List[bytes]:
         """
-        Returns messages received from server
+        Returns every message received from server since the last call,
+        oldest first, without waiting.
         """
-        messages = self._server_messages
-        self._server_messages = []
-        return set(messages)
+        return self._inbox.get_all()
 
-    def send_tcp_message(self, message: str) -> Any:
+    def receive(self, timeout: float = None) -> Optional[bytes]:
+        """
+        Returns the next message received from server, waiting up to
+        `timeout` seconds, or forever, for it. Returns `None` if none
+        arrived, or if the client was closed.
+        """
+        return self._inbox.get(timeout)
+
+    def messages(self) -> Iterator[bytes]:
+        """
+        Yields every message received from server, waiting for the next one,
+        until the client is closed.
+        """
+        return iter(self._inbox)
+
+    def open_session(self) -> socket.socket:
+        """
+        Opens the persistent TCP session, if it is not open yet. Must be
+        called with the session lock held.
+        """
+        if self._sock_tcp is None:
+            sock = socket.create_connection(self._server_tcp, self._timeout)
+            sock.settimeout(None)
+            sock.sendall(SESSION_MAGIC)
+            SessionThread(sock, self).start()
+            self._sock_tcp = sock
+        return self._sock_tcp
+
+    def close_session(self, sock: socket.socket, error: Exception):
+        """
+        Closes a TCP session and fails every request still waiting on it.
+        """
+        with self._session_lock:
+            if self._sock_tcp is sock:
+                self._sock_tcp = None
+            pending = self._pending
+            self._pending = {}
+        sock.close()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def resolve_request(self, data: dict):
+        """
+        Delivers a reply to the request waiting for it.
+        """
+        with self._session_lock:
+            future = self._pending.pop(data.get("request_id"), None)
+        if future is None:
+            log("Received reply for unknown request: {}", "warning", data)
+            return
+        try:
+            future.set_result(self.parse_reply(data))
+        except Exception as exc:  # pylint: disable=broad-except
+            future.set_exception(exc)
+
+    def request(self, message: Union[str, dict]) -> Future:
+        """
+        Sends a request through the persistent TCP session without waiting
+        for the reply. The returned future resolves to the parsed response.
+        """
+        if isinstance(message, str):
+            message = JSON.decode(message.encode())
+        future = Future()
+        with self._session_lock:
+            sock = self.open_session()
+            request_id = next(self._request_ids)
+            self._pending[request_id] = future
+            try:
+                sock.sendall(encode_frame(
+                    {**message, "request_id": request_id}, self._codec))
+            except OSError:
+                self._pending.pop(request_id, None)
+                raise
+        return future
+
+    def send_tcp_message(self, message: Union[str, dict]) -> Any:
         """
         Sends a TCP message, parses the response and returns it.
         """
-        self._sock_tcp = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
-        self._sock_tcp.connect(self._server_tcp)
-        self._sock_tcp.send(message.encode())
-        data = self._sock_tcp.recv(1024)
-        self._sock_tcp.close()
+        if self._persistent:
+            return self.request(message).result(self._timeout)
+        if isinstance(message, dict):
+            message = JSON.encode(message)
+        else:
+            message = message.encode()
+        sock = socket.create_connection(self._server_tcp, self._timeout)
+        try:
+            sock.sendall(message)
+            # The server closes the connection right after replying
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b"".join(chunks)
+        finally:
+            sock.close()
         response = self.parse_data(data)
         return response
 
-    def send_udp_message(self, message: str) -> None:
+    def close(self):
+        """
+        Closes the TCP session and stops listening for server messages.
+        """
+        with self._session_lock:
+            sock = self._sock_tcp
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._keepalive is not None:
+            self._keepalive.stop()
+        if self._retransmitter is not None:
+            self._retransmitter.stop()
+        self._server_listener.stop()
+        self._inbox.close()
+
+    def send_udp_message(self, message: Union[str, bytes, dict]) -> None:
         """
         Sends an UDP message.
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(message.encode(), self._server_udp)
+        if isinstance(message, dict):
+            if self._token is not None:
+                message = {**message, "token": self._token}
+            message = self._codec.encode(message)
+        elif isinstance(message, str):
+            message = message.encode()
+        self._server_listener.sendto(message, self._server_udp)
+
+    def ping(self):
+        """
+        Tells the server that this client is still there.
+        """
+        message = {
+            "action": "ping",
+            "identifier": self._identifier,
+        }
+        self.send_udp_message(message)
+
+    def send_reliable(self, message: dict) -> None:
+        """
+        Sends an UDP message through the reliable channel of its room.
+        """
+        if not self._reliable:
+            raise ValueError("The server did not agree to reliable channels")
+        codec = self._codec
+        message = {**message, "token": self._token}
+        data = self._peer.send(
+            message["room_id"],
+            lambda epoch, seq: codec.encode({**message, "epoch": epoch, "seq": seq}),
+        )
+        if data is not None:
+            self.send_udp_message(data)
 
-    def send_all(self, message: str):
+    def send_all(self, message: str, reliable: bool = False):
         """
-        Sends a message to all players in the room.
+        Sends a message to all players in the room, reliably if asked to.
         """
-        message = json.dumps({
+        message = {
             "action": "send",
             "payload": {"message": message},
             "room_id": self._room_id,
             "identifier": self._identifier,
-        })
-        self.send_udp_message(message)
+        }
+        if reliable:
+            self.send_reliable(message)
+        else:
+            self.send_udp_message(message)
 
-    def send_to(self, recipients: List[str], message: str):
+    def send_to(self, recipients: List[str], message: str, reliable: bool = False):
         """
-        Sends a message to a list of players.
+        Sends a message to a list of players, reliably if asked to.
         """
-        message = json.dumps({
+        message = {
             "action": "sendto",
             "payload": {"message": message, "recipients": recipients},
             "room_id": self._room_id,
             "identifier": self._identifier,
-        })
-        self.send_udp_message(message)
+        }
+        if reliable:
+            self.send_reliable(message)
+        else:
+            self.send_udp_message(message)
 
-    def create_room(self, room_name: str = None):
+    def create_room(self, room_name: str = None, tick_rate: int = 0):
         """
-        Creates a new room in the server.
+        Creates a new room in the server. A room with a tick rate, in ticks
+        per second, sends the messages of each tick together.
         """
-        message = json.dumps({
+        message = {
             "action": "create",
-            "payload": room_name,
+            "payload": {"name": room_name, "tick_rate": tick_rate} if tick_rate else room_name,
             "identifier": self._identifier,
-        })
+        }
         response = self.send_tcp_message(message)
         self._room_id = response
+        self._snapshots.reset()
+        self.ping()
 
     def join_room(self, room_id):
         """
         Joins an existing room in the server.
         """
-        message = json.dumps({
+        message = {
             "action": "join",
             "payload": room_id,
             "identifier": self._identifier,
-        })
+        }
         response = self.send_tcp_message(message)
         self._room_id = response
+        self._snapshots.reset()
+        self.ping()
 
     def autojoin(self):
         """
         Join any valid room.
         """
-        message = json.dumps({
+        message = {
             "action": "autojoin",
             "identifier": self._identifier,
-        })
+        }
         response = self.send_tcp_message(message)
         self._room_id = response
+        self._snapshots.reset()
+        self.ping()
 
     def leave_room(self):
         """
         Leave the current room.
         """
-        message = json.dumps({
+        message = {
             "action": "leave",
             "room_id": self._room_id,
             "identifier": self._identifier,
-        })
+        }
         self.send_tcp_message(message)
+        self._peer.forget(message["room_id"])
+        self._snapshots.reset()
+
+    def start_game(self, rules: str = "eights", **options) -> dict:
+        """
+        Starts a game between the players of the room, with the given rules
+        and options, and returns the view of the game of this client. Its
+        hand is the bits of a `card_game_server.cards.CardSet`.
+        """
+        message = {
+            "action": "start_game",
+            "payload": {"rules": rules, **options},
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        }
+        response = self.send_tcp_message(message)
+        self.apply_game(response)
+        return response
+
+    def play(self, move: Any) -> dict:
+        """
+        Makes a move in the game of the room, and returns the view of the
+        game of this client. Raises if the rules forbid the move.
+        """
+        message = {
+            "action": "play",
+            "payload": move,
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        }
+        response = self.send_tcp_message(message)
+        self.apply_game(response)
+        return response
+
+    def get_game(self) -> dict:
+        """
+        Gets the view of the game of the room of this client.
+        """
+        message = {
+            "action": "get_game",
+            "room_id": self._room_id,
+            "identifier": self._identifier,
+        }
+        response = self.send_tcp_message(message)
+        self.apply_game(response)
+        return response
 
     def get_rooms(self) -> List[dict]:
         """
         Gets the list of existing rooms in the server.
         """
-        message = json.dumps({
+        message = {
             "action": "get_rooms",
             "identifier": self._identifier,
-        })
+        }
         response = self.send_tcp_message(message)
         return response
 
+    def subscribe_lobby(self) -> List[dict]:
+        """
+        Subscribes to the lobby and returns the rooms of the server. From
+        then on, `lobby_rooms` is kept up to date by the server.
+        """
+        message = {
+            "action": "subscribe_lobby",
+            "identifier": self._identifier,
+        }
+        response = self.send_tcp_message(message)
+        with self._lobby_lock:
+            self._lobby_seq = response["seq"]
+            self._lobby_rooms = {room["id"]: dict(room) for room in response["rooms"]}
+        return response["rooms"]
+
+    def unsubscribe_lobby(self):
+        """
+        Stops the lobby subscription.
+        """
+        message = {
+            "action": "unsubscribe_lobby",
+            "identifier": self._identifier,
+        }
+        self.send_tcp_message(message)
+        with self._lobby_lock:
+            self._lobby_seq = None
+            self._lobby_rooms = {}
+
+    def get_rooms_page(  # pylint: disable=too-many-arguments
+        self,
+        cursor: str = None,
+        limit: int = 50,
+        sort: str = "created",
+        open_only: bool = False,
+        prefix: str = None,
+        capacity: int = None,
+    ) -> dict:
+        """
+        Gets a page of the existing rooms in the server, optionally filtered.
+        The `next` of the reply is the cursor of the next page, or `None` on
+        the last one.
+        """
+        query = {"limit": limit, "sort": sort, "open": open_only}
+        if cursor is not None:
+            query["cursor"] = cursor
+        if prefix is not None:
+            query["prefix"] = prefix
+        if capacity is not None:
+            query["capacity"] = capacity
+        message = {
+            "action": "get_rooms",
+            "payload": query,
+            "identifier": self._identifier,
+        }
+        return self.send_tcp_message(message)
+
     def register(self):
         """
         Register the client to server and get unique identifier.
         """
-        message = json.dumps({
+        message = {
             "action": "register",
-            "payload": self._client_udp[1]
-        })
+            "payload": {
+                "codecs": [self._preferred_codec],
+                "batching": True,
+            },
+        }
+        if self._reliable_requested:
+            message["payload"]["reliable"] = True
         response = self.send_tcp_message(message)
-        self._identifier = response
+        self._identifier = response["identifier"]
+        self._codec = get_codec(response["codec"])
+        self._reliable = bool(response.get("reliable"))
+        self._batching = bool(response.get("batching"))
+        self._token = response["token"]
+        self.ping()
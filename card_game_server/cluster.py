@@ -0,0 +1,731 @@
+"""
+Multi-process sharded server.
+
+Every worker process owns one shard of the rooms, runs its own asyncio engine
+and shares the public TCP and UDP ports with the other workers through
+`SO_REUSEPORT`, so the kernel spreads connections and datagrams among them.
+Each identifier generated by a worker encodes its shard (see
+`card_game_server.models.identifiers`), which is what requests are routed by:
+
+- `register` is always handled by the worker that received it, which becomes
+  the home shard of the new player.
+- A request from a player the worker does not know is forwarded to the home
+  shard of the player.
+- `join` and `leave` are forwarded to the shard of the room, along with the
+  player, which is mirrored ("adopted") there. Datagrams for a room are
+  forwarded to the shard of the room as well, which delivers them.
+- `create` always creates the room on the worker that received it.
+- Keep-alive pings are forwarded to the home shard of the player, which is
+  the only one tracking its liveness. Other requests and datagrams handled
+  elsewhere still show the player is alive: they are reported to its home
+  shard in batches, once per liveness tick. When the home shard evicts the
+  player, it tells every other shard to drop its mirror of the player as
+  well.
+- `get_rooms`, `subscribe_lobby` and `autojoin` are answered from the
+  summaries that every worker broadcasts about its own rooms whenever they
+  change. Lobby deltas for the rooms of other shards are found by comparing
+  their successive summaries. A summary may
+  be slightly outdated, so an autojoin that fails on a remote shard falls back
+  to the local one.
+
+Rooms never migrate between shards, and workers only talk to each other
+through unix sockets, using the same framing as TCP sessions.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+from itertools import count
+from typing import Any, Awaitable, Dict, List, Optional, Set, Tuple, Union
+
+from card_game_server.async_server import AsyncServer
+from card_game_server.codec import BINARY, get_codec
+from card_game_server.exceptions import ProtocolError
+from card_game_server.game import GAME_ACTIONS
+from card_game_server.handler import Handler, make_reply
+from card_game_server.journal import (
+    JOURNAL_INTERVAL,
+    SNAPSHOT_INTERVAL,
+    Journal,
+    JournalWriter,
+)
+from card_game_server.listing import RoomListing
+from card_game_server.liveness import Liveness, Reaper
+from card_game_server.lobby import LOBBY_INTERVAL, Lobby, LobbyPublisher
+from card_game_server.logger import log
+from card_game_server.metrics import MetricsServer
+from card_game_server.models.identifiers import MAX_SHARDS, shard_of
+from card_game_server.models.message import Message
+from card_game_server.models.player import Player
+from card_game_server.models.rooms import Rooms
+from card_game_server.protocol import FrameDecoder, encode_frame
+from card_game_server.reclaimer import (
+    RECLAIM_BATCH,
+    RECLAIM_GRACE,
+    RECLAIM_INTERVAL,
+    Reclaimer,
+)
+from card_game_server.reliable import Retransmitter
+from card_game_server.ticks import TickScheduler
+
+# Seconds between two checks for changes in the summary of a shard
+SUMMARY_INTERVAL = 0.5
+
+# Seconds to wait for the reply to a forwarded request
+FORWARD_TIMEOUT = 5
+
+# Attempts, and seconds between them, to connect to another worker
+CONNECT_ATTEMPTS = 50
+CONNECT_DELAY = 0.1
+
+# Largest number of messages queued for a worker we are not connected to yet
+MAX_BACKLOG = 10000
+
+
+async def _resolved(value: Any) -> Any:
+    return value
+
+
+class ShardRouter:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        rooms: Rooms,
+        n_shards: int,
+        ipc_dir: str,
+    ):
+        """
+        Routes requests and datagrams between the workers of a sharded
+        server. Runs in the event loop of the worker's `AsyncServer`.
+        """
+        self._rooms: Rooms = rooms
+        self._shard: int = rooms.shard
+        self._n_shards: int = n_shards
+        self._ipc_dir: str = ipc_dir
+        self._server: asyncio.AbstractServer = None
+        self._peers: Dict[int, asyncio.StreamWriter] = {}
+        self._connecting: Dict[int, asyncio.Task] = {}
+        self._backlogs: Dict[int, List[bytes]] = {}
+        self._pending: Dict[int, Tuple[int, asyncio.Future]] = {}
+        self._request_ids = count(1)
+        self._summaries: Dict[int, dict] = {}
+        # Bumped whenever the summary of another shard arrives
+        self._summaries_version: int = 0
+        # Lists the rooms of this shard followed by those of the other shards
+        self._listing: RoomListing = RoomListing(
+            lambda: (self._rooms.version, self._summaries_version), self._summarize_all)
+        # Rooms of the other shards, by identifier
+        self._remote_rooms: Dict[str, dict] = {}
+        self._lobby: Lobby = Lobby(
+            rooms.fanout,
+            self._summarize_room,
+            self._listing.rooms,
+            lambda player_id: rooms.get_player(player_id) is not None,
+        )
+        rooms.observe(self._lobby.mark)
+        self._handler: Handler = Handler(rooms, self._listing, self._lobby)
+        self._summary: dict = None
+        self._summary_version: int = 0
+        self._sent_versions: Dict[int, int] = {}
+        # Players of other shards heard from since the last batch, by shard
+        self._touches: Dict[int, Set[str]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._loop: asyncio.AbstractEventLoop = None
+
+    @property
+    def shard(self) -> int:
+        return self._shard
+
+    @property
+    def lobby(self) -> Lobby:
+        return self._lobby
+
+    def get_path(self, shard: int) -> str:
+        """
+        Get the path of the unix socket of a worker.
+        """
+        return os.path.join(self._ipc_dir, f"shard-{shard}.sock")
+
+    def get_target(self, identifier: str) -> Optional[int]:
+        """
+        Get the shard an identifier belongs to, or `None` if it belongs to
+        this shard or to no shard at all.
+        """
+        shard = shard_of(identifier)
+        if shard is None or shard == self._shard or shard >= self._n_shards:
+            return None
+        return shard
+
+    def _spawn(self, coroutine: Awaitable) -> asyncio.Task:
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def start(self):
+        """
+        Starts listening for other workers and broadcasting summaries.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_unix_server(
+            self._serve_peer, path=self.get_path(self._shard))
+        self._spawn(self._broadcast_summaries())
+        if self._rooms.liveness is not None:
+            self._spawn(self._send_touches())
+
+    async def stop(self):
+        """
+        Closes every connection with other workers.
+        """
+        for task in list(self._tasks) + list(self._connecting.values()):
+            task.cancel()
+        for writer in self._peers.values():
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    #
+    # Routing
+    #
+
+    def route_request(
+        self,
+        address: Tuple[str, int],
+        message: Message,
+    ) -> Optional[Awaitable[dict]]:
+        """
+        Routes a TCP request. Returns `None` if it must be handled by this
+        worker, or an awaitable of its reply otherwise.
+        """
+        if message.action == "register" or message.identifier is None:
+            return None
+
+        player = self._rooms.get_player(message.identifier)
+        if player is None:
+            home = self.get_target(message.identifier)
+            if home is None:
+                return None
+            return self._forward(home, address, message.data)
+        # Requests forwarded to other shards still show the player is alive
+        self._touch(message.identifier)
+
+        if message.action == "join" and message.payload is not None:
+            target = self.get_target(message.payload)
+        elif message.action == "leave" or message.action in GAME_ACTIONS:
+            target = self.get_target(message.room_id)
+        elif message.action == "autojoin":
+            return self._autojoin(address, message, player)
+        elif message.action in ("get_rooms", "subscribe_lobby", "unsubscribe_lobby"):
+            # Answered from the listing and lobby covering every shard
+            return _resolved(self._handler.handle_request(address, message))
+        else:
+            target = None
+        if target is None:
+            return None
+        return self._forward(target, address, message.data, player)
+
+    def route_datagram(self, message: Message, address: Tuple[str, int]) -> bool:
+        """
+        Forwards a datagram to the shard of its room, or to the home shard
+        of its player for pings. Returns whether it was forwarded. The
+        address it came from goes along, so that the shard handling it
+        learns where to reach its player.
+        """
+        if message.action == "ping":
+            target = self.get_target(message.identifier)
+        else:
+            self._touch(message.identifier)
+            target = self.get_target(message.room_id)
+        if target is None:
+            return False
+        self._post(target, {
+            "type": "datagram",
+            "data": message.data,
+            "address": list(address) if address else None,
+        })
+        return True
+
+    def _touch(self, player_id: str) -> None:
+        """
+        Records that a player was heard from, on its home shard.
+        """
+        if self._rooms.liveness is None or not isinstance(player_id, str):
+            return
+        home = self.get_target(player_id)
+        if home is None:
+            self._rooms.touch(player_id)
+        else:
+            self._touches.setdefault(home, set()).add(player_id)
+
+    async def _send_touches(self):
+        """
+        Tells the home shard of every player of another shard heard from
+        that it is still alive, once per liveness tick.
+        """
+        while True:
+            await asyncio.sleep(self._rooms.liveness.tick)
+            touches, self._touches = self._touches, {}
+            for shard, player_ids in touches.items():
+                self._post(shard, {"type": "touch", "identifiers": list(player_ids)})
+
+    def evicted(self, player_ids: List[str]) -> None:
+        """
+        Tells every other shard that players of this shard were evicted. May
+        be called from any thread.
+        """
+        if self._loop is None or self._loop.is_closed():
+            return
+        frame = {"type": "evict", "identifiers": player_ids}
+        for shard in range(self._n_shards):
+            if shard != self._shard:
+                self._loop.call_soon_threadsafe(self._post, shard, frame)
+
+    def _summarize_all(self) -> List[dict]:
+        rooms = self._rooms.summarize()
+        for shard in sorted(self._summaries):
+            rooms.extend(self._summaries[shard]["rooms"])
+        return rooms
+
+    def _summarize_room(self, room_id: str) -> Optional[dict]:
+        summary = self._rooms.summarize_room(room_id)
+        if summary is None:
+            summary = self._remote_rooms.get(room_id)
+        return summary
+
+    def _update_summary(self, summary: dict) -> None:
+        """
+        Stores the summary of another shard, and tells the lobby about every
+        room of that shard that changed since its previous summary.
+        """
+        previous = self._summaries.get(summary["shard"])
+        before = {} if previous is None else {room["id"]: room for room in previous["rooms"]}
+        after = {room["id"]: room for room in summary["rooms"]}
+        self._summaries[summary["shard"]] = summary
+        self._summaries_version += 1
+        # Replaced at once, since the lobby reads it from another thread
+        remote_rooms = {
+            room_id: room for room_id, room in self._remote_rooms.items()
+            if room_id not in before
+        }
+        remote_rooms.update(after)
+        self._remote_rooms = remote_rooms
+        for room_id in before.keys() | after.keys():
+            if before.get(room_id) != after.get(room_id):
+                self._lobby.mark(room_id)
+
+    async def _autojoin(
+        self,
+        address: Tuple[str, int],
+        message: Message,
+        player: Player,
+    ) -> dict:
+        """
+        Joins the best open room among every shard according to the autojoin
+        policy, preferring local rooms on ties.
+        """
+        best_id, best_seats = None, None
+        room = self._rooms.get_open_room()
+        if room is not None:
+            best_id, best_seats = room.identifier, room.capacity - room.n_players
+        spread = self._rooms.autojoin_policy == "spread"
+        for summary in self._summaries.values():
+            candidate = summary["open"]
+            if candidate is None:
+                continue
+            seats = candidate["free_seats"]
+            if best_seats is None or (seats > best_seats if spread else seats < best_seats):
+                best_id, best_seats = candidate["id"], seats
+
+        target = self.get_target(best_id)
+        if target is not None:
+            reply = await self._forward(target, address, {
+                "action": "join",
+                "identifier": message.identifier,
+                "payload": best_id,
+                "request_id": message.request_id,
+            }, player)
+            if reply["success"]:
+                return reply
+            log("Remote autojoin of {} failed, joining a local room", "debug", best_id,
+                player=message.identifier)
+        return self._handler.handle_request(address, message)
+
+    async def _forward(
+        self,
+        shard: int,
+        address: Tuple[str, int],
+        data: dict,
+        player: Player = None,
+    ) -> dict:
+        """
+        Forwards a request to another shard and waits for its reply. When a
+        player is given, the other shard adopts it and handles the request
+        without routing it any further.
+        """
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (shard, future)
+        request = {
+            "type": "request",
+            "id": request_id,
+            "address": list(address) if address else None,
+            "data": data,
+            "player": None,
+        }
+        if player is not None:
+            request["player"] = {
+                "identifier": player.identifier,
+                "address": list(player.address),
+                "udp_port": None if player.requires_token else player.udp_address[1],
+                "udp_address": list(player.udp_address) if player.udp_address else None,
+                "codec": player.codec.name,
+                "reliable": player.reliable,
+                "token": player.token,
+                "batching": player.batching,
+            }
+        self._post(shard, request)
+        try:
+            return await asyncio.wait_for(future, FORWARD_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            log("Shard {} did not reply to request {}", "error", shard, data)
+            return make_reply(False, "Shard unavailable", data.get("request_id"))
+        finally:
+            self._pending.pop(request_id, None)
+
+    #
+    # Connections between workers
+    #
+
+    def _post(self, shard: int, data: dict) -> None:
+        """
+        Sends a message to another shard, connecting to it first if needed.
+        Messages to the same shard are always sent in order.
+        """
+        frame = encode_frame(data, BINARY)
+        writer = self._peers.get(shard)
+        if writer is not None and not writer.is_closing():
+            writer.write(frame)
+            return
+        backlog = self._backlogs.setdefault(shard, [])
+        if len(backlog) >= MAX_BACKLOG:
+            log("Backlog for shard {} is full, dropping message", "error", shard)
+            return
+        backlog.append(frame)
+        if shard not in self._connecting:
+            self._connecting[shard] = asyncio.ensure_future(self._connect(shard))
+
+    async def _connect(self, shard: int):
+        """
+        Connects to another shard, retrying while it starts up, then flushes
+        everything queued for it.
+        """
+        try:
+            for _ in range(CONNECT_ATTEMPTS):
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.get_path(shard))
+                    break
+                except OSError:
+                    await asyncio.sleep(CONNECT_DELAY)
+            else:
+                log("Could not connect to shard {}", "error", shard)
+                self._backlogs.pop(shard, None)
+                self._fail_pending(shard)
+                return
+            self._peers[shard] = writer
+            for frame in self._backlogs.pop(shard, []):
+                writer.write(frame)
+            self._spawn(self._serve_peer(reader, writer, shard))
+        finally:
+            self._connecting.pop(shard, None)
+
+    def _fail_pending(self, shard: int) -> None:
+        for target, future in list(self._pending.values()):
+            if target == shard and not future.done():
+                future.set_exception(ConnectionError(f"Lost connection to shard {shard}"))
+
+    async def _serve_peer(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        shard: int = None,
+    ):
+        """
+        Reads every message another worker sends through a connection.
+        """
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame, _ in decoder.feed(data):
+                    self._dispatch(frame, writer)
+        except (ConnectionError, ProtocolError) as exc:
+            log("Connection with shard {} lost: {!r}", "error", shard, exc)
+        except asyncio.CancelledError:
+            # The worker is stopping, which is not an error for the server
+            # this connection was accepted by
+            pass
+        finally:
+            if shard is not None:
+                self._peers.pop(shard, None)
+                self._sent_versions.pop(shard, None)
+                self._fail_pending(shard)
+            writer.close()
+
+    def _dispatch(self, frame: dict, writer: asyncio.StreamWriter) -> None:
+        kind = frame.get("type")
+        if kind == "reply":
+            pending = self._pending.get(frame["id"])
+            if pending is not None and not pending[1].done():
+                pending[1].set_result(frame["reply"])
+        elif kind == "request":
+            self._spawn(self._handle_peer_request(frame, writer))
+        elif kind == "datagram":
+            try:
+                address = frame.get("address")
+                self._handler.handle_udp(
+                    Message(frame["data"]), tuple(address) if address else None)
+            except Exception as exc:  # pylint: disable=broad-except
+                log("Failed to deliver forwarded datagram: {!r}", "error", exc)
+        elif kind == "summary":
+            self._update_summary(frame)
+        elif kind == "touch":
+            for player_id in frame["identifiers"]:
+                self._rooms.touch(player_id)
+        elif kind == "evict":
+            for player_id in frame["identifiers"]:
+                self._rooms.unregister(player_id)
+        else:
+            log("Unknown message from another shard: {}", "error", kind)
+
+    async def _handle_peer_request(self, frame: dict, writer: asyncio.StreamWriter):
+        address = tuple(frame["address"]) if frame["address"] else None
+        message = Message(frame["data"])
+        player = frame["player"]
+        routed = None
+        if player is not None:
+            self._rooms.adopt(Player(
+                tuple(player["address"]),
+                player["udp_port"],
+                get_codec(player["codec"]),
+                identifier=player["identifier"],
+                reliable=player.get("reliable", False),
+                token=player.get("token"),
+                batching=player.get("batching", False),
+                udp_address=tuple(player["udp_address"]) if player.get("udp_address") else None,
+            ))
+        else:
+            routed = self.route_request(address, message)
+        if routed is not None:
+            reply = await routed
+        else:
+            reply = self._handler.handle_request(address, message)
+        if not writer.is_closing():
+            writer.write(encode_frame({"type": "reply", "id": frame["id"], "reply": reply}, BINARY))
+
+    #
+    # Summaries
+    #
+
+    def get_summary(self) -> dict:
+        """
+        Summarizes the rooms of this shard for the other ones.
+        """
+        rooms = self._rooms.summarize()
+        room = self._rooms.get_open_room()
+        return {
+            "type": "summary",
+            "shard": self._shard,
+            "rooms": rooms,
+            "open": None if room is None else {
+                "id": room.identifier,
+                "free_seats": room.capacity - room.n_players,
+            },
+        }
+
+    async def _broadcast_summaries(self):
+        """
+        Sends the summary of this shard to every other shard whenever it
+        changes.
+        """
+        while True:
+            summary = self.get_summary()
+            if summary != self._summary:
+                self._summary = summary
+                self._summary_version += 1
+            for shard in range(self._n_shards):
+                if shard == self._shard:
+                    continue
+                if self._sent_versions.get(shard) != self._summary_version:
+                    self._sent_versions[shard] = self._summary_version
+                    self._post(shard, self._summary)
+            await asyncio.sleep(SUMMARY_INTERVAL)
+
+
+def _run_worker(  # pylint: disable=too-many-arguments
+    shard: int,
+    n_workers: int,
+    tcp_port: int,
+    udp_port: int,
+    capacity: int,
+    autojoin_policy: str,
+    ipc_dir: str,
+    stopped: Any,
+    metrics_port: int = 0,
+    idle_timeout: float = 0,
+    liveness_tick: float = 1.0,
+    reclaim: Tuple[float, float, int] = (RECLAIM_INTERVAL, RECLAIM_GRACE, RECLAIM_BATCH),
+    lobby_interval: float = LOBBY_INTERVAL,
+    journal: Tuple[str, str, float, float] = None,
+):
+    """
+    Entry point of a worker process. `reclaim` holds the interval, grace
+    period and batch size of the reclaimer of empty rooms, and `journal`, if
+    any, the directory, fsync policy, write interval and snapshot interval of
+    the journals of the shards, each kept in its own subdirectory.
+    """
+    liveness = Liveness(idle_timeout, liveness_tick) if idle_timeout else None
+    journal_dir, journal_fsync, journal_interval, snapshot_interval = journal or ("", "", 0, 0)
+    rooms = Rooms(
+        capacity, autojoin_policy, shard=shard, liveness=liveness,
+        journal=Journal(os.path.join(journal_dir, f"shard-{shard}"), journal_fsync)
+        if journal_dir else None)
+    router = ShardRouter(rooms, n_workers, ipc_dir)
+    servers = [AsyncServer(tcp_port, udp_port, rooms, reuse_port=True, router=router)]
+    if liveness is not None:
+        servers.append(Reaper(rooms, router.evicted))
+    if reclaim[0]:
+        servers.append(Reclaimer(rooms, *reclaim))
+    if lobby_interval:
+        servers.append(LobbyPublisher(router.lobby, lobby_interval))
+    servers.append(Retransmitter(rooms.reliable))
+    servers.append(TickScheduler(rooms.ticks))
+    if journal_dir:
+        servers.append(JournalWriter(rooms, journal_interval, snapshot_interval))
+    if metrics_port:
+        servers.append(MetricsServer(metrics_port + shard, rooms))
+    for server in servers:
+        server.start()
+    log("Worker {} serving shard {}", "debug", os.getpid(), shard)
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.stop()
+    for server in servers:
+        server.join()
+
+
+class Cluster:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        n_workers: int,
+        tcp_port: Union[str, int],
+        udp_port: Union[str, int],
+        capacity: int = 2,
+        autojoin_policy: str = "fill",
+        metrics_port: int = 0,
+        idle_timeout: float = 0,
+        liveness_tick: float = 1.0,
+        reclaim_interval: float = RECLAIM_INTERVAL,
+        reclaim_grace: float = RECLAIM_GRACE,
+        reclaim_batch: int = RECLAIM_BATCH,
+        lobby_interval: float = LOBBY_INTERVAL,
+        journal_dir: str = None,
+        journal_fsync: str = "batch",
+        journal_interval: float = JOURNAL_INTERVAL,
+        snapshot_interval: float = SNAPSHOT_INTERVAL,
+    ):
+        """
+        Runs the server as several worker processes, each owning a shard of
+        the rooms. Has the same `start`, `stop` and `join` methods as the
+        single process servers.
+
+        When a metrics port is given, each worker serves its metrics on that
+        port plus its shard. When an idle timeout is given, each worker
+        evicts the players registered with it once they have been silent for
+        that many seconds. Each worker also reclaims its own empty rooms,
+        unless the reclaim interval is 0, and publishes lobby deltas every
+        lobby interval, unless it is 0.
+
+        When a journal directory is given, each worker journals its shard in
+        a subdirectory of it, see `card_game_server.journal`, so the server
+        must be restarted with the same number of workers to recover it.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Multiple workers require SO_REUSEPORT support")
+        if not 1 <= n_workers <= MAX_SHARDS:
+            raise ValueError(f"Invalid number of workers: {n_workers}")
+        self._n_workers: int = n_workers
+        self._tcp_port: int = int(tcp_port)
+        self._udp_port: int = int(udp_port)
+        self._capacity: int = capacity
+        self._autojoin_policy: str = autojoin_policy
+        self._metrics_port: int = metrics_port
+        self._idle_timeout: float = idle_timeout
+        self._liveness_tick: float = liveness_tick
+        self._reclaim: Tuple[float, float, int] = (
+            reclaim_interval, reclaim_grace, reclaim_batch)
+        self._lobby_interval: float = lobby_interval
+        self._journal: Optional[Tuple[str, str, float, float]] = (
+            (journal_dir, journal_fsync, journal_interval, snapshot_interval)
+            if journal_dir else None)
+        self._context = multiprocessing.get_context("fork")
+        self._stopped = self._context.Event()
+        self._ipc_dir: str = None
+        self._workers: List[multiprocessing.Process] = []
+
+    @property
+    def workers(self) -> List[multiprocessing.Process]:
+        return self._workers
+
+    def start(self):
+        """
+        Forks every worker.
+        """
+        self._ipc_dir = tempfile.mkdtemp(prefix="card-game-server-")
+        for shard in range(self._n_workers):
+            worker = self._context.Process(
+                target=_run_worker,
+                args=(
+                    shard,
+                    self._n_workers,
+                    self._tcp_port,
+                    self._udp_port,
+                    self._capacity,
+                    self._autojoin_policy,
+                    self._ipc_dir,
+                    self._stopped,
+                    self._metrics_port,
+                    self._idle_timeout,
+                    self._liveness_tick,
+                    self._reclaim,
+                    self._lobby_interval,
+                    self._journal,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """
+        Asks every worker to stop.
+        """
+        self._stopped.set()
+
+    def join(self):
+        """
+        Waits for every worker to stop.
+        """
+        for worker in self._workers:
+            worker.join()
+        if self._ipc_dir is not None:
+            shutil.rmtree(self._ipc_dir, ignore_errors=True)
@@ -0,0 +1,400 @@
+"""
+Codecs for the messages exchanged between clients and the server.
+
+Every codec turns plain Python values (dicts, lists, strings, numbers,
+booleans and `None`) into bytes and back. The codec used by a player is
+negotiated at `register` time. Decoding never needs to know it in advance,
+since binary messages start with a byte that JSON never starts with.
+"""
+
+import json
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+from card_game_server.exceptions import CodecError
+
+# Strings that show up in almost every message, encoded by the binary codec
+# as a single byte. Only ever append to this list: the position of each
+# string is its code on the wire.
+SYMBOLS: List[str] = [
+    # Keys
+    "action",
+    "payload",
+    "identifier",
+    "room_id",
+    "request_id",
+    "success",
+    "message",
+    "recipients",
+    "id",
+    "name",
+    "n_players",
+    "capacity",
+    "udp_port",
+    "codecs",
+    "codec",
+    # Actions
+    "register",
+    "join",
+    "autojoin",
+    "create",
+    "leave",
+    "get_rooms",
+    "send",
+    "sendto",
+    # Codecs
+    "json",
+    "binary",
+    # Room listing
+    "rooms",
+    "next",
+    "version",
+    "limit",
+    "cursor",
+    # Lobby
+    "subscribe_lobby",
+    "unsubscribe_lobby",
+    "lobby",
+    "seq",
+    "created",
+    "removed",
+    "changed",
+    "resync",
+    # UDP sessions
+    "token",
+    # Ticks
+    "batch",
+    "batching",
+    "tick_rate",
+    # Games
+    "start_game",
+    "play",
+    "get_game",
+    "game",
+    "rules",
+    "players",
+    "turn",
+    "hand",
+    "hands",
+    "deck",
+    "piles",
+    "top",
+    "size",
+    "state",
+    "winner",
+    "discard",
+    "draw",
+    "suit",
+    # Snapshots
+    "game_ack",
+    "base",
+]
+SYMBOL_CODES: Dict[str, int] = {symbol: code for code, symbol in enumerate(SYMBOLS)}
+
+BINARY_MAGIC = 0xB1
+
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_BYTES = 6
+_LIST = 7
+_DICT = 8
+_UUID = 9
+_SYMBOL = 10
+
+_DOUBLE = struct.Struct(">d")
+
+
+class Encoded:
+    """
+    Wraps a value that is sent over and over again, such as a cached room
+    listing, so that it is only encoded once per codec however many
+    messages it is part of.
+    """
+
+    __slots__ = ("value", "_encoded")
+
+    def __init__(self, value: Any):
+        self.value: Any = value
+        self._encoded: Dict[str, bytes] = {}
+
+    def encode(self, codec: 'Codec') -> bytes:
+        """
+        Get the encoding of the value as part of a message of a codec.
+        """
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            encoded = self._encoded[codec.name] = codec.encode_value(self.value)
+        return encoded
+
+
+def _unwrap(value: Any) -> Any:
+    if isinstance(value, Encoded):
+        return value.value
+    raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+
+class Codec:
+    """
+    Base class for message codecs.
+    """
+
+    name: str = None
+
+    def encode(self, data: Any) -> bytes:
+        """
+        Encodes a message.
+        """
+        raise NotImplementedError()
+
+    def encode_value(self, data: Any) -> bytes:
+        """
+        Encodes a value as part of a message.
+        """
+        raise NotImplementedError()
+
+    def decode(self, data: bytes) -> Any:
+        """
+        Decodes a message.
+        """
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    """
+    Plain JSON, understood by every client.
+    """
+
+    name = "json"
+
+    def encode(self, data: Any) -> bytes:
+        if isinstance(data, dict) and any(isinstance(item, Encoded) for item in data.values()):
+            # Splices the values that are already encoded, which is what
+            # replies carrying a cached listing look like. They may be
+            # large, so they are only copied once
+            parts = []
+            for key, item in data.items():
+                parts.append(b", " if parts else b"{")
+                parts.append(json.dumps(key).encode() + b": ")
+                parts.append(item.encode(self) if isinstance(item, Encoded)
+                             else self.encode_value(item))
+            parts.append(b"}")
+            return b"".join(parts)
+        return self.encode_value(data)
+
+    def encode_value(self, data: Any) -> bytes:
+        return json.dumps(data, default=_unwrap).encode()
+
+    def decode(self, data: bytes) -> Any:
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError as exc:
+            raise CodecError("Malformed JSON message") from exc
+
+
+class BinaryCodec(Codec):
+    """
+    Compact tagged binary encoding. Well-known keys and actions take a
+    single byte, and UUID identifiers take 16 bytes instead of 36.
+    """
+
+    name = "binary"
+
+    def encode(self, data: Any) -> bytes:
+        out = bytearray((BINARY_MAGIC,))
+        _encode_value(data, out)
+        return bytes(out)
+
+    def encode_value(self, data: Any) -> bytes:
+        out = bytearray()
+        _encode_value(data, out)
+        return bytes(out)
+
+    def decode(self, data: bytes) -> Any:
+        if not data or data[0] != BINARY_MAGIC:
+            raise CodecError("Not a binary message")
+        try:
+            value, offset = _decode_value(memoryview(data), 1)
+        except (IndexError, TypeError, ValueError, struct.error) as exc:
+            raise CodecError("Malformed binary message") from exc
+        if offset != len(data):
+            raise CodecError("Trailing bytes after binary message")
+        return value
+
+
+def _encode_varint(value: int, out: bytearray):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(data: memoryview, offset: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _uuid_bytes(value: str) -> Optional[bytes]:
+    """
+    Returns the 16 bytes of a canonical UUID string, or `None` if the string
+    is not one.
+    """
+    if (len(value) != 36 or value[8] != '-' or value[13] != '-' or value[18] != '-'
+            or value[23] != '-' or not value.islower()):
+        return None
+    try:
+        return bytes.fromhex(value[:8] + value[9:13] + value[14:18] + value[19:23] + value[24:])
+    except ValueError:
+        return None
+
+
+def _uuid_str(data: bytes) -> str:
+    value = data.hex()
+    return f"{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}"
+
+
+def _encode_value(value: Any, out: bytearray):  # pylint: disable=too-many-branches
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, str):
+        code = SYMBOL_CODES.get(value)
+        if code is not None:
+            out.append(_SYMBOL)
+            out.append(code)
+            return
+        uuid = _uuid_bytes(value)
+        if uuid is not None:
+            out.append(_UUID)
+            out += uuid
+            return
+        encoded = value.encode()
+        out.append(_STR)
+        _encode_varint(len(encoded), out)
+        out += encoded
+    elif isinstance(value, int):
+        out.append(_INT)
+        _encode_varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _encode_varint(len(value), out)
+        for key, item in value.items():
+            _encode_value(key, out)
+            _encode_value(item, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        _encode_varint(len(value), out)
+        for item in value:
+            _encode_value(item, out)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(_BYTES)
+        _encode_varint(len(value), out)
+        out += value
+    elif isinstance(value, Encoded):
+        out += value.encode(BINARY)
+    else:
+        raise CodecError(f"Cannot encode value of type {type(value).__name__}")
+
+
+def _decode_value(data: memoryview, offset: int) -> Tuple[Any, int]:  # pylint: disable=too-many-return-statements
+    tag = data[offset]
+    offset += 1
+    if tag == _SYMBOL:
+        return SYMBOLS[data[offset]], offset + 1
+    if tag == _UUID:
+        return _uuid_str(bytes(data[offset:offset + 16])), offset + 16
+    if tag == _STR:
+        size, offset = _decode_varint(data, offset)
+        return str(data[offset:offset + size], 'utf-8'), offset + size
+    if tag == _INT:
+        value, offset = _decode_varint(data, offset)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+    if tag == _DICT:
+        size, offset = _decode_varint(data, offset)
+        result = {}
+        for _ in range(size):
+            key, offset = _decode_value(data, offset)
+            if not isinstance(key, str):
+                raise CodecError(f"Invalid key of type {type(key).__name__}")
+            result[key], offset = _decode_value(data, offset)
+        return result, offset
+    if tag == _LIST:
+        size, offset = _decode_varint(data, offset)
+        result = []
+        for _ in range(size):
+            item, offset = _decode_value(data, offset)
+            result.append(item)
+        return result, offset
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, offset)[0], offset + 8
+    if tag == _BYTES:
+        size, offset = _decode_varint(data, offset)
+        return bytes(data[offset:offset + size]), offset + size
+    raise CodecError(f"Unknown tag {tag}")
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+CODECS: Dict[str, Codec] = {
+    JSON.name: JSON,
+    BINARY.name: BINARY,
+}
+
+
+def get_codec(name: str) -> Codec:
+    """
+    Gets a codec by its name.
+    """
+    if name not in CODECS:
+        raise CodecError(f"Unknown codec {name}")
+    return CODECS[name]
+
+
+def negotiate(names: List[str]) -> Codec:
+    """
+    Picks the first codec of a client's preference list that the server
+    supports, falling back to JSON.
+    """
+    for name in names or []:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+def sniff(data: bytes) -> Codec:
+    """
+    Tells which codec a message was encoded with.
+    """
+    if data and data[0] == BINARY_MAGIC:
+        return BINARY
+    return JSON
+
+
+def decode(data: bytes) -> Any:
+    """
+    Decodes a message encoded with any known codec.
+    """
+    return sniff(data).decode(data)
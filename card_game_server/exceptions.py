@@ -32,6 +32,29 @@ class PlayerNotFoundError(Exception):
     """
 
 
+#
+# Game
+#
+
+
+class GameError(Exception):
+    """
+    Raised when a game cannot do what a player asked for.
+    """
+
+
+class GameNotFoundError(GameError):
+    """
+    Raised when a player asks for the game of a room that has none.
+    """
+
+
+class InvalidMoveError(GameError):
+    """
+    Raised when a move breaks the rules of the game.
+    """
+
+
 #
 # UdpServer
 #
@@ -41,3 +64,31 @@ class UdpServerFailedToSendError(Exception):
     """
     Raised when a message could not be sent.
     """
+
+
+#
+# Protocol
+#
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends data that does not follow the protocol.
+    """
+
+
+class CodecError(ProtocolError):
+    """
+    Raised when a message cannot be encoded or decoded.
+    """
+
+
+#
+# Journal
+#
+
+
+class JournalLockedError(Exception):
+    """
+    Raised when another server already uses the directory of a journal.
+    """
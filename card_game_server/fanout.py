@@ -0,0 +1,207 @@
+import asyncio
+import socket
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from card_game_server.codec import Codec
+from card_game_server.logger import log
+from card_game_server.metrics import METRICS
+from card_game_server.models.player import Player
+from card_game_server.ticks import BATCH_SENDER, MAX_BATCH_BYTES
+
+SendTo = Callable[[bytes, Tuple[str, int]], Any]
+
+
+class FanOut:
+
+    def __init__(self, sendto: SendTo = None):
+        """
+        Sends the same message to many players at once. The message is
+        encoded once per codec in use, and every datagram goes out through
+        the socket the server is already bound to.
+        """
+        self._sendto: SendTo = sendto
+        self._sock: socket.socket = None
+        self._loop: asyncio.AbstractEventLoop = None
+
+    def bind(self, sendto: SendTo, loop: asyncio.AbstractEventLoop = None) -> None:
+        """
+        Sets the function used to send datagrams, usually the `sendto` of the
+        server's bound UDP socket or transport. Asyncio transports are not
+        thread-safe, so when `loop` is given, messages sent from any other
+        thread are handed over to it.
+        """
+        self._sendto = sendto
+        self._loop = loop
+
+    def _get_sendto(self) -> SendTo:
+        """
+        Returns the bound `sendto`, falling back to a socket of our own that is
+        created once and reused when no server is bound.
+        """
+        if self._sendto is None:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sendto = self._sock.sendto
+        return self._sendto
+
+    def send(
+        self,
+        sender_id: str,
+        message: Any,
+        recipients: Iterable[Player],
+    ) -> int:
+        """
+        Sends a message from a player to every recipient and returns how many
+        datagrams were sent.
+        """
+        payload = {sender_id: message}
+        encoded: Dict[Codec, bytes] = {}
+        datagrams: List[Tuple[bytes, Tuple[str, int]]] = []
+        for player in recipients:
+            codec = player.codec
+            data = encoded.get(codec)
+            if data is None:
+                data = encoded[codec] = codec.encode(payload)
+            datagrams.append((data, player.udp_address))
+        return self.transmit(datagrams)
+
+    def send_batch(  # pylint: disable=too-many-locals
+        self,
+        messages: List[Tuple[str, Any, List[Player]]],
+        max_bytes: int = MAX_BATCH_BYTES,
+    ) -> int:
+        """
+        Sends messages held back during a tick, each given as its sender, its
+        message and its recipients, and returns how many datagrams were sent.
+        Every recipient gets its messages in order, packed into datagrams of
+        at most `max_bytes` if it accepts batches, see
+        `card_game_server.ticks`. Recipients getting the same messages share
+        their encoding.
+        """
+        # Messages of each recipient, in order
+        indexes: Dict[str, List[int]] = {}
+        players: Dict[str, Player] = {}
+        for index, (_, _, recipients) in enumerate(messages):
+            for player in recipients:
+                players[player.identifier] = player
+                indexes.setdefault(player.identifier, []).append(index)
+        encoded: Dict[Tuple[Codec, int], bytes] = {}
+        packed: Dict[Tuple[Codec, bool, Tuple[int, ...]], List[bytes]] = {}
+        datagrams: List[Tuple[bytes, Tuple[str, int]]] = []
+        for player_id, player_indexes in indexes.items():
+            player = players[player_id]
+            key = (player.codec, player.batching, tuple(player_indexes))
+            data = packed.get(key)
+            if data is None:
+                items = []
+                for index in player_indexes:
+                    item = encoded.get((player.codec, index))
+                    if item is None:
+                        sender_id, message, _ = messages[index]
+                        item = encoded[player.codec, index] = player.codec.encode(
+                            {sender_id: message})
+                    items.append((index, item))
+                if player.batching:
+                    data = self._pack(player.codec, messages, items, max_bytes)
+                else:
+                    data = [item for _, item in items]
+                packed[key] = data
+            datagrams.extend((datagram, player.udp_address) for datagram in data)
+        return self.transmit(datagrams)
+
+    @classmethod
+    def _pack(
+        cls,
+        codec: Codec,
+        messages: List[Tuple[str, Any, List[Player]]],
+        items: List[Tuple[int, bytes]],
+        max_bytes: int,
+    ) -> List[bytes]:
+        """
+        Packs encoded messages, given along with their index, into batches
+        of at most `max_bytes`, keeping their order.
+        """
+        if len(items) == 1:
+            return [items[0][1]]
+        # The size of a batch is roughly the sum of the sizes of its messages,
+        # which is only checked once the batch is encoded
+        chunks: List[List[Tuple[int, bytes]]] = [[]]
+        size = 0
+        for item in items:
+            if chunks[-1] and size + len(item[1]) > max_bytes:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(item)
+            size += len(item[1])
+        datagrams = []
+        for chunk in chunks:
+            if len(chunk) == 1:
+                datagrams.append(chunk[0][1])
+                continue
+            data = codec.encode({BATCH_SENDER: [
+                {messages[index][0]: messages[index][1]} for index, _ in chunk]})
+            if len(data) > max_bytes:
+                middle = len(chunk) // 2
+                datagrams.extend(cls._pack(codec, messages, chunk[:middle], max_bytes))
+                datagrams.extend(cls._pack(codec, messages, chunk[middle:], max_bytes))
+            else:
+                datagrams.append(data)
+        return datagrams
+
+    def transmit(self, datagrams: List[Tuple[bytes, Tuple[str, int]]]) -> int:
+        """
+        Sends datagrams that are already encoded, each to its own address,
+        and returns how many were sent.
+        """
+        if not datagrams:
+            return 0
+        sendto = self._get_sendto()
+        loop = self._loop
+        if loop is not None and not self._in_loop(loop):
+            if loop.is_closed():
+                return 0
+            # Every datagram goes through a single callback, so the loop is
+            # only woken up once
+            loop.call_soon_threadsafe(self._send_datagrams, sendto, datagrams)
+            return len(datagrams)
+        return self._send_datagrams(sendto, datagrams)
+
+    @staticmethod
+    def _in_loop(loop: asyncio.AbstractEventLoop) -> bool:
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
+    @staticmethod
+    def _send_datagrams(
+        sendto: SendTo,
+        datagrams: List[Tuple[bytes, Tuple[str, int]]],
+    ) -> int:
+        """
+        Sends encoded datagrams and returns how many were sent.
+        """
+        sent = 0
+        sent_bytes = 0
+        for data, address in datagrams:
+            if address is None:
+                # The player has not sent any datagram yet
+                continue
+            try:
+                sendto(data, address)
+                sent += 1
+                sent_bytes += len(data)
+            except OSError as exc:
+                log("Failed to send message to {}: {}", "error", address, exc)
+        METRICS.datagrams_sent.inc(sent)
+        METRICS.bytes_sent.inc(sent_bytes)
+        return sent
+
+    def close(self) -> None:
+        """
+        Closes the fallback socket, if any.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._sendto = None
+            self._loop = None
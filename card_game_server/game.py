@@ -0,0 +1,384 @@
+"""
+Server-authoritative game state.
+
+A room hosts at most one game at a time. The server shuffles the deck, deals
+the hands and checks every move against the rules of the game, so players
+only ever send their moves, never the state of the game, and only ever see
+their own hand.
+
+Games are played through TCP requests carrying the `room_id` of the game:
+
+- `start_game`, with a payload such as `{"rules": "eights", "hand_size": 5}`,
+  starts a game between the players of the room, in a random order. Options
+  other than `rules` are up to the rules.
+- `play`, with a move as payload, whose format is up to the rules.
+- `get_game`, without payload.
+
+Each of them replies with the view of the game of the player:
+
+    {"id": game_id, "version": 4, "rules": "eights",
+     "players": [player_id, ...],
+     "turn": player_id, "hand": 4503599627370497,
+     "hands": {player_id: 5, ...}, "deck": 41,
+     "piles": {"discard": {"top": 12, "size": 2}},
+     "state": {"suit": 0}, "winner": None}
+
+`hand` holds the bits of a `CardSet` (see `card_game_server.cards`), and
+`hands` the number of cards of every player. The versions of a game only
+ever increase, so a player can tell the latest view from an older one.
+
+After every change, every other player of the room is also sent its own view
+through UDP, as a message from the `game` sender, but only as the changes
+since the last view it acknowledged (see `card_game_server.snapshots`):
+
+    {"game": {"version": 12, "base": 11,
+              "changed": [[["version"], 5], [["turn"], player_id], ...]}}
+
+Rules are subclasses of `Rules`, registered by name with `register_rules`.
+`EightsRules` is a simple example.
+"""
+
+from random import Random, SystemRandom
+from typing import Any, Dict, List, Optional, Type
+
+from card_game_server.cards import (
+    MAX_CARDS,
+    STANDARD_DECK,
+    SUITS,
+    CardSet,
+    Pile,
+    rank_of,
+    suit_of,
+)
+from card_game_server.exceptions import GameError, InvalidMoveError
+from card_game_server.models.identifiers import new_identifier
+
+# Sender of the views, as seen by the players
+GAME_SENDER = "game"
+
+# Actions played on the game of a room
+GAME_ACTIONS = ("start_game", "play", "get_game")
+
+
+class Rules:
+    """
+    Base class for the rules of a game. Rules hold no state of their own:
+    everything they need is kept by the `Game` they are given, whose `state`
+    is shown to every player.
+    """
+
+    name: str = None
+    deck_size: int = STANDARD_DECK
+    min_players: int = 2
+    max_players: int = 8
+
+    def setup(self, game: 'Game', options: Dict[str, Any]) -> None:
+        """
+        Deals the cards of a new game, given the options of `start_game`.
+        """
+        raise NotImplementedError()
+
+    def check(self, game: 'Game', player_id: str, move: Any) -> None:
+        """
+        Raises `InvalidMoveError` if a player may not make a move. Must not
+        change the game.
+        """
+        raise NotImplementedError()
+
+    def apply(self, game: 'Game', player_id: str, move: Any) -> None:
+        """
+        Makes a move that passed `check`.
+        """
+        raise NotImplementedError()
+
+    def leave(self, game: 'Game', player_id: str) -> None:  # pylint: disable=no-self-use
+        """
+        Called when a player leaves the game, before it is removed. Its cards
+        are shuffled back into the deck by default.
+        """
+        game.deck.extend(game.hand(player_id))
+        game.deck.shuffle(game.rng)
+
+
+RULES: Dict[str, Type[Rules]] = {}
+
+
+def register_rules(rules: Type[Rules]) -> Type[Rules]:
+    """
+    Makes rules available to `start_game` under their name. May be used as a
+    class decorator.
+    """
+    RULES[rules.name] = rules
+    return rules
+
+
+def get_rules(name: str) -> Rules:
+    """
+    Gets rules by their name.
+    """
+    if name not in RULES:
+        raise GameError(f"Unknown rules {name}")
+    return RULES[name]()
+
+
+class Game:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        rules: Rules,
+        player_ids: List[str],
+        options: Dict[str, Any] = None,
+        rng: Random = None,
+    ):
+        """
+        A game between players, dealt right away. The turn order and the
+        deck are shuffled by `rng`, which defaults to the system's source of
+        randomness, so that players cannot predict the cards.
+        """
+        if not rules.min_players <= len(player_ids) <= rules.max_players:
+            raise GameError(
+                f"The game needs between {rules.min_players} and "
+                f"{rules.max_players} players")
+        if not 0 < rules.deck_size <= MAX_CARDS:
+            raise ValueError(f"Invalid deck size: {rules.deck_size}")
+        self._identifier: str = new_identifier()
+        self._rules: Rules = rules
+        self._rng: Random = rng if rng is not None else SystemRandom()
+        self._players: List[str] = list(player_ids)
+        self._rng.shuffle(self._players)
+        self._turn: int = 0
+        self._deck: Pile = Pile(range(rules.deck_size))
+        self._deck.shuffle(self._rng)
+        self._hands: Dict[str, CardSet] = {player_id: CardSet() for player_id in self._players}
+        self._piles: Dict[str, Pile] = {}
+        self._state: Dict[str, Any] = {}
+        self._winner: Optional[str] = None
+        self._version: int = 0
+        rules.setup(self, options or {})
+
+    @property
+    def identifier(self) -> str:
+        return self._identifier
+
+    @property
+    def rules(self) -> Rules:
+        return self._rules
+
+    @property
+    def rng(self) -> Random:
+        return self._rng
+
+    @property
+    def players(self) -> List[str]:
+        """
+        Get the players still in the game, in turn order.
+        """
+        return list(self._players)
+
+    @property
+    def turn(self) -> Optional[str]:
+        """
+        Get the player whose turn it is, or `None` once the game is over.
+        """
+        if self._winner is not None or not self._players:
+            return None
+        return self._players[self._turn]
+
+    @property
+    def deck(self) -> Pile:
+        return self._deck
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        """
+        Get the state of the rules, which every player sees.
+        """
+        return self._state
+
+    @property
+    def winner(self) -> Optional[str]:
+        return self._winner
+
+    @property
+    def finished(self) -> bool:
+        return self._winner is not None or not self._players
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def hand(self, player_id: str) -> CardSet:
+        """
+        Get the hand of a player, raising `InvalidMoveError` if it is not in
+        the game.
+        """
+        hand = self._hands.get(player_id)
+        if hand is None:
+            raise InvalidMoveError("You are not in this game")
+        return hand
+
+    def pile(self, name: str) -> Pile:
+        """
+        Get a pile by its name, creating it if needed.
+        """
+        pile = self._piles.get(name)
+        if pile is None:
+            pile = self._piles[name] = Pile()
+        return pile
+
+    def draw(self, player_id: str, count: int = 1) -> CardSet:
+        """
+        Moves up to `count` cards from the deck to the hand of a player, and
+        returns them.
+        """
+        drawn = self._deck.draw_many(count)
+        self.hand(player_id).update(drawn)
+        return drawn
+
+    def deal(self, count: int) -> None:
+        """
+        Deals `count` cards to every player, one at a time, as long as the
+        deck lasts.
+        """
+        for _ in range(count):
+            for player_id in self._players:
+                if not self._deck:
+                    return
+                self._hands[player_id].add(self._deck.draw())
+
+    def advance(self, steps: int = 1) -> None:
+        """
+        Passes the turn on.
+        """
+        if self._players:
+            self._turn = (self._turn + steps) % len(self._players)
+
+    def finish(self, winner: str) -> None:
+        self._winner = winner
+
+    def play(self, player_id: str, move: Any) -> None:
+        """
+        Makes a move, raising `InvalidMoveError` if the rules forbid it.
+        """
+        if self.finished:
+            raise InvalidMoveError("The game is over")
+        self.hand(player_id)
+        self._rules.check(self, player_id, move)
+        self._rules.apply(self, player_id, move)
+        self._version += 1
+
+    def remove_player(self, player_id: str) -> None:
+        """
+        Removes a player that left. The last player standing wins.
+        """
+        if player_id not in self._hands:
+            return
+        if not self.finished:
+            self._rules.leave(self, player_id)
+        index = self._players.index(player_id)
+        del self._players[index]
+        del self._hands[player_id]
+        if index < self._turn:
+            self._turn -= 1
+        elif self._turn >= len(self._players):
+            self._turn = 0
+        if len(self._players) == 1 and self._winner is None:
+            self._winner = self._players[0]
+        self._version += 1
+
+    def view(self, player_id: str) -> dict:
+        """
+        Get the game as seen by a player: its own hand, and only the number
+        of cards of the others.
+        """
+        hand = self._hands.get(player_id)
+        return {
+            "id": self._identifier,
+            "version": self._version,
+            "rules": self._rules.name,
+            "players": list(self._players),
+            "turn": self.turn,
+            "hand": hand.bits if hand is not None else 0,
+            "hands": {player: len(cards) for player, cards in self._hands.items()},
+            "deck": len(self._deck),
+            "piles": {
+                name: {"top": pile.top, "size": len(pile)}
+                for name, pile in self._piles.items()
+            },
+            "state": dict(self._state),
+            "winner": self._winner,
+        }
+
+
+# Rank of the eights, which match any card
+EIGHT = 7
+
+
+@register_rules
+class EightsRules(Rules):
+    """
+    Crazy eights, simplified, with the standard deck.
+
+    Every player gets `hand_size` cards, 7 by default with two players and 5
+    otherwise, and the top card of the deck starts the `discard` pile. In
+    turn, players either play a card of the rank of the top of the pile or
+    of the current suit, or any eight while naming the next suit, with
+    `{"play": card, "suit": suit}`, or draw a card with `{"draw": True}`,
+    which ends their turn. The first player left without cards wins.
+    """
+
+    name = "eights"
+
+    def setup(self, game: Game, options: Dict[str, Any]) -> None:
+        n_players = len(game.players)
+        hand_size = options.get("hand_size", 7 if n_players == 2 else 5)
+        if isinstance(hand_size, bool) or not isinstance(hand_size, int) or not (
+                0 < hand_size <= (self.deck_size - 1) // n_players):
+            raise GameError(f"Invalid hand size: {hand_size}")
+        game.deal(hand_size)
+        first = game.deck.draw()
+        game.pile("discard").push(first)
+        game.state["suit"] = suit_of(first)
+
+    def check(self, game: Game, player_id: str, move: Any) -> None:
+        if player_id != game.turn:
+            raise InvalidMoveError("It is not your turn")
+        if not isinstance(move, dict):
+            raise InvalidMoveError(f"Invalid move: {move!r}")
+        if move.get("draw") is True:
+            return
+        card = move.get("play")
+        if isinstance(card, bool) or not isinstance(card, int) or card not in game.hand(player_id):
+            raise InvalidMoveError(f"You do not hold card {card!r}")
+        if rank_of(card) == EIGHT:
+            suit = move.get("suit", suit_of(card))
+            if isinstance(suit, bool) or not isinstance(suit, int) or not 0 <= suit < SUITS:
+                raise InvalidMoveError(f"Invalid suit: {suit!r}")
+            return
+        top = game.pile("discard").top
+        if rank_of(card) != rank_of(top) and suit_of(card) != game.state["suit"]:
+            raise InvalidMoveError(f"Card {card} matches neither rank nor suit")
+
+    def apply(self, game: Game, player_id: str, move: Any) -> None:
+        discard = game.pile("discard")
+        if move.get("draw") is True:
+            if not game.deck and len(discard) > 1:
+                # Every card but the top of the pile is shuffled into the deck
+                top = discard.draw()
+                game.deck.extend(discard.take_all())
+                game.deck.shuffle(game.rng)
+                discard.push(top)
+            game.draw(player_id)
+            game.advance()
+            return
+        card = move["play"]
+        game.hand(player_id).remove(card)
+        discard.push(card)
+        if rank_of(card) == EIGHT:
+            game.state["suit"] = move.get("suit", suit_of(card))
+        else:
+            game.state["suit"] = suit_of(card)
+        if not game.hand(player_id):
+            game.finish(player_id)
+        else:
+            game.advance()
@@ -11,15 +11,20 @@ The layout consists in:
 - The room's chat is a list of messages and, at the bottom, a text box for
     sending messages.
 - There's also a log of the game's events in the bottom of the screen.
+
+Messages are received by the socket thread of the client, which only queues
+them and signals the GUI thread. The GUI thread adds whatever was queued to
+the chat at most once per frame, so a busy room costs one repaint per frame
+rather than one per message.
 """
 
-import json
-from random import randint
-from threading import Thread
-from time import sleep
+from collections import deque
+from threading import Lock, Thread
+from typing import Deque
 import traceback
 
 import pendulum
+from PyQt5.QtCore import QTimer, pyqtSignal
 from PyQt5.QtWidgets import (
     QWidget,
     QVBoxLayout,
@@ -30,6 +35,11 @@ from PyQt5.QtWidgets import (
 )
 
 from card_game_server.client import Client
+from card_game_server.codec import decode
+from card_game_server.gui.message_list import MAX_ROWS, MessageListView
+
+# Milliseconds between two updates of the chat, about one per frame
+FRAME_INTERVAL_MS = 16
 
 
 # Build the layout
@@ -38,12 +48,26 @@ class ClientGui(QWidget):  # pylint: disable=too-many-instance-attributes
     The main widget of the client.
     """
 
+    # Emitted from any thread, handled on the GUI thread
+    messages_ready = pyqtSignal()
+    log_ready = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
         self._client: Client = None
+        # Messages received since the last update of the chat. Older ones
+        # would not be shown anyway
+        self._pending: Deque[bytes] = deque(maxlen=MAX_ROWS)
+        self._pending_lock: Lock = Lock()
+        self._flush_scheduled: bool = False
+        self._flush_timer: QTimer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(FRAME_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self.flush_messages)
+        self.messages_ready.connect(self.schedule_flush)
+        self.log_ready.connect(self.append_log)
         self.init_ui()
         Thread(target=self.connect_to_server, daemon=True).start()
-        Thread(target=self.get_messages_loop, daemon=True).start()
 
     def init_ui(self):
         """
@@ -72,7 +96,7 @@ class ClientGui(QWidget):  # pylint: disable=too-many-instance-attributes
 
         # Room's players and chat
         self.room_players_list = QListWidget(self)
-        self.room_chat_list = QListWidget(self)
+        self.room_chat_list = MessageListView(parent=self)
 
         # Room's chat text box
         self.room_chat_text = QLineEdit(self)
@@ -81,7 +105,7 @@ class ClientGui(QWidget):  # pylint: disable=too-many-instance-attributes
         self.room_chat_text.returnPressed.connect(self.send_message)
 
         # Log of the game's events
-        self.log_list = QListWidget(self)
+        self.log_list = MessageListView(parent=self)
 
         # Layout
         self.main_layout = QVBoxLayout(self)
@@ -110,9 +134,15 @@ class ClientGui(QWidget):  # pylint: disable=too-many-instance-attributes
 
     def log(self, message: str):
         """
-        Add a message to the log.
+        Add a message to the log. May be called from any thread.
+        """
+        self.log_ready.emit(f"{pendulum.now().isoformat()}: {message}")
+
+    def append_log(self, line: str):
+        """
+        Add a line to the log, from the GUI thread.
         """
-        self.log_list.addItem(f"{pendulum.now().isoformat()}: {message}")
+        self.log_list.append_rows([line])
 
     def connect_to_server(self):
         """
@@ -124,35 +154,54 @@ class ClientGui(QWidget):  # pylint: disable=too-many-instance-attributes
                 server_host="localhost",
                 server_port_tcp=1234,
                 server_port_udp=1234,
-                client_port_udp=randint(5000, 6000),
+                on_message=self.on_message,
             )
             self.log(
                 f"Successfully connected with ID {self._client.identifier}")
         except Exception as exc:  # pylint: disable=broad-except
             self.log(f"Failed to connect: {exc}\n{traceback.format_exc()}")
 
-    def get_messages_loop(self):
-        """
-        Get messages from the server and add them to the chat.
-        """
-        while True:
-            if self._client:
-                sleep(0.05)  # TODO: maybe remove this on the future
-                try:
-                    messages = self._client.get_messages()
-                    for message in messages:
-                        # We need to decode the message.
-                        # After that, the sender is the dictionary key and the
-                        # message is the value.
-                        content = json.loads(message.decode())
-                        sender = list(content.keys())[0]
-                        message = content[sender]
-                        self.room_chat_list.addItem(
-                            f"{pendulum.now().isoformat()} ["
-                            f"{sender if sender != self._client.identifier else 'me'}]: {message}")
-                except Exception as exc:  # pylint: disable=broad-except
-                    self.log(
-                        f"Failed to get messages: {exc}\n{traceback.format_exc()}")
+    def on_message(self, message: bytes):
+        """
+        Queue a message from the server, from the socket thread of the
+        client, and wake the GUI thread up if it is not awake yet.
+        """
+        with self._pending_lock:
+            self._pending.append(message)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.messages_ready.emit()
+
+    def schedule_flush(self):
+        """
+        Add the queued messages to the chat on the next frame.
+        """
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def flush_messages(self):
+        """
+        Add every queued message to the chat at once.
+        """
+        with self._pending_lock:
+            messages = list(self._pending)
+            self._pending.clear()
+            self._flush_scheduled = False
+        identifier = self._client.identifier if self._client else None
+        now = pendulum.now().isoformat()
+        rows = []
+        for message in messages:
+            try:
+                # The sender is the dictionary key and the message is the value
+                content = decode(message)
+                sender = list(content.keys())[0]
+                rows.append(
+                    f"{now} [{sender if sender != identifier else 'me'}]: "
+                    f"{content[sender]}")
+            except Exception as exc:  # pylint: disable=broad-except
+                self.log(f"Failed to read message: {exc}\n{traceback.format_exc()}")
+        self.room_chat_list.append_rows(rows)
 
     def send_message(self):
         """
@@ -0,0 +1,95 @@
+"""
+Bounded list of lines for the GUI client, such as the chat and the log.
+
+The lines are kept in a model that never holds more than `max_rows` of them,
+dropping the oldest ones as new ones come in, and shown by a `QListView` that
+only lays out and paints the rows in sight. Lines are added in batches, so a
+burst of messages costs one insertion and one repaint, not one per line.
+"""
+
+from collections import deque
+from typing import Any, Deque, List
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+from PyQt5.QtWidgets import QAbstractItemView, QListView, QWidget
+
+# Default number of lines kept by a list
+MAX_ROWS = 5000
+
+# Number of rows laid out at a time when the view needs to lay out many
+BATCH_SIZE = 200
+
+
+class BoundedListModel(QAbstractListModel):
+
+    def __init__(self, max_rows: int = MAX_ROWS, parent: QWidget = None):
+        """
+        List model of at most `max_rows` lines, oldest first.
+        """
+        super().__init__(parent)
+        if max_rows < 1:
+            raise ValueError(f"Invalid maximum number of rows: {max_rows}")
+        self._rows: Deque[str] = deque()
+        self._max_rows: int = max_rows
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:  # pylint: disable=invalid-name
+        """
+        Qt model method.
+        """
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        """
+        Qt model method.
+        """
+        if role != Qt.DisplayRole or not 0 <= index.row() < len(self._rows):
+            return None
+        return self._rows[index.row()]
+
+    def append_rows(self, rows: List[str]):
+        """
+        Adds lines at the end, dropping the oldest ones if there are too many.
+        """
+        rows = rows[-self._max_rows:]
+        if not rows:
+            return
+        overflow = len(self._rows) + len(rows) - self._max_rows
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            for _ in range(overflow):
+                self._rows.popleft()
+            self.endRemoveRows()
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self._rows.extend(rows)
+        self.endInsertRows()
+
+
+class MessageListView(QListView):
+
+    def __init__(self, max_rows: int = MAX_ROWS, parent: QWidget = None):
+        """
+        Read-only view of a `BoundedListModel`, which follows the newest line
+        unless the user scrolled up.
+        """
+        super().__init__(parent)
+        self._model: BoundedListModel = BoundedListModel(max_rows, self)
+        self.setModel(self._model)
+        # Rows all have the same height, so the view never measures each one
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QListView.Batched)
+        self.setBatchSize(BATCH_SIZE)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+    def append_rows(self, rows: List[str]):
+        """
+        Adds lines at the end of the list. Must be called from the GUI
+        thread.
+        """
+        scrollbar = self.verticalScrollBar()
+        following = scrollbar.value() == scrollbar.maximum()
+        self._model.append_rows(rows)
+        if following:
+            self.scrollToBottom()
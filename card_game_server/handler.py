@@ -0,0 +1,443 @@
+from time import perf_counter
+from typing import Any, Tuple
+
+from card_game_server.codec import JSON, negotiate
+from card_game_server.exceptions import (
+    GameError,
+    PlayerNotFoundError,
+    PlayerNotInRoomError,
+    RoomFullError,
+    RoomNotFoundError,
+    UdpServerFailedToSendError,
+)
+from card_game_server.game import GAME_ACTIONS
+from card_game_server.listing import RoomListing
+from card_game_server.lobby import Lobby
+from card_game_server.logger import log
+from card_game_server.metrics import METRICS
+from card_game_server.models.message import Message
+from card_game_server.models.rooms import Rooms
+from card_game_server.reliable import parse_seq
+from card_game_server.snapshots import parse_version
+from card_game_server.ticks import parse_tick_rate
+
+
+def make_reply(success: bool, data: Any, request_id: int = None) -> dict:
+    """
+    Builds the reply to a TCP request, echoing its request ID if any.
+    """
+    reply = {
+        'success': success,
+        'message': data,
+    }
+    if request_id is not None:
+        reply['request_id'] = request_id
+    return reply
+
+
+def parse_udp_port(value: Any) -> int:
+    """
+    Validates the UDP port a client registers with.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"Invalid UDP port: {value!r}")
+    port = int(value)
+    if not 0 < port < 65536:
+        raise ValueError(f"Invalid UDP port: {value!r}")
+    return port
+
+
+def encode_reply(success: bool, data: Any) -> bytes:
+    """
+    Encodes a reply to a one-shot TCP request.
+    """
+    return JSON.encode(make_reply(success, data))
+
+
+class Handler:
+
+    def __init__(
+        self,
+        rooms: Rooms,
+        listing: RoomListing = None,
+        lobby: Lobby = None,
+    ):
+        """
+        Implements the server actions independently of the transport, so
+        that every server engine runs exactly the same logic.
+
+        Rooms are listed, and lobby subscriptions are served, from the
+        listing and lobby of `rooms` unless other ones are given, e.g. ones
+        that also cover the rooms of other shards.
+        """
+        self._rooms: Rooms = rooms
+        self._listing: RoomListing = listing if listing is not None else rooms.listing
+        self._lobby: Lobby = lobby if lobby is not None else rooms.lobby
+
+    @property
+    def rooms(self) -> Rooms:
+        return self._rooms
+
+    def handle_udp(self, message: Message, address: Tuple[str, int] = None) -> None:
+        """
+        Handles a message received through UDP from an address.
+        """
+        start = perf_counter()
+        success = False
+        try:
+            self._handle_udp(message, address)
+            success = True
+        finally:
+            METRICS.observe_request(message.action, perf_counter() - start, success)
+
+    def _handle_udp(self, message: Message, address: Tuple[str, int]) -> None:
+        """
+        Implements `handle_udp`.
+        """
+        if not all(isinstance(value, (str, type(None)))
+                   for value in (message.identifier, message.room_id)):
+            log("Datagram from {} with a malformed identifier or room", "error", address)
+            return
+        if not self._authenticate(message, address):
+            return
+        # Keep-alive pings only tell that the player is still there
+        if message.action == "ping":
+            if self._rooms.get_player(message.identifier) is None:
+                log("Ping from unknown player {}", "debug", message.identifier)
+            else:
+                self._rooms.touch(message.identifier)
+            return
+        self._rooms.touch(message.identifier)
+        if message.action == "ack":
+            try:
+                self._rooms.reliable.acknowledge(
+                    message.identifier, message.room_id, message.payload)
+            except ValueError as exc:
+                log("Invalid acknowledgement from player {}: {}", "error",
+                    message.identifier, exc, player=message.identifier)
+            return
+        if message.action == "game_ack":
+            try:
+                self._rooms.acknowledge_game(
+                    message.identifier, message.room_id, parse_version(message.payload))
+            except (PlayerNotFoundError, PlayerNotInRoomError, RoomNotFoundError,
+                    ValueError) as exc:
+                log("Invalid game acknowledgement from player {}: {!r}", "debug",
+                    message.identifier, exc, player=message.identifier)
+            return
+        if message.seq is not None:
+            self._handle_reliable(message)
+            return
+        self._relay(message)
+
+    def _authenticate(self, message: Message, address: Tuple[str, int]) -> bool:
+        """
+        Checks the token of a datagram, and follows its player to the address
+        it came from. Returns whether the datagram may be handled.
+        """
+        player = self._rooms.get_player(message.identifier)
+        if player is None:
+            # Reported by whatever handles the datagram
+            return True
+        if message.token is None:
+            if player.requires_token:
+                log("Datagram from {} without the token of player {}", "error", address,
+                    message.identifier, player=message.identifier)
+                return False
+            return True
+        previous = player.udp_address
+        if not player.learn_address(message.token, address):
+            log("Datagram from {} with a wrong token for player {}", "error", address,
+                message.identifier, player=message.identifier)
+            return False
+        if player.udp_address != previous:
+            log("Player {} is now reached at {}", "debug", message.identifier,
+                player.udp_address, player=message.identifier)
+        return True
+
+    def _handle_reliable(self, message: Message) -> None:
+        """
+        Acknowledges a message of a reliable channel, then relays every
+        message of the channel that is now in order.
+        """
+        player = self._rooms.get_player(message.identifier)
+        if player is None:
+            log("Reliable message from unknown player {}", "debug", message.identifier)
+            return
+        try:
+            epoch, seq = parse_seq(message.epoch), parse_seq(message.seq)
+        except ValueError as exc:
+            log("Invalid reliable message from player {}: {}", "error",
+                message.identifier, exc, player=message.identifier)
+            return
+        for delivered in self._rooms.reliable.receive(
+                player, message.room_id, epoch, seq, message):
+            # The message was acknowledged, so a failure must not hold back
+            # the ones after it
+            try:
+                self._relay(delivered, reliable=True)
+            except (RoomNotFoundError, UdpServerFailedToSendError):
+                pass
+
+    def _relay(self, message: Message, reliable: bool = False) -> None:
+        """
+        Relays a `send` or `sendto` message to the players of its room.
+        """
+        if self._rooms.get_room(message.room_id) is None:
+            log("Room with id {} not found when handling message from player {}", "error",
+                message.room_id, message.identifier)
+            raise RoomNotFoundError()
+        if message.action == "send":
+            log("Sending message {} to {}", "debug", message.payload, message.room_id,
+                room=message.room_id, player=message.identifier)
+            try:
+                self._rooms.send(
+                    message.identifier,
+                    message.room_id,
+                    message.payload["message"],
+                    reliable,
+                )
+                log("Message successfully sent to {}", "debug", message.room_id,
+                    room=message.room_id, player=message.identifier)
+            except Exception as exc:
+                log("Failed to send message to {}: {}", "error", message.room_id, exc)
+                raise UdpServerFailedToSendError() from exc
+        elif message.action == "sendto":
+            try:
+                log("Sending message {} to {}", "debug", message.payload,
+                    message.payload["recipients"], room=message.room_id,
+                    player=message.identifier)
+                self._rooms.sendto(
+                    message.identifier,
+                    message.room_id,
+                    message.payload["recipients"],
+                    message.payload["message"],
+                    reliable,
+                )
+                log("Message successfully sent to {}", "debug", message.payload["recipients"],
+                    room=message.room_id, player=message.identifier)
+            except Exception as exc:
+                log("Failed to send message to {}: {}", "error",
+                    message.payload["recipients"], exc)
+                raise UdpServerFailedToSendError() from exc
+
+    def handle_request(
+        self,
+        address: Tuple[str, int],
+        message: Message,
+    ) -> dict:
+        """
+        Handles a request received through a TCP session and returns the
+        reply frame.
+        """
+        success, data = self.handle_tcp(address, message)
+        return make_reply(success, data, message.request_id)
+
+    def handle_tcp(
+        self,
+        address: Tuple[str, int],
+        message: Message,
+    ) -> Tuple[bool, Any]:
+        """
+        Handles a request received through TCP and returns the pair
+        `(success, message)` that must be sent back to the client.
+        """
+        start = perf_counter()
+        success = False
+        try:
+            success, data = self._handle_tcp(address, message)
+            return success, data
+        except PlayerNotFoundError:
+            # The player was evicted while its request was being handled
+            return False, "Unknown Player ID"
+        except (KeyError, TypeError, ValueError) as exc:
+            # A payload missing a field or with a field of the wrong type
+            log("Malformed {} request from {}: {!r}", "error", message.action, address, exc,
+                player=message.identifier)
+            return False, "Malformed request"
+        finally:
+            METRICS.observe_request(message.action, perf_counter() - start, success)
+
+    def _handle_tcp(  # pylint: disable=too-many-return-statements
+        self,
+        address: Tuple[str, int],
+        message: Message,
+    ) -> Tuple[bool, Any]:
+        """
+        Implements `handle_tcp`.
+        """
+        # If we want to register a player, just do it and return
+        if message.action == "register":
+            # Legacy clients only send their UDP port
+            if not isinstance(message.payload, dict):
+                log("Registering player with UDP port {}", "debug", message.payload)
+                client = self._rooms.register(address, parse_udp_port(message.payload))
+                log("Registered player {}", "debug", client)
+                return True, client.identifier
+            # Clients that do not report a UDP port are reached wherever
+            # their datagrams come from
+            udp_port = message.payload.get("udp_port")
+            if udp_port is not None:
+                udp_port = parse_udp_port(udp_port)
+            codecs = message.payload.get("codecs")
+            if codecs is not None and (
+                    not isinstance(codecs, list)
+                    or not all(isinstance(name, str) for name in codecs)):
+                raise ValueError(f"Invalid codecs: {codecs!r}")
+            codec = negotiate(codecs)
+            reliable = message.payload.get("reliable", False)
+            if not isinstance(reliable, bool):
+                raise ValueError(f"Invalid reliable flag: {reliable!r}")
+            batching = message.payload.get("batching", False)
+            if not isinstance(batching, bool):
+                raise ValueError(f"Invalid batching flag: {batching!r}")
+            log("Registering player with {}", "debug", message.payload)
+            client = self._rooms.register(address, udp_port, codec, reliable, batching)
+            log("Registered player {} using codec {}", "debug", client, codec.name)
+            return True, {
+                "identifier": client.identifier,
+                "codec": codec.name,
+                "reliable": reliable,
+                "token": client.token,
+                "batching": batching,
+            }
+
+        # Every other action requires a registered player
+        if message.identifier is None:
+            log("Unregistered client {} sent action {}", "error", address, message.action)
+            return False, "You must register"
+
+        # Check if it is registered, if it's not, send a failure message
+        client = self._rooms.get_player(message.identifier)
+        if not client:
+            log("Unknown Player ID {} for {}", "error", message.identifier, address)
+            return False, "Unknown Player ID"
+        self._rooms.touch(message.identifier)
+
+        # If the action asks to join a room
+        if message.action == "join":
+            # Tries to find a room and join it
+            try:
+                if not self._rooms.get_room(message.payload):
+                    log("Player {} tried to join room {} but it doesn't exist", "error",
+                        client, message.payload)
+                    raise RoomNotFoundError()
+                log("Player {} is joining room {}", "debug", client, message.payload,
+                    room=message.payload, player=message.identifier)
+                self._rooms.join(message.identifier, message.payload)
+                log("Player {} joined room {}", "debug", client, message.payload,
+                    room=message.payload, player=message.identifier)
+                return True, message.payload
+            except RoomNotFoundError:
+                log("Join failure (RoomNotFound) for {}", "debug", client,
+                    player=message.identifier)
+                return False, message.payload
+            except RoomFullError:
+                log("Join failure (RoomFull) for {}", "debug", client,
+                    room=message.payload, player=message.identifier)
+                return False, message.payload
+
+        # If the action asks to join ANY room
+        if message.action == "autojoin":
+            log("Player {} is trying to autojoin ANY room", "debug", client,
+                player=message.identifier)
+            room_id = self._rooms.join(message.identifier).identifier
+            log("Player {} joined room {}", "debug", client, room_id,
+                room=room_id, player=message.identifier)
+            return True, room_id
+
+        # If the action asks to list rooms
+        if message.action == "get_rooms":
+            log("Player {} is trying to list rooms", "debug", client,
+                player=message.identifier)
+            try:
+                return True, self._listing.query(message.payload)
+            except ValueError as exc:
+                log("Invalid room listing query from {}: {}", "debug", client, exc,
+                    player=message.identifier)
+                return False, str(exc)
+
+        # If the action asks to be told about changes in the rooms
+        if message.action == "subscribe_lobby":
+            log("Player {} subscribed to the lobby", "debug", client,
+                player=message.identifier)
+            return True, self._lobby.subscribe(client)
+
+        if message.action == "unsubscribe_lobby":
+            log("Player {} unsubscribed from the lobby", "debug", client,
+                player=message.identifier)
+            return True, self._lobby.unsubscribe(message.identifier)
+
+        # If the action asks to create a room
+        if message.action == "create":
+            log("Player {} is trying to create a room", "debug", client,
+                player=message.identifier)
+            # The payload is either the name of the room, or its settings
+            room_name, tick_rate = message.payload, 0
+            if isinstance(message.payload, dict):
+                room_name = message.payload.get("name")
+                tick_rate = parse_tick_rate(message.payload.get("tick_rate"))
+            room_id = self._rooms.create(room_name, client.identifier, tick_rate).identifier
+            log("Player {} created and joined room {}", "debug", client, room_id,
+                room=room_id, player=message.identifier)
+            return True, room_id
+
+        # If the action asks to leave a room
+        if message.action == "leave":
+            log("Player {} is trying to leave a room", "debug", client,
+                room=message.room_id, player=message.identifier)
+            try:
+                if not self._rooms.get_room(message.room_id):
+                    log("Player {} tried to leave room {} but it doesn't exist", "error",
+                        client, message.room_id)
+                    raise RoomNotFoundError()
+                self._rooms.leave(message.identifier, message.room_id)
+                log("Player {} left room {}", "debug", client, message.room_id,
+                    room=message.room_id, player=message.identifier)
+                return True, message.room_id
+            except RoomNotFoundError:
+                log("Leave failure (RoomNotFound) for {}", "debug", client,
+                    player=message.identifier)
+                return False, message.room_id
+            except PlayerNotInRoomError:
+                log("Leave failure (PlayerNotInRoom) for {}", "debug", client,
+                    room=message.room_id, player=message.identifier)
+                return False, message.room_id
+
+        # If the action is played on the game of a room
+        if message.action in GAME_ACTIONS:
+            return self._handle_game(message)
+
+        # Otherwise, the action is unknown
+        log("Player {} sent an unknown action {}", "error", client, message.action)
+        return False, f"Unknown action {message.action}"
+
+    def _handle_game(self, message: Message) -> Tuple[bool, Any]:
+        """
+        Handles the actions played on the game of a room, see
+        `card_game_server.game`.
+        """
+        log("Player {} sent {} to the game of room {}", "debug", message.identifier,
+            message.action, message.room_id, room=message.room_id, player=message.identifier)
+        try:
+            if message.action == "start_game":
+                options = dict(message.payload or {})
+                rules = options.pop("rules")
+                return True, self._rooms.start_game(
+                    message.identifier, message.room_id, rules, options)
+            if message.action == "play":
+                return True, self._rooms.play(
+                    message.identifier, message.room_id, message.payload)
+            return True, self._rooms.get_game(message.identifier, message.room_id)
+        except RoomNotFoundError:
+            log("Game failure (RoomNotFound) for {}", "debug", message.identifier,
+                player=message.identifier)
+            return False, message.room_id
+        except PlayerNotInRoomError:
+            log("Game failure (PlayerNotInRoom) for {}", "debug", message.identifier,
+                room=message.room_id, player=message.identifier)
+            return False, message.room_id
+        except GameError as exc:
+            log("Game failure for {}: {}", "debug", message.identifier, exc,
+                room=message.room_id, player=message.identifier)
+            return False, str(exc) or type(exc).__name__
@@ -0,0 +1,140 @@
+"""
+Bounded, ordered queue of the messages a client receives.
+
+Messages come out in the order they arrived, duplicates included. The queue
+never holds more than `max_messages` of them: when it is full, the overflow
+policy decides what happens to the next one.
+
+- `drop_oldest` drops the oldest message to make room, so a slow consumer
+  always sees the latest state of the game.
+- `drop_newest` drops the incoming message instead.
+- `block` makes the receiving thread wait for room. Datagrams that keep
+  arriving meanwhile pile up in the socket buffer, then get dropped by the
+  kernel.
+
+Consumers may drain the queue at once, wait for the next message, with or
+without a timeout, or iterate over the messages until the queue is closed.
+"""
+
+from collections import deque
+from threading import Condition, Lock
+from time import monotonic
+from typing import Any, Deque, Iterator, List, Optional
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+DEFAULT_MAX_MESSAGES = 10000
+
+
+class Inbox:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        max_messages: int = DEFAULT_MAX_MESSAGES,
+        overflow: str = "drop_oldest",
+    ):
+        """
+        Queue of at most `max_messages` messages, handling overflow according
+        to one of `OVERFLOW_POLICIES`.
+        """
+        if max_messages < 1:
+            raise ValueError(f"Invalid maximum number of messages: {max_messages}")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflow}")
+        self._messages: Deque[Any] = deque()
+        self._max_messages: int = max_messages
+        self._overflow: str = overflow
+        self._lock: Lock = Lock()
+        self._not_empty: Condition = Condition(self._lock)
+        self._not_full: Condition = Condition(self._lock)
+        self._closed: bool = False
+        self._dropped: int = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Any]:
+        """
+        Yields every message, waiting for the next one, until the queue is
+        closed and drained.
+        """
+        while True:
+            message = self.get()
+            if message is None:
+                return
+            yield message
+
+    @property
+    def dropped(self) -> int:
+        """
+        Get the number of messages dropped because the queue was full.
+        """
+        return self._dropped
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, message: Any) -> bool:
+        """
+        Adds a message. Returns whether it was queued, as it is not when it
+        is dropped or when the queue is closed.
+        """
+        with self._lock:
+            while len(self._messages) >= self._max_messages and not self._closed:
+                if self._overflow == "drop_oldest":
+                    self._messages.popleft()
+                    self._dropped += 1
+                elif self._overflow == "drop_newest":
+                    self._dropped += 1
+                    return False
+                else:
+                    self._not_full.wait()
+            if self._closed:
+                return False
+            self._messages.append(message)
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout: float = None) -> Optional[Any]:
+        """
+        Removes and returns the oldest message, waiting up to `timeout`
+        seconds, or forever, for one to arrive. Returns `None` if none did,
+        or if the queue is closed and drained.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._lock:
+            while not self._messages:
+                if self._closed:
+                    return None
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._not_empty.wait(remaining)
+            message = self._messages.popleft()
+            self._not_full.notify()
+            return message
+
+    def get_all(self) -> List[Any]:
+        """
+        Removes and returns every queued message, oldest first, without
+        waiting.
+        """
+        with self._lock:
+            messages = list(self._messages)
+            self._messages.clear()
+            self._not_full.notify_all()
+            return messages
+
+    def close(self) -> None:
+        """
+        Closes the queue. Messages still queued can be read, but no new one
+        is accepted, and nobody waits on the queue anymore.
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
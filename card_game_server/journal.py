@@ -0,0 +1,369 @@
+"""
+Append-only journal and snapshots of the registry.
+
+Players, rooms and memberships only live in memory, in `Rooms`. With a
+journal, every change to them is also written to disk, so that a restarted
+server comes back with the same players, tokens and rooms, and clients carry
+on instead of all registering again at once. Games, reliable channels and
+messages held back until a tick are not kept, and neither are the addresses
+players are reached at that were learned since the last snapshot: they are
+learned again from the next datagram of each player, such as a keep-alive
+ping.
+
+The journal is a directory of segments, `journal-<n>.log`, each a sequence of
+records, and of snapshots, `snapshot-<n>.bin`, which hold every record needed
+to rebuild the registry as it was when segment `n` started. Recovering loads
+the latest snapshot, then replays the segments from `n` on, in order.
+
+Every record is framed by its length and its CRC-32, and holds a JSON list:
+
+    [op, value]
+
+Records are written by `Rooms` and must be idempotent, such as "this room
+now has these players" rather than "this player joined this room". Snapshots
+are then taken while the registry keeps changing: the segment is rotated
+first, and the registry captured after, so that replaying the new segment
+over a snapshot that already holds some of its changes leads to the same
+state. A record cut short by a crash, or that fails its checksum, ends the
+segment it is in.
+
+Records are buffered, and written by a `JournalWriter` thread every interval
+in a single write. The `fsync` policy tells how long they may stay in the
+buffers of the operating system:
+
+- `always` writes and syncs every record before the change returns, which
+  is durable but holds the registry while the disk works.
+- `batch` syncs after every write, so at most an interval of changes is lost.
+- `never` leaves syncing to the operating system.
+
+Snapshots are read through `mmap`, so only the pages being decoded are ever
+held in memory, and their records hold thousands of players or rooms each,
+which keeps recovering a million players down to a few seconds.
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import zlib
+from contextlib import nullcontext
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import IO, Any, Iterable, Iterator, List, Optional
+
+from card_game_server.exceptions import JournalLockedError
+from card_game_server.logger import log
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# Policies for syncing the journal to disk, see the module docstring
+JOURNAL_FSYNC = ("always", "batch", "never")
+
+# Default seconds between two writes of the buffered records
+JOURNAL_INTERVAL = 0.05
+
+# Default seconds between two snapshots
+SNAPSHOT_INTERVAL = 300.0
+
+# Most players or rooms in a single record of a snapshot
+SNAPSHOT_CHUNK = 4096
+
+# Length and CRC-32 of the payload of a record
+_HEADER = struct.Struct("<II")
+
+_NO_LOCK = nullcontext()
+
+_FILE_NAME = re.compile(r"^(journal|snapshot)-(\d+)\.(log|bin)$")
+_EXTENSIONS = {"journal": "log", "snapshot": "bin"}
+
+
+def _frame(record: Any) -> bytes:
+    """
+    Encodes a record along with its header.
+    """
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str) -> Iterator[Any]:
+    """
+    Yields the records of a segment or a snapshot, up to the first one that
+    is cut short or corrupt.
+    """
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + _HEADER.size <= size:
+                length, checksum = _HEADER.unpack_from(data, offset)
+                start = offset + _HEADER.size
+                if start + length > size:
+                    break
+                payload = data[start:start + length]
+                if zlib.crc32(payload) != checksum:
+                    break
+                yield json.loads(payload)
+                offset = start + length
+            if offset < size:
+                log("Ignored the last {} bytes of {}, cut short or corrupt", "error",
+                    size - offset, path)
+
+
+class Journal:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, directory: str, fsync: str = "batch"):
+        """
+        Journal kept in a directory, created if needed. It must be recovered
+        from, then opened, before anything is appended to it.
+
+        The directory is locked until the journal is closed, where the
+        platform allows it, and `JournalLockedError` is raised if another
+        journal holds it, since two servers writing the same journal would
+        remove each other's segments.
+        """
+        if fsync not in JOURNAL_FSYNC:
+            raise ValueError(f"Invalid fsync policy: {fsync}")
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file: Optional[IO[bytes]] = self._lock_directory(directory)
+        self._directory: str = directory
+        self._fsync: str = fsync
+        self._segment: int = 0
+        self._file: Optional[IO[bytes]] = None
+        self._buffer: List[bytes] = []
+        # Guards the buffer and the current segment. Only ever held for a
+        # list operation, unless every record is synced, since it is taken
+        # while the registry lock is held
+        self._lock: Lock = Lock()
+        # Serializes writes, rotations and snapshots
+        self._write_lock: Lock = Lock()
+
+    @staticmethod
+    def _lock_directory(directory: str) -> Optional[IO[bytes]]:
+        if fcntl is None:
+            return None
+        lock_file = open(os.path.join(directory, "lock"), "ab")  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as exc:
+            lock_file.close()
+            raise JournalLockedError(f"Journal {directory} is used by another server") from exc
+        return lock_file
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def fsync(self) -> str:
+        return self._fsync
+
+    @property
+    def segment(self) -> int:
+        """
+        Get the segment records are appended to.
+        """
+        return self._segment
+
+    def _path(self, kind: str, number: int) -> str:
+        return os.path.join(self._directory, f"{kind}-{number:010d}.{_EXTENSIONS[kind]}")
+
+    def _list(self, kind: str) -> List[int]:
+        """
+        Get the numbers of the segments or snapshots in the directory, in
+        order.
+        """
+        numbers = []
+        for name in os.listdir(self._directory):
+            match = _FILE_NAME.match(name)
+            if match and match.group(1) == kind:
+                numbers.append(int(match.group(2)))
+        return sorted(numbers)
+
+    def recover(self) -> Iterator[Any]:
+        """
+        Yields the records of the latest snapshot, then those of every
+        segment that follows it.
+        """
+        snapshots = self._list("snapshot")
+        start = snapshots[-1] if snapshots else 0
+        self._segment = start
+        if snapshots:
+            yield from read_records(self._path("snapshot", start))
+        for number in self._list("journal"):
+            self._segment = max(self._segment, number)
+            if number >= start:
+                yield from read_records(self._path("journal", number))
+
+    def open(self) -> None:
+        """
+        Starts a new segment, after the ones recovered from, so that a record
+        cut short by a crash is never followed by new ones.
+        """
+        with self._write_lock, self._lock:
+            if self._file is not None:
+                return
+            self._segment += 1
+            self._file = open(self._path("journal", self._segment), "ab")  # pylint: disable=consider-using-with
+            self._sync_directory()
+
+    def close(self) -> None:
+        """
+        Writes the buffered records and closes the journal.
+        """
+        self.flush()
+        with self._write_lock, self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    def append(self, record: Any) -> None:
+        """
+        Adds a record, written by the next `flush` unless every record is
+        synced right away.
+        """
+        data = _frame(record)
+        with self._lock:
+            if self._fsync != "always":
+                self._buffer.append(data)
+                return
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _write(self, file: IO[bytes], buffer: List[bytes]) -> None:
+        """
+        Writes records to a segment, and syncs it as the policy asks.
+        """
+        if buffer:
+            file.write(b"".join(buffer))
+            file.flush()
+            if self._fsync == "batch":
+                os.fsync(file.fileno())
+
+    def flush(self) -> int:
+        """
+        Writes the buffered records, and returns how many.
+        """
+        with self._write_lock:
+            with self._lock:
+                buffer, self._buffer = self._buffer, []
+                file = self._file
+            if file is not None:
+                self._write(file, buffer)
+        return len(buffer)
+
+    def rotate(self, barrier: Lock = None) -> int:
+        """
+        Writes the buffered records and starts a new segment, whose number
+        is returned. A snapshot of the registry taken from then on holds
+        every record of the segments before it.
+
+        When a lock is given, segments are switched while holding it, so
+        that the changes it guards are either all in the old segment or all
+        in the new one. Nothing is written while holding it.
+        """
+        with self._write_lock:
+            with barrier if barrier is not None else _NO_LOCK, self._lock:
+                buffer, self._buffer = self._buffer, []
+                previous = self._file
+                self._segment += 1
+                self._file = open(self._path("journal", self._segment), "ab")  # pylint: disable=consider-using-with
+            if previous is not None:
+                self._write(previous, buffer)
+                if self._fsync != "never":
+                    os.fsync(previous.fileno())
+                previous.close()
+            self._sync_directory()
+            return self._segment
+
+    def write_snapshot(self, segment: int, records: Iterable[Any]) -> int:
+        """
+        Writes the snapshot from which segment `segment` is to be replayed,
+        then removes the snapshots and segments it makes useless. Returns
+        how many records it holds.
+        """
+        path = self._path("snapshot", segment)
+        count = 0
+        with open(f"{path}.tmp", "wb") as file:
+            for record in records:
+                file.write(_frame(record))
+                count += 1
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{path}.tmp", path)
+        self._sync_directory()
+        for number in self._list("snapshot"):
+            if number < segment:
+                os.remove(self._path("snapshot", number))
+        for number in self._list("journal"):
+            if number < segment:
+                os.remove(self._path("journal", number))
+        return count
+
+    def _sync_directory(self) -> None:
+        """
+        Makes files created or renamed in the directory survive a crash.
+        """
+        if self._fsync == "never" or not hasattr(os, "O_DIRECTORY"):
+            return
+        descriptor = os.open(self._directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+class JournalWriter(Thread):
+
+    def __init__(
+        self,
+        rooms: "Rooms",
+        interval: float = JOURNAL_INTERVAL,
+        snapshot_interval: float = SNAPSHOT_INTERVAL,
+    ):
+        """
+        Writes the buffered records of the journal of a `Rooms` every
+        interval, and a snapshot of it every snapshot interval, unless that
+        is 0.
+        """
+        super().__init__(daemon=True)
+        if rooms.journal is None:
+            raise ValueError("Rooms has no journal")
+        self._rooms: "Rooms" = rooms
+        self._interval: float = interval
+        self._snapshot_interval: float = snapshot_interval
+        self._stopped: Event = Event()
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        journal = self._rooms.journal
+        next_snapshot = monotonic() + self._snapshot_interval
+        while not self._stopped.wait(self._interval):
+            try:
+                journal.flush()
+                if self._snapshot_interval and monotonic() >= next_snapshot:
+                    start = monotonic()
+                    count = self._rooms.checkpoint()
+                    log("Wrote a snapshot of {} records in {:.2f}s", "info",
+                        count, monotonic() - start)
+                    next_snapshot = monotonic() + self._snapshot_interval
+            except OSError as exc:
+                log("Failed to write the journal: {!r}", "error", exc)
+        journal.close()
+
+    def stop(self):
+        """
+        Stop the writer, once it wrote what is left.
+        """
+        self._stopped.set()
@@ -0,0 +1,232 @@
+"""
+Room listing served by `get_rooms`.
+
+The listing is a snapshot of the summary of every room, tagged with the
+version of the registry it was taken at. It is only rebuilt when the version
+changes, and the pages served from a snapshot are cached until then, along
+with their encoding for each codec, so a lobby full of clients polling the
+same page costs one rebuild and one serialization per change, not one per
+request.
+
+A `get_rooms` request without a payload gets the whole list, as it always
+did. A request with a dict payload gets a single page:
+
+    {"limit": 50, "cursor": None, "sort": "created",
+     "open": False, "prefix": None, "capacity": None}
+
+- `sort` is one of `SORT_KEYS`, always ascending: `created` lists the oldest
+  rooms first, `players` the emptiest ones and `free_seats` the fullest ones
+  that still have a seat.
+- `open` only lists rooms with a free seat, `prefix` only those whose name
+  starts with it, and `capacity` only those of that capacity.
+- `cursor` is the `next` of the previous page. Cursors point between two
+  rooms rather than at an offset, so rooms created or removed between two
+  pages never make a page skip or repeat a room.
+
+The reply is `{"rooms": [...], "next": cursor, "version": version}`, where
+`next` is `None` on the last page.
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_right
+from itertools import count
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from card_game_server.codec import Encoded
+
+SORT_KEYS = ("created", "name", "players", "free_seats")
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Largest number of distinct pages cached for a single snapshot
+MAX_CACHED_PAGES = 1024
+
+Key = Tuple[Any, ...]
+
+
+def _encode_cursor(key: Key) -> str:
+    return urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Key:
+    try:
+        return tuple(json.loads(urlsafe_b64decode(cursor.encode())))
+    except (ValueError, TypeError, AttributeError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor}") from exc
+
+
+class RoomListing:
+
+    def __init__(
+        self,
+        version: Callable[[], Hashable],
+        summaries: Callable[[], Iterable[dict]],
+    ):
+        """
+        Cached listing of rooms. `version` returns a value that changes
+        whenever any room is created, removed, joined or left, and
+        `summaries` returns the summary of every room, oldest first.
+        """
+        self._get_version: Callable[[], Hashable] = version
+        self._get_summaries: Callable[[], Iterable[dict]] = summaries
+        self._version: Hashable = None
+        self._rooms: List[dict] = []
+        self._encoded_rooms: Encoded = Encoded([])
+        self._sequences: Dict[str, int] = {}
+        self._sequence = count()
+        self._sorted: Dict[str, Tuple[List[Key], List[dict]]] = {}
+        self._pages: Dict[tuple, Encoded] = {}
+        self._lock: Lock = Lock()
+
+    def _refresh(self) -> Hashable:
+        """
+        Rebuilds the snapshot if the rooms changed since it was taken. Must
+        be called with the lock held.
+        """
+        # Reading the version first means a change made while we build the
+        # snapshot triggers another rebuild, rather than getting lost
+        version = self._get_version()
+        if version == self._version:
+            return version
+        rooms = list(self._get_summaries())
+        sequences = {}
+        for room in rooms:
+            sequence = self._sequences.get(room["id"])
+            if sequence is None:
+                sequence = next(self._sequence)
+            sequences[room["id"]] = sequence
+        self._sequences = sequences
+        self._rooms = rooms
+        self._encoded_rooms = Encoded(rooms)
+        self._sorted = {}
+        self._pages = {}
+        self._version = version
+        return version
+
+    def _sort(self, sort: str) -> Tuple[List[Key], List[dict]]:
+        """
+        Get the rooms of the snapshot sorted by a key, along with the sort key
+        of each. Must be called with the lock held.
+        """
+        result = self._sorted.get(sort)
+        if result is not None:
+            return result
+        sequences = self._sequences
+        if sort == "created":
+            def key(room):
+                return (sequences[room["id"]],)
+        elif sort == "name":
+            def key(room):
+                return (str(room["name"]), sequences[room["id"]])
+        elif sort == "players":
+            def key(room):
+                return (room["n_players"], sequences[room["id"]])
+        else:
+            def key(room):
+                return (room["capacity"] - room["n_players"], sequences[room["id"]])
+        pairs = sorted(((key(room), room) for room in self._rooms), key=lambda pair: pair[0])
+        result = self._sorted[sort] = (
+            [pair[0] for pair in pairs], [pair[1] for pair in pairs])
+        return result
+
+    def rooms(self) -> List[dict]:
+        """
+        Get the summary of every room, oldest first.
+        """
+        with self._lock:
+            self._refresh()
+            return self._rooms
+
+    def page(  # pylint: disable=too-many-arguments
+        self,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        sort: str = "created",
+        open_only: bool = False,
+        prefix: Optional[str] = None,
+        capacity: Optional[int] = None,
+    ) -> dict:
+        """
+        Get a page of rooms, see the module documentation.
+        """
+        return self._get_page(limit, cursor, sort, open_only, prefix, capacity).value
+
+    def _get_page(  # pylint: disable=too-many-arguments
+        self,
+        limit: int,
+        cursor: Optional[str],
+        sort: str,
+        open_only: bool,
+        prefix: Optional[str],
+        capacity: Optional[int],
+    ) -> Encoded:
+        """
+        Implements `page`, returning the cached page.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        if not isinstance(limit, int) or not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"Invalid page size: {limit}")
+        if prefix is not None and not isinstance(prefix, str):
+            raise ValueError(f"Invalid prefix: {prefix}")
+        if capacity is not None and not isinstance(capacity, int):
+            raise ValueError(f"Invalid capacity: {capacity}")
+        query = (limit, cursor, sort, bool(open_only), prefix, capacity)
+        with self._lock:
+            version = self._refresh()
+            page = self._pages.get(query)
+            if page is not None:
+                return page
+            keys, rooms = self._sort(sort)
+            start = 0
+            if cursor is not None:
+                try:
+                    start = bisect_right(keys, _decode_cursor(cursor))
+                except TypeError as exc:
+                    raise ValueError(f"Invalid cursor for sort key {sort}: {cursor}") from exc
+            selected = []
+            next_cursor = None
+            for index in range(start, len(rooms)):
+                room = rooms[index]
+                if open_only and room["n_players"] >= room["capacity"]:
+                    continue
+                if prefix is not None and not str(room["name"]).startswith(prefix):
+                    continue
+                if capacity is not None and room["capacity"] != capacity:
+                    continue
+                if len(selected) == limit:
+                    next_cursor = _encode_cursor(keys[selected[-1]])
+                    break
+                selected.append(index)
+            page = Encoded({
+                "rooms": [rooms[index] for index in selected],
+                "next": next_cursor,
+                "version": version if isinstance(version, int) else str(version),
+            })
+            if len(self._pages) >= MAX_CACHED_PAGES:
+                self._pages.clear()
+            self._pages[query] = page
+            return page
+
+    def query(self, payload: Any) -> Encoded:
+        """
+        Answers a `get_rooms` request, given its payload. The answer is
+        cached along with its encoding, until the rooms change.
+        """
+        if payload is None:
+            with self._lock:
+                self._refresh()
+                return self._encoded_rooms
+        if not isinstance(payload, dict):
+            raise ValueError(f"Invalid query: {payload}")
+        return self._get_page(
+            limit=payload.get("limit", DEFAULT_PAGE_SIZE),
+            cursor=payload.get("cursor"),
+            sort=payload.get("sort", "created"),
+            open_only=payload.get("open", False),
+            prefix=payload.get("prefix"),
+            capacity=payload.get("capacity"),
+        )
@@ -0,0 +1,198 @@
+"""
+Liveness tracking of players.
+
+Clients prove they are alive by sending a `ping` datagram every once in a
+while, and any other request they make counts as well. Players that stay
+silent for longer than the timeout are evicted: they are removed from every
+room they sit in, then from the registry.
+
+Deadlines are kept in a hashed timer wheel, advanced once per tick, so a tick
+only looks at the players whose deadline falls in it, never at every player.
+A ping only records the current tick. When a deadline comes up for a player
+that was seen since it was scheduled, the player is simply rescheduled at its
+new deadline, so each player costs O(1) work per timeout period, however
+often it pings.
+"""
+
+from math import ceil
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, List
+
+from card_game_server.logger import log
+from card_game_server.metrics import METRICS
+
+if TYPE_CHECKING:
+    from card_game_server.models.rooms import Rooms  # pylint: disable=cyclic-import
+
+
+class TimerWheel:
+
+    def __init__(self, n_slots: int):
+        """
+        Hashed timer wheel with one slot per tick. Deadlines may be at most
+        `n_slots - 1` ticks away, so every key in a slot is due when the
+        wheel reaches it. Scheduling, cancelling and expiring a key are O(1).
+        """
+        if n_slots < 2:
+            raise ValueError(f"Invalid number of slots: {n_slots}")
+        self._slots: List[Dict[Hashable, None]] = [{} for _ in range(n_slots)]
+        self._slot_of: Dict[Hashable, int] = {}
+        self._now: int = 0
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    @property
+    def now(self) -> int:
+        """
+        Get the current tick.
+        """
+        return self._now
+
+    def schedule(self, key: Hashable, ticks: int) -> None:
+        """
+        Schedules a key to expire `ticks` ticks from now, replacing its
+        previous deadline if any.
+        """
+        if not 0 < ticks < len(self._slots):
+            raise ValueError(f"Invalid deadline: {ticks} ticks")
+        self.cancel(key)
+        slot = (self._now + ticks) % len(self._slots)
+        self._slots[slot][key] = None
+        self._slot_of[key] = slot
+
+    def cancel(self, key: Hashable) -> None:
+        """
+        Cancels the deadline of a key, if any.
+        """
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self) -> List[Hashable]:
+        """
+        Moves to the next tick and returns every key due at it.
+        """
+        self._now += 1
+        slot = self._now % len(self._slots)
+        due = self._slots[slot]
+        self._slots[slot] = {}
+        for key in due:
+            del self._slot_of[key]
+        return list(due)
+
+
+class Liveness:
+
+    def __init__(self, timeout: float, tick: float = 1.0):
+        """
+        Tracks when each player was last seen and tells which ones have been
+        silent for longer than `timeout` seconds, with a resolution of `tick`
+        seconds.
+        """
+        if timeout <= 0 or tick <= 0:
+            raise ValueError(f"Invalid timeout {timeout} or tick {tick}")
+        self._tick: float = tick
+        self._timeout_ticks: int = max(1, ceil(timeout / tick))
+        self._wheel: TimerWheel = TimerWheel(self._timeout_ticks + 1)
+        self._last_seen: Dict[str, int] = {}
+        self._lock: Lock = Lock()
+
+    @property
+    def tick(self) -> float:
+        return self._tick
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout_ticks * self._tick
+
+    def __len__(self) -> int:
+        return len(self._last_seen)
+
+    def track(self, player_id: str) -> None:
+        """
+        Starts tracking a player, as seen right now.
+        """
+        with self._lock:
+            self._last_seen[player_id] = self._wheel.now
+            self._wheel.schedule(player_id, self._timeout_ticks)
+
+    def touch(self, player_id: str) -> None:
+        """
+        Records that a tracked player was seen right now.
+        """
+        with self._lock:
+            if player_id in self._last_seen:
+                self._last_seen[player_id] = self._wheel.now
+
+    def forget(self, player_id: str) -> None:
+        """
+        Stops tracking a player.
+        """
+        with self._lock:
+            if self._last_seen.pop(player_id, None) is not None:
+                self._wheel.cancel(player_id)
+
+    def advance(self) -> List[str]:
+        """
+        Moves to the next tick and returns the players that just timed out.
+        They are not tracked anymore.
+        """
+        expired = []
+        with self._lock:
+            due = self._wheel.advance()
+            now = self._wheel.now
+            for player_id in due:
+                idle = now - self._last_seen[player_id]
+                if idle >= self._timeout_ticks:
+                    del self._last_seen[player_id]
+                    expired.append(player_id)
+                else:
+                    self._wheel.schedule(player_id, self._timeout_ticks - idle)
+        return expired
+
+
+class Reaper(Thread):
+
+    def __init__(
+        self,
+        rooms: "Rooms",
+        on_evict: Callable[[List[str]], None] = None,
+    ):
+        """
+        Advances the liveness tracker of a `Rooms` once per tick and evicts
+        the players that timed out. `on_evict` is called with the
+        identifiers of the evicted players, from this thread.
+        """
+        super().__init__(daemon=True)
+        if rooms.liveness is None:
+            raise ValueError("Rooms does not track liveness")
+        self._rooms: "Rooms" = rooms
+        self._on_evict: Callable[[List[str]], None] = on_evict
+        self._stopped: Event = Event()
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        tick = self._rooms.liveness.tick
+        deadline = monotonic()
+        while True:
+            # Ticks are scheduled from the start, so they do not drift
+            deadline += tick
+            if self._stopped.wait(max(0, deadline - monotonic())):
+                break
+            evicted = self._rooms.reap()
+            if not evicted:
+                continue
+            METRICS.evictions.inc(len(evicted))
+            log("Evicted {} idle players", "debug", len(evicted))
+            if self._on_evict is not None:
+                self._on_evict(evicted)
+
+    def stop(self):
+        """
+        Stop the reaper.
+        """
+        self._stopped.set()
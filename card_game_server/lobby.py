@@ -0,0 +1,200 @@
+"""
+Push-based lobby subscriptions.
+
+A player sends `subscribe_lobby` and gets a snapshot of every room along with
+a sequence number. From then on, the server pushes deltas to its UDP address,
+as a message from the `lobby` sender:
+
+    {"lobby": {"seq": 8, "created": [summary, ...], "removed": [room_id, ...],
+               "changed": [{"id": room_id, "n_players": 1}, ...]}}
+
+Each delta has the next sequence number. A player that sees a gap, or gets
+`{"lobby": {"seq": 9, "resync": True}}`, sends `subscribe_lobby` again to
+get a fresh snapshot. `unsubscribe_lobby` stops the deltas.
+
+Changes are only recorded as "this room changed" when they happen, and
+deltas are built from the current state of those rooms when they are
+published, at most once per interval. A room that changes a hundred times
+in an interval costs a single entry, a room created and removed within one
+costs nothing, and the push rate stays bounded however fast rooms churn.
+When too many rooms changed in an interval for a single datagram, the
+subscribers are asked to resync instead.
+"""
+
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Set
+
+from card_game_server.fanout import FanOut
+from card_game_server.logger import log
+from card_game_server.models.player import Player
+
+# Sender of the deltas, as seen by the players
+LOBBY_SENDER = "lobby"
+
+# Default seconds between two deltas
+LOBBY_INTERVAL = 0.1
+
+# Most rooms described by a single delta before asking for a resync instead
+MAX_DELTA_ROOMS = 100
+
+
+class Lobby:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        fanout: FanOut,
+        summary: Callable[[str], Optional[dict]],
+        snapshot: Callable[[], List[dict]],
+        is_registered: Callable[[str], bool] = lambda player_id: True,
+    ):
+        """
+        Subscribers of the lobby and the rooms that changed since the last
+        delta. `summary` gets the summary of a room, or `None` if it does
+        not exist anymore, `snapshot` gets the summary of every room, and
+        `is_registered` tells whether a subscriber is still registered.
+        """
+        self._fanout: FanOut = fanout
+        self._summary: Callable[[str], Optional[dict]] = summary
+        self._snapshot: Callable[[], List[dict]] = snapshot
+        self._is_registered: Callable[[str], bool] = is_registered
+        self._subscribers: Dict[str, Player] = {}
+        self._seq: int = 0
+        # Rooms the subscribers know about
+        self._known: Set[str] = set()
+        # Rooms that changed since the last delta. This lock is only ever
+        # held for a single dict operation, since it is taken while the
+        # registry lock is held
+        self._changed: Dict[str, None] = {}
+        self._changed_lock: Lock = Lock()
+        # Serializes snapshots and deltas, so that every delta following a
+        # snapshot describes changes made after it
+        self._lock: Lock = Lock()
+
+    @property
+    def n_subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def mark(self, room_id: str) -> None:
+        """
+        Records that a room was created, removed, joined or left. Costs
+        nothing while nobody is subscribed.
+        """
+        if not self._subscribers:
+            return
+        with self._changed_lock:
+            self._changed[room_id] = None
+
+    def subscribe(self, player: Player) -> dict:
+        """
+        Subscribes a player, or resyncs it if it already is, and returns the
+        snapshot it must apply the next deltas to.
+        """
+        with self._lock:
+            if not self._subscribers:
+                self._known = set()
+            self._subscribers[player.identifier] = player
+            rooms = self._snapshot()
+            self._known.update(room["id"] for room in rooms)
+            return {"seq": self._seq, "rooms": rooms}
+
+    def unsubscribe(self, player_id: str) -> bool:
+        """
+        Unsubscribes a player. Returns whether it was subscribed.
+        """
+        with self._lock:
+            return self._subscribers.pop(player_id, None) is not None
+
+    def _build_delta(self, changed: List[str]) -> Optional[dict]:
+        """
+        Builds the delta for rooms that changed, or returns `None` if the
+        subscribers would not learn anything from it. Must be called with the
+        lock held.
+        """
+        if len(changed) > MAX_DELTA_ROOMS:
+            # Everybody gets a snapshot again, which tells what they know
+            self._known = set()
+            self._seq += 1
+            return {"seq": self._seq, "resync": True}
+        created, removed, updated = [], [], []
+        for room_id in changed:
+            summary = self._summary(room_id)
+            if summary is None:
+                if room_id in self._known:
+                    self._known.discard(room_id)
+                    removed.append(room_id)
+            elif room_id in self._known:
+                updated.append({"id": room_id, "n_players": summary["n_players"]})
+            else:
+                self._known.add(room_id)
+                created.append(summary)
+        if not (created or removed or updated):
+            # Only rooms created and removed since the last delta
+            return None
+        self._seq += 1
+        delta = {"seq": self._seq}
+        if created:
+            delta["created"] = created
+        if removed:
+            delta["removed"] = removed
+        if updated:
+            delta["changed"] = updated
+        return delta
+
+    def publish(self) -> int:
+        """
+        Pushes a delta of every room that changed since the last one to the
+        subscribers, if any changed. Returns how many datagrams were sent.
+        """
+        with self._lock:
+            with self._changed_lock:
+                changed, self._changed = list(self._changed), {}
+            if not changed or not self._subscribers:
+                return 0
+            for player_id in [
+                    player_id for player_id in self._subscribers
+                    if not self._is_registered(player_id)]:
+                del self._subscribers[player_id]
+            delta = self._build_delta(changed)
+            if delta is None:
+                return 0
+            recipients = list(self._subscribers.values())
+        return self._fanout.send(LOBBY_SENDER, delta, recipients)
+
+
+class LobbyPublisher(Thread):
+
+    def __init__(self, lobby: Lobby, interval: float = LOBBY_INTERVAL):
+        """
+        Publishes the deltas of a lobby every `interval` seconds.
+        """
+        super().__init__(daemon=True)
+        if interval <= 0:
+            raise ValueError(f"Invalid interval {interval}")
+        self._lobby: Lobby = lobby
+        self._interval: float = interval
+        self._stopped: Event = Event()
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        deadline = monotonic()
+        while True:
+            deadline += self._interval
+            if self._stopped.wait(max(0, deadline - monotonic())):
+                break
+            try:
+                self._lobby.publish()
+            except Exception as exc:  # pylint: disable=broad-except
+                log("Failed to publish lobby delta: {!r}", "error", exc)
+
+    def stop(self):
+        """
+        Stop the publisher.
+        """
+        self._stopped.set()
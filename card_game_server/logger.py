@@ -1,19 +1,116 @@
-from typing import Any
+"""
+Logging facade used by the whole server.
+
+Messages are formatted lazily: `log("Received {} from {}", "debug", data,
+address)` only formats its arguments if the record is actually going to be
+written, and a call below the current level returns right away. Records are
+written by a background thread (loguru's `enqueue`), so request handlers
+never wait for stderr or a log file.
+
+The level can be raised for a single room or player at runtime with
+`set_verbosity`, which only affects the calls that name that room or player
+through the `room` and `player` keywords.
+"""
+
+import sys
+from typing import Any, Dict
 
 from loguru import logger
 
+LEVELS: Dict[str, int] = {
+    "debug": 10,
+    "info": 20,
+    "warning": 30,
+    "error": 40,
+    "critical": 50,
+}
+
+# Records below this level are dropped unless an override applies
+_threshold: int = LEVELS["debug"]
 
-def log(msg: Any, level: str = "info") -> None:
+# Levels of the rooms and players whose verbosity was changed at runtime
+_overrides: Dict[str, int] = {}
+
+_DISABLED = LEVELS["critical"] + 1
+
+
+def _override(identifier: Any) -> int:
     """
-    Logs a message to prefect's logger.
+    Get the level of a room or player, which may come straight from a
+    client and so be of any type.
     """
-    levels = {
-        "debug": logger.debug,
-        "info": logger.info,
-        "warning": logger.warning,
-        "error": logger.error,
-        "critical": logger.critical,
-    }
-    if level not in levels:
+    if not isinstance(identifier, str):
+        return _DISABLED
+    return _overrides.get(identifier, _DISABLED)
+
+
+def log(
+    msg: Any,
+    level: str,
+    *args: Any,
+    room: str = None,
+    player: str = None,
+) -> None:
+    """
+    Logs a message to loguru's logger at a level such as "info". Extra
+    arguments are formatted into the message with `str.format`, only when the
+    record is written.
+    """
+    levelno = LEVELS.get(level)
+    if levelno is None:
         raise ValueError(f"Invalid log level: {level}")
-    levels[level](msg)
+    if levelno < _threshold:
+        if not _overrides:
+            return
+        if levelno < min(_override(room), _override(player)):
+            return
+    logger.opt(depth=1).log(level.upper(), str(msg), *args)
+
+
+def get_level() -> str:
+    """
+    Get the current global level.
+    """
+    for name, levelno in LEVELS.items():
+        if levelno == _threshold:
+            return name
+    return None
+
+
+def configure(level: str = "info", sink: Any = sys.stderr, enqueue: bool = True) -> None:
+    """
+    Sets the global level and replaces loguru's handlers by a single sink,
+    written from a background thread unless `enqueue` is false.
+    """
+    global _threshold  # pylint: disable=global-statement
+    if level not in LEVELS:
+        raise ValueError(f"Invalid log level: {level}")
+    logger.remove()
+    # Filtering is done by `log`, so that overrides can let records through
+    logger.add(sink, level="DEBUG", enqueue=enqueue)
+    _threshold = LEVELS[level]
+
+
+def set_verbosity(identifier: str, level: str = None) -> None:
+    """
+    Sets the level of a single room or player, or resets it to the global
+    level if no level is given.
+    """
+    global _overrides  # pylint: disable=global-statement
+    if level is not None and level not in LEVELS:
+        raise ValueError(f"Invalid log level: {level}")
+    # Replaced rather than mutated, so `log` never sees it half updated
+    overrides = dict(_overrides)
+    if level is None:
+        overrides.pop(identifier, None)
+    else:
+        overrides[identifier] = LEVELS[level]
+    _overrides = overrides
+
+
+def get_verbosity() -> Dict[str, str]:
+    """
+    Get the level of every room and player whose verbosity was changed.
+    """
+    names = {levelno: name for name, levelno in LEVELS.items()}
+    return {identifier: names[levelno] for identifier, levelno in _overrides.items()}
@@ -0,0 +1,376 @@
+"""
+Server metrics, exposed in the Prometheus text format.
+
+Recording is meant to stay enabled in production: a counter increment or a
+histogram observation is a dict lookup and an addition under an uncontended
+lock, and gauges are only computed when the metrics are scraped. Locks only
+record their wait time when they are contended.
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from card_game_server.models.rooms import Rooms  # pylint: disable=cyclic-import
+
+# Actions that get their own label, anything else is counted as "unknown"
+ACTIONS = (
+    "register",
+    "join",
+    "autojoin",
+    "create",
+    "leave",
+    "get_rooms",
+    "send",
+    "sendto",
+    "ping",
+    "subscribe_lobby",
+    "unsubscribe_lobby",
+    "ack",
+    "start_game",
+    "play",
+    "get_game",
+    "game_ack",
+)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(label: Optional[str], value: Optional[str], extra: str = None) -> str:
+    labels = []
+    if label is not None:
+        labels.append(f'{label}="{value}"')
+    if extra is not None:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, label: str = None):
+        """
+        Monotonically increasing value, optionally split by a single label.
+        """
+        self._name: str = name
+        self._documentation: str = documentation
+        self._label: str = label
+        self._values: Dict[Optional[str], float] = {}
+        self._lock: Lock = Lock()
+
+    def inc(self, amount: float = 1, label_value: str = None) -> None:
+        """
+        Increments the counter.
+        """
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def get(self, label_value: str = None) -> float:
+        """
+        Get the current value of the counter.
+        """
+        return self._values.get(label_value, 0)
+
+    def render(self) -> List[str]:
+        """
+        Renders the counter in the Prometheus text format.
+        """
+        lines = [
+            f"# HELP {self._name} {self._documentation}",
+            f"# TYPE {self._name} counter",
+        ]
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: str(item[0]))
+        for value, total in values:
+            lines.append(f"{self._name}{_format_labels(self._label, value)} {total}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label: str = None,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        """
+        Distribution of observed values, optionally split by a single label.
+        """
+        self._name: str = name
+        self._documentation: str = documentation
+        self._label: str = label
+        self._buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # For each label value: the count of every bucket, then +Inf, then the sum
+        self._values: Dict[Optional[str], List[float]] = {}
+        self._lock: Lock = Lock()
+
+    def observe(self, value: float, label_value: str = None) -> None:
+        """
+        Records a single observation.
+        """
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(label_value)
+            if counts is None:
+                counts = self._values[label_value] = [0] * (len(self._buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, label_value: str = None) -> int:
+        """
+        Get how many values were observed.
+        """
+        counts = self._values.get(label_value)
+        return sum(counts[:-1]) if counts else 0
+
+    def render(self) -> List[str]:
+        """
+        Renders the histogram in the Prometheus text format.
+        """
+        lines = [
+            f"# HELP {self._name} {self._documentation}",
+            f"# TYPE {self._name} histogram",
+        ]
+        with self._lock:
+            values = sorted(
+                ((value, list(counts)) for value, counts in self._values.items()),
+                key=lambda item: str(item[0]))
+        for value, counts in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self._label, value, f'le="{bound}"')
+                lines.append(f"{self._name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self._label, value)
+            lines.append(f"{self._name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self._name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: Callable[[], float] = None,
+    ):
+        """
+        Value computed by a function whenever the metrics are scraped.
+        """
+        self._name: str = name
+        self._documentation: str = documentation
+        self._function: Callable[[], float] = function
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Sets the function that computes the value of the gauge.
+        """
+        self._function = function
+
+    def render(self) -> List[str]:
+        """
+        Renders the gauge in the Prometheus text format.
+        """
+        if self._function is None:
+            return []
+        return [
+            f"# HELP {self._name} {self._documentation}",
+            f"# TYPE {self._name} gauge",
+            f"{self._name} {self._function()}",
+        ]
+
+
+class Metrics:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(self):
+        """
+        Every metric recorded by the server.
+        """
+        self.requests = Counter(
+            "cgs_requests_total", "Requests handled, by action.", "action")
+        self.request_failures = Counter(
+            "cgs_request_failures_total", "Requests that failed, by action.", "action")
+        self.request_duration = Histogram(
+            "cgs_request_duration_seconds", "Time spent handling requests, by action.", "action")
+        self.datagrams_received = Counter(
+            "cgs_datagrams_received_total", "UDP datagrams received.")
+        self.bytes_received = Counter(
+            "cgs_bytes_received_total", "Bytes received in UDP datagrams.")
+        self.datagrams_sent = Counter(
+            "cgs_datagrams_sent_total", "UDP datagrams sent to players.")
+        self.bytes_sent = Counter(
+            "cgs_bytes_sent_total", "Bytes sent to players in UDP datagrams.")
+        self.decode_failures = Counter(
+            "cgs_decode_failures_total", "Messages that could not be decoded, by transport.",
+            "transport")
+        self.lock_wait = Histogram(
+            "cgs_lock_wait_seconds", "Time spent waiting for contended locks, by lock.", "lock")
+        self.evictions = Counter(
+            "cgs_evictions_total", "Players evicted for being silent for too long.")
+        self.rooms_reclaimed = Counter(
+            "cgs_rooms_reclaimed_total", "Empty rooms removed by the reclaimer.")
+        self.reclaimed_bytes = Counter(
+            "cgs_reclaimed_bytes_total", "Estimated memory freed by removing empty rooms.")
+        self.retransmissions = Counter(
+            "cgs_retransmissions_total", "Reliable datagrams sent again for lack of an ack.")
+        self.reliable_failures = Counter(
+            "cgs_reliable_failures_total",
+            "Reliable channels dropped after too many retransmissions.")
+        self.players = Gauge("cgs_players", "Registered players.")
+        self.rooms = Gauge("cgs_rooms", "Existing rooms.")
+
+    def observe_request(self, action: str, duration: float, success: bool) -> None:
+        """
+        Records a handled request.
+        """
+        if action not in ACTIONS:
+            action = "unknown"
+        self.requests.inc(1, action)
+        self.request_duration.observe(duration, action)
+        if not success:
+            self.request_failures.inc(1, action)
+
+    def track(self, players: Callable[[], float], rooms: Callable[[], float]) -> None:
+        """
+        Sets the functions that count players and rooms.
+        """
+        self.players.set_function(players)
+        self.rooms.set_function(rooms)
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in (
+            self.requests,
+            self.request_failures,
+            self.request_duration,
+            self.datagrams_received,
+            self.bytes_received,
+            self.datagrams_sent,
+            self.bytes_sent,
+            self.decode_failures,
+            self.lock_wait,
+            self.evictions,
+            self.rooms_reclaimed,
+            self.reclaimed_bytes,
+            self.retransmissions,
+            self.reliable_failures,
+            self.players,
+            self.rooms,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class TimedLock:
+
+    __slots__ = ("_lock", "_name")
+
+    def __init__(self, name: str):
+        """
+        Lock that records how long it was waited for whenever it is
+        contended. Uncontended acquisitions cost a single non-blocking try.
+        """
+        self._lock: Lock = Lock()
+        self._name: str = name
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        """
+        Acquires the lock, like `threading.Lock.acquire`.
+        """
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        METRICS.lock_wait.observe(perf_counter() - start, self._name)
+        return acquired
+
+    def release(self) -> None:
+        """
+        Releases the lock.
+        """
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # Scrapes are far too frequent to be worth logging
+        pass
+
+
+class MetricsServer(Thread):
+
+    def __init__(
+        self,
+        port: Union[str, int],
+        rooms: "Rooms" = None,
+        host: str = "127.0.0.1",
+        metrics: Metrics = METRICS,
+    ):
+        """
+        Serves the metrics over HTTP, at `/metrics`, on the local interface
+        by default.
+        """
+        super().__init__(daemon=True)
+        self._metrics: Metrics = metrics
+        if rooms is not None:
+            metrics.track(lambda: rooms.n_players, lambda: rooms.n_rooms)
+        self._httpd: ThreadingHTTPServer = ThreadingHTTPServer(
+            (host, int(port)), _MetricsRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.metrics = metrics
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        self._httpd.serve_forever()
+
+    def stop(self):
+        """
+        Stop the server.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
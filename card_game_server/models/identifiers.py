@@ -0,0 +1,31 @@
+from typing import Optional
+from uuid import uuid4
+
+# Shards are encoded in the first byte of an identifier
+MAX_SHARDS = 256
+
+
+def new_identifier(shard: Optional[int] = None) -> str:
+    """
+    Generates a new identifier. When a shard is given, it is encoded in the
+    first byte, so that anyone can tell which shard owns the identifier.
+    """
+    identifier = str(uuid4())
+    if shard is None:
+        return identifier
+    if not 0 <= shard < MAX_SHARDS:
+        raise ValueError(f"Invalid shard: {shard}")
+    return f"{shard:02x}{identifier[2:]}"
+
+
+def shard_of(identifier: str) -> Optional[int]:
+    """
+    Returns the shard encoded in an identifier, or `None` if it is not a
+    valid identifier.
+    """
+    if not isinstance(identifier, str) or len(identifier) < 2:
+        return None
+    try:
+        return int(identifier[:2], 16)
+    except ValueError:
+        return None
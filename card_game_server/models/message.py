@@ -1,13 +1,29 @@
 from typing import Any
 
+from card_game_server.exceptions import ProtocolError
 
-class Message:
+
+class Message:  # pylint: disable=too-many-instance-attributes
     def __init__(self, data: dict):
+        """
+        Message decoded from a datagram or a request. Raises `ProtocolError`
+        if it is not an object.
+        """
+        if not isinstance(data, dict):
+            raise ProtocolError(f"Message is not an object: {type(data).__name__}")
         self._raw_data: dict = data
         self._identifier: str = data.get('identifier', None)
         self._room_id: str = data.get('room_id', None)
         self._payload: Any = data.get('payload', None)
         self._action: str = data.get('action', None)
+        self._request_id: int = data.get('request_id', None)
+        self._epoch: int = data.get('epoch', None)
+        self._seq: int = data.get('seq', None)
+        self._token: str = data.get('token', None)
+
+    @property
+    def data(self) -> dict:
+        return self._raw_data
 
     @property
     def identifier(self) -> str:
@@ -24,3 +40,19 @@ class Message:
     @property
     def action(self) -> str:
         return self._action
+
+    @property
+    def request_id(self) -> int:
+        return self._request_id
+
+    @property
+    def epoch(self) -> int:
+        return self._epoch
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    @property
+    def token(self) -> str:
+        return self._token
@@ -1,28 +1,55 @@
-import json
-import socket
-from typing import Tuple, Union
-from uuid import uuid4
+import hmac
+import secrets
+from typing import Any, Optional, Tuple, Union
 
+from card_game_server.codec import JSON, Codec
+from card_game_server.models.identifiers import new_identifier
 
-class Player:
 
-    def __init__(
+class Player:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(  # pylint: disable=too-many-arguments
         self,
         address: Tuple[str, int],
-        udp_port: Union[str, int]
+        udp_port: Union[str, int, None] = None,
+        codec: Codec = JSON,
+        identifier: str = None,
+        reliable: bool = False,
+        token: str = None,
+        udp_address: Tuple[str, int] = None,
+        batching: bool = False,
     ):
         """
-        Identification of a remote player.
+        Identification of a remote player. Reliable players acknowledge the
+        messages of reliable channels, see `card_game_server.reliable`.
+
+        Players that report a UDP port are reached at it, on the IP address
+        of their TCP connection, as legacy clients expect. The others are
+        reached wherever their datagrams come from, see `learn_address`, so
+        they work behind a NAT, and every datagram they send must carry
+        their token.
+
+        Batching players accept several messages in a single datagram, see
+        `card_game_server.ticks`.
         """
-        self._identifier: str = str(uuid4())
+        self._identifier: str = identifier if identifier else new_identifier()
         self._address: str = address
-        self._udp_address: Tuple[str, int] = (address[0], int(udp_port))
+        self._requires_token: bool = udp_port is None
+        self._udp_address: Optional[Tuple[str, int]] = (
+            (address[0], int(udp_port)) if udp_port is not None else udp_address)
+        self._token: str = token if token else secrets.token_urlsafe(16)
+        self._codec: Codec = codec
+        self._reliable: bool = reliable
+        self._batching: bool = batching
 
     def __eq__(self, other: 'Player'):
         return self._identifier == other._identifier
 
+    def __hash__(self) -> int:
+        return hash(self._identifier)
+
     def __str__(self) -> str:
-        return f"<Player {self._identifier} (udp_port={self.udp_address[1]})>"
+        return f"<Player {self._identifier} (udp_address={self._udp_address})>"
 
     def __repr__(self) -> str:
         return self.__str__()
@@ -36,36 +63,43 @@ class Player:
         return self._address
 
     @property
-    def udp_address(self):
-        return self._udp_address
-
-    # pylint: disable=no-self-use
-    def send_tcp(
-        self,
-        success: bool,
-        data: str,
-        sock: socket.socket
-    ):
+    def udp_address(self) -> Optional[Tuple[str, int]]:
         """
-        Send a TCP message to the player.
+        Get the address datagrams are sent to, or `None` until the player
+        sent one.
         """
-        message = json.dumps({
-            'success': success,
-            'message': data,
-        })
-        sock.send(message.encode())
+        return self._udp_address
 
-    def send_udp(
-        self,
-        player_identifier: str,
-        message: str,
-    ):
+    @property
+    def token(self) -> str:
+        return self._token
+
+    @property
+    def requires_token(self) -> bool:
+        return self._requires_token
+
+    def learn_address(self, token: Any, address: Optional[Tuple[str, int]]) -> bool:
         """
-        Send a UDP message to the player.
+        Checks the token carried by a datagram, and if it matches, makes the
+        address it came from the one the player is reached at from now on.
+        Returns whether the token matched.
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(
-            json.dumps({player_identifier: message}).encode(),
-            self._udp_address,
-        )
-        sock.close()
+        if not isinstance(token, str):
+            return False
+        if not hmac.compare_digest(token.encode(), self._token.encode()):
+            return False
+        if address is not None:
+            self._udp_address = tuple(address)
+        return True
+
+    @property
+    def codec(self) -> Codec:
+        return self._codec
+
+    @property
+    def reliable(self) -> bool:
+        return self._reliable
+
+    @property
+    def batching(self) -> bool:
+        return self._batching
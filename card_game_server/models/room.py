@@ -1,31 +1,71 @@
-from typing import List
-from uuid import uuid4
+import math
+import sys
+from typing import Any, Dict, KeysView, List, Optional, Tuple
 
 from card_game_server.exceptions import (
+    GameError,
     PlayerNotInRoomError,
     RoomFullError,
 )
+from card_game_server.game import Game
+from card_game_server.metrics import TimedLock
+from card_game_server.models.identifiers import new_identifier
 from card_game_server.models.player import Player
+from card_game_server.snapshots import SnapshotSender
 
+# A message held back until the next tick: its sender, itself and its recipients
+Pending = Tuple[str, Any, List[Player]]
 
-class Room:
+
+class Room:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
 
     def __init__(
         self,
         capacity: int = 2,
         name: str = None,
+        identifier: str = None,
+        tick_rate: int = 0,
+        created_at: float = 0,
     ):
         """
         A room for playing a game.
+
+        The room's lock guards its membership, its messaging and its game.
+        It is acquired by `Rooms`, not by the room itself.
+
+        A room with a tick rate holds its messages back until its next tick,
+        see `card_game_server.ticks`. Its ticks fall every `1 / tick_rate`
+        seconds from the monotonic time it was created at.
         """
-        self._identifier: str = str(uuid4())
+        self._identifier: str = identifier if identifier else new_identifier()
         self._capacity: int = capacity
-        self._players: List[Player] = []
+        self._players: Dict[str, Player] = {}
         self._name: str = name if name else self._identifier
+        self._lock: TimedLock = TimedLock("room")
+        self._closed: bool = False
+        self._tick_rate: int = tick_rate
+        self._created_at: float = created_at
+        self._pending: List[Pending] = []
+        self._game: Optional[Game] = None
+        self._snapshots: Optional[SnapshotSender] = None
 
     def __eq__(self, other: 'Room'):
         return self._identifier == other._identifier
 
+    def __hash__(self) -> int:
+        return hash(self._identifier)
+
+    def __sizeof__(self) -> int:
+        # Players are not owned by the room, so they are not counted
+        return (
+            object.__sizeof__(self)
+            + sys.getsizeof(self.__dict__)
+            + sys.getsizeof(self._identifier)
+            + sys.getsizeof(self._name)
+            + sys.getsizeof(self._players)
+            + sys.getsizeof(self._lock)
+        )
+
     @property
     def identifier(self):
         return self._identifier
@@ -39,8 +79,82 @@ class Room:
         return self._capacity
 
     @property
-    def players(self):
-        return self._players
+    def players(self) -> List[Player]:
+        return list(self._players.values())
+
+    @property
+    def player_ids(self) -> KeysView[str]:
+        return self._players.keys()
+
+    @property
+    def n_players(self) -> int:
+        return len(self._players)
+
+    @property
+    def tick_rate(self) -> int:
+        return self._tick_rate
+
+    @property
+    def game(self) -> Optional[Game]:
+        """
+        Get the game of the room, or `None` if none was started.
+        """
+        return self._game
+
+    @property
+    def snapshots(self) -> SnapshotSender:
+        """
+        Get the versions of the game sent to the players of the room, see
+        `card_game_server.snapshots`.
+        """
+        if self._snapshots is None:
+            self._snapshots = SnapshotSender()
+        return self._snapshots
+
+    @property
+    def lock(self) -> TimedLock:
+        return self._lock
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        """
+        Marks the room as removed, so that nobody joins it anymore.
+        """
+        self._closed = True
+
+    def next_tick(self, now: float) -> float:
+        """
+        Get the monotonic time of the first tick after `now`.
+        """
+        interval = 1 / self._tick_rate
+        return self._created_at + (math.floor((now - self._created_at) / interval) + 1) * interval
+
+    def hold(self, sender_id: str, message: Any, recipients: List[Player]) -> int:
+        """
+        Holds a message back until the next tick. Returns how many messages
+        are held back.
+        """
+        self._pending.append((sender_id, message, recipients))
+        return len(self._pending)
+
+    def release(self) -> List[Pending]:
+        """
+        Returns the messages held back, oldest first, and forgets them.
+        """
+        pending = self._pending
+        self._pending = []
+        return pending
+
+    def start_game(self, game: Game) -> None:
+        """
+        Makes a game the game of the room, unless one is still going on.
+        """
+        if self._game is not None and not self._game.finished:
+            raise GameError("A game is already in progress")
+        self._game = game
 
     def is_full(self):
         """
@@ -54,11 +168,17 @@ class Room:
         """
         return len(self._players) == 0
 
+    def get_player(self, player_id: str) -> Player:
+        """
+        Get a player of the room by its identifier.
+        """
+        return self._players.get(player_id)
+
     def is_in_room(self, player: Player):
         """
         Check if a player is in the room.
         """
-        return player in self._players
+        return player.identifier in self._players
 
     def join(self, player: Player):
         """
@@ -66,12 +186,16 @@ class Room:
         """
         if self.is_full():
             raise RoomFullError()
-        self._players.append(player)
+        self._players[player.identifier] = player
 
     def leave(self, player: Player):
         """
         Remove a player from the room.
         """
-        if player not in self._players:
+        if player.identifier not in self._players:
             raise PlayerNotInRoomError()
-        self._players.remove(player)
+        del self._players[player.identifier]
+        if self._game is not None:
+            self._game.remove_player(player.identifier)
+        if self._snapshots is not None:
+            self._snapshots.forget(player.identifier)
@@ -1,18 +1,111 @@
+"""
+Registry of players and rooms.
+
+Concurrency rules:
+
+- The registry lock guards the registry itself: the player and room indexes
+  and the open rooms index. It is only ever held for a few dict operations,
+  never while sending anything.
+- Each room has its own lock, guarding its membership, its messaging and its
+  game.
+  Joins, leaves and messages in different rooms never wait on each other.
+- Locks are always taken in the order room lock, then registry lock. Code
+  holding the registry lock never tries to acquire a room lock.
+- Lookups (`get_player`, `get_room`, `room_ids`) take no lock: a single dict
+  read is atomic, so they see either the state before or after a concurrent
+  change, never a partial one.
+- Messages to a room are sent while holding its lock, so every member sees
+  them in the same order, a player never receives a message sent after it
+  left, and a player that joined receives every message sent after its join
+  returned.
+- A room removed from the registry is marked closed under its own lock, so a
+  join racing with the removal fails with `RoomNotFoundError` instead of
+  landing in a room nobody can find anymore.
+- Likewise, a player is only seated while the registry lock is held and it
+  is still registered, so a join racing with its eviction fails with
+  `PlayerNotFoundError` instead of leaving a seat nobody will ever free.
+- Messages held back until the tick of their room are sent by the tick
+  scheduler while holding the room lock too. The tick queue lock is only
+  ever taken last, with or without a room lock held.
+- Changes are appended to the journal, if any, while holding the registry
+  lock, so that they are journaled in the order they were made. The journal
+  lock is only ever taken last.
+"""
+
+import gc
+from collections import OrderedDict
+from time import monotonic
 from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    KeysView,
     List,
+    Optional,
+    Set,
     Tuple,
     Union,
 )
 
+from card_game_server.codec import JSON, Codec, get_codec
 from card_game_server.exceptions import (
+    GameNotFoundError,
     PlayerNotFoundError,
     PlayerNotInRoomError,
-    RoomFullError,
     RoomNotFoundError,
 )
+from card_game_server.fanout import FanOut
+from card_game_server.game import GAME_SENDER, Game, get_rules
+from card_game_server.journal import SNAPSHOT_CHUNK, Journal
+from card_game_server.listing import RoomListing
+from card_game_server.liveness import Liveness
+from card_game_server.lobby import Lobby
 from card_game_server.logger import log
+from card_game_server.metrics import TimedLock
+from card_game_server.models.identifiers import new_identifier, shard_of
 from card_game_server.models.player import Player
 from card_game_server.models.room import Room
+from card_game_server.reliable import ReliableChannels
+from card_game_server.ticks import MAX_TICK_MESSAGES, Ticks
+
+# Policies for picking a room when a player joins without a room ID:
+# - "fill" prefers the fullest open room, so games start sooner
+# - "spread" prefers the emptiest open room
+AUTOJOIN_POLICIES = ("fill", "spread")
+
+
+def _summarize(room: Room) -> dict:
+    return {
+        "id": room.identifier,
+        "name": room.name,
+        "n_players": room.n_players,
+        "capacity": room.capacity,
+        "tick_rate": room.tick_rate,
+    }
+
+
+def _player_record(player: Player) -> list:
+    """
+    Get what the journal keeps of a player, see `Rooms._restore_player`.
+    """
+    return [
+        player.identifier,
+        player.address,
+        player.requires_token,
+        player.udp_address,
+        player.codec.name,
+        player.token,
+        player.reliable,
+        player.batching,
+    ]
+
+
+def _room_record(room: Room) -> list:
+    """
+    Get what the journal keeps of a room, see `Rooms._restore_room`.
+    """
+    return [room.identifier, room.name, room.capacity, room.tick_rate, list(room.player_ids)]
 
 
 class Rooms:
@@ -20,34 +113,113 @@ class Rooms:
     def __init__(
         self,
         capacity: int = 2,
+        autojoin_policy: str = "fill",
+        shard: int = None,
+        liveness: Liveness = None,
+        journal: Journal = None,
     ):
         """
         Collection of rooms.
+
+        Players and rooms are indexed by their identifiers, so every lookup
+        is O(1) regardless of how many of them are registered. Rooms that
+        are not full are also bucketed by their number of free seats, so
+        joining without a room ID never walks over every room, and empty
+        rooms are kept in the order they became empty, so reclaiming them
+        never walks over every room either.
+
+        When the collection is one shard of a multi-process server, its
+        shard is encoded in every identifier it generates.
+
+        When a liveness tracker is given, the players registered here are
+        evicted by `reap` once they have been silent for too long.
+
+        When a journal is given, the players and rooms it holds are recovered
+        first, then every change is appended to it, see
+        `card_game_server.journal`.
         """
-        self._players: List[Player] = []
-        self._rooms: List[Room] = []
+        if autojoin_policy not in AUTOJOIN_POLICIES:
+            raise ValueError(f"Invalid autojoin policy: {autojoin_policy}")
+        self._players: Dict[str, Player] = {}
+        self._rooms: Dict[str, Room] = {}
         self._capacity: int = capacity
+        self._autojoin_policy: str = autojoin_policy
+        self._shard: int = shard
+        # Open rooms by number of free seats, and the bucket of each open room
+        self._open_rooms: List[Dict[str, Room]] = [
+            OrderedDict() for _ in range(capacity + 1)]
+        self._free_seats: Dict[str, int] = {}
+        # Empty rooms, oldest first, and the time they became empty at
+        self._empty_rooms: Dict[str, float] = OrderedDict()
+        # Rooms of each player, so that evicting it never walks over every room
+        self._memberships: Dict[str, Set[Room]] = {}
+        self._liveness: Liveness = liveness
+        self._fanout: FanOut = FanOut()
+        self._reliable: ReliableChannels = ReliableChannels(self._fanout)
+        self._ticks: Ticks = Ticks(self.flush)
+        # Bumped whenever a room is created, removed, joined or left
+        self._version: int = 0
+        self._listing: RoomListing = RoomListing(lambda: self._version, self.summarize)
+        # Called with the identifier of every room created, removed, joined
+        # or left, with the registry lock held
+        self._observers: List[Callable[[str], None]] = []
+        self._lobby: Lobby = Lobby(
+            self._fanout,
+            self.summarize_room,
+            self._listing.rooms,
+            lambda player_id: player_id in self._players,
+        )
+        self.observe(self._lobby.mark)
+        self._registry_lock: TimedLock = TimedLock("registry")
+        self._journal: Journal = None
+        if journal is not None:
+            self._recover(journal)
+            journal.open()
+            self._journal = journal
 
     @property
     def rooms(self) -> List[Room]:
         """
         Get all rooms.
         """
-        return self._rooms
+        with self._registry_lock:
+            return list(self._rooms.values())
 
     @property
-    def room_ids(self) -> List[str]:
+    def room_ids(self) -> KeysView[str]:
         """
         Get all room identifiers.
         """
-        return [room.identifier for room in self._rooms]
+        return self._rooms.keys()
 
     @property
     def players(self) -> List[Player]:
         """
         Get all players.
         """
-        return self._players
+        with self._registry_lock:
+            return list(self._players.values())
+
+    @property
+    def n_players(self) -> int:
+        """
+        Get the number of players.
+        """
+        return len(self._players)
+
+    @property
+    def n_rooms(self) -> int:
+        """
+        Get the number of rooms.
+        """
+        return len(self._rooms)
+
+    @property
+    def n_empty_rooms(self) -> int:
+        """
+        Get the number of empty rooms.
+        """
+        return len(self._empty_rooms)
 
     @property
     def capacity(self) -> int:
@@ -56,68 +228,483 @@ class Rooms:
         """
         return self._capacity
 
-    def get_player(self, player_id: str) -> Player:
+    @property
+    def shard(self) -> int:
+        """
+        Get the shard of this collection, if any.
+        """
+        return self._shard
+
+    @property
+    def fanout(self) -> FanOut:
+        """
+        Get the sender used to deliver messages to players.
+        """
+        return self._fanout
+
+    @property
+    def reliable(self) -> ReliableChannels:
+        """
+        Get the reliable channels of the players.
+        """
+        return self._reliable
+
+    @property
+    def ticks(self) -> Ticks:
         """
-        Get a player by its identifier.
+        Get the queue of the rooms waiting for their next tick.
+        """
+        return self._ticks
+
+    @property
+    def journal(self) -> Optional[Journal]:
+        return self._journal
+
+    @property
+    def version(self) -> int:
+        """
+        Get a number that changes whenever a room is created, removed,
+        joined or left.
+        """
+        return self._version
+
+    @property
+    def listing(self) -> RoomListing:
+        """
+        Get the cached listing of the rooms, as served by `get_rooms`.
+        """
+        return self._listing
+
+    @property
+    def lobby(self) -> Lobby:
         """
-        for player in self._players:
-            if player.identifier == player_id:
-                return player
+        Get the subscribers of the lobby.
+        """
+        return self._lobby
+
+    @property
+    def liveness(self) -> Liveness:
+        """
+        Get the liveness tracker of the players, if any.
+        """
+        return self._liveness
+
+    @property
+    def autojoin_policy(self) -> str:
+        """
+        Get the policy used to pick a room when joining without a room ID.
+        """
+        return self._autojoin_policy
+
+    def _index_room(self, room: Room) -> None:
+        """
+        Moves a room to the bucket matching its number of free seats, and
+        tracks whether it is empty. Must be called with the registry lock
+        held whenever its number of players changes.
+        """
+        free_seats = room.capacity - room.n_players
+        current = self._free_seats.get(room.identifier)
+        if current == free_seats:
+            return
+        self._version += 1
+        for observer in self._observers:
+            observer(room.identifier)
+        if room.n_players == 0:
+            self._empty_rooms.setdefault(room.identifier, monotonic())
+        else:
+            self._empty_rooms.pop(room.identifier, None)
+        if current is not None:
+            del self._open_rooms[current][room.identifier]
+            del self._free_seats[room.identifier]
+        if free_seats > 0:
+            while free_seats >= len(self._open_rooms):
+                self._open_rooms.append(OrderedDict())
+            self._open_rooms[free_seats][room.identifier] = room
+            self._free_seats[room.identifier] = free_seats
+        if self._journal is not None:
+            self._journal.append(["room", _room_record(room)])
+
+    def _unindex_room(self, room: Room) -> None:
+        """
+        Removes a room from the open rooms and empty rooms indexes. Must be
+        called with the registry lock held.
+        """
+        self._version += 1
+        for observer in self._observers:
+            observer(room.identifier)
+        self._empty_rooms.pop(room.identifier, None)
+        current = self._free_seats.pop(room.identifier, None)
+        if current is not None:
+            del self._open_rooms[current][room.identifier]
+        if self._journal is not None:
+            self._journal.append(["remove", room.identifier])
+
+    def _get_open_room(self) -> Room:
+        """
+        Implements `get_open_room`. Must be called with the registry lock
+        held.
+        """
+        seats = range(1, len(self._open_rooms))
+        if self._autojoin_policy == "spread":
+            seats = reversed(seats)
+        for free_seats in seats:
+            bucket = self._open_rooms[free_seats]
+            if bucket:
+                return next(iter(bucket.values()))
         return None
 
+    def _add_room(self, room_name: str = None, tick_rate: int = 0) -> Room:
+        """
+        Creates a room and adds it to the registry. Must be called with the
+        registry lock held.
+        """
+        room = self._new_room(room_name, tick_rate)
+        self._rooms[room.identifier] = room
+        self._index_room(room)
+        return room
+
+    def _new_room(self, room_name: str = None, tick_rate: int = 0) -> Room:
+        return Room(
+            capacity=self._capacity,
+            name=room_name,
+            identifier=new_identifier(self._shard),
+            tick_rate=tick_rate,
+            created_at=monotonic(),
+        )
+
+    def _recover(self, journal: Journal) -> None:
+        """
+        Rebuilds the registry from the records of a journal.
+        """
+        start = monotonic()
+        # Recovering creates millions of objects that all live on, which
+        # would only make the garbage collector walk over them again and again
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._replay(journal)
+        finally:
+            if collecting:
+                gc.enable()
+        log("Recovered {} players and {} rooms from {} in {:.2f}s", "info",
+            len(self._players), len(self._rooms), journal.directory, monotonic() - start)
+
+    def _replay(self, journal: Journal) -> None:
+        """
+        Implements `_recover`.
+        """
+        with self._registry_lock:
+            for operation, value in journal.recover():
+                if operation == "players":
+                    for record in value:
+                        self._restore_player(record)
+                elif operation == "player":
+                    self._restore_player(value)
+                elif operation == "unregister":
+                    self._forget_player(value)
+                elif operation == "rooms":
+                    for record in value:
+                        self._restore_room(record)
+                elif operation == "room":
+                    self._restore_room(value)
+                elif operation == "remove":
+                    self._remove_room(value)
+                else:
+                    raise ValueError(f"Unknown journal record: {operation}")
+
+    def _restore_player(self, record: list) -> None:
+        """
+        Adds a player from the journal, unless it is already known. Players
+        registered by this shard are tracked for liveness again, as if they
+        were just seen.
+        """
+        (identifier, address, requires_token, udp_address, codec, token, reliable,
+         batching) = record
+        if identifier in self._players:
+            return
+        self._players[identifier] = Player(
+            tuple(address) if address else address,
+            None if requires_token else udp_address[1],
+            get_codec(codec),
+            identifier=identifier,
+            reliable=reliable,
+            token=token,
+            udp_address=tuple(udp_address) if udp_address else None,
+            batching=batching,
+        )
+        if self._liveness is not None and (
+                self._shard is None or shard_of(identifier) == self._shard):
+            self._liveness.track(identifier)
+
+    def _forget_player(self, player_id: str) -> None:
+        """
+        Removes a player the journal says was unregistered, along with its
+        seats.
+        """
+        player = self._players.pop(player_id, None)
+        if player is None:
+            return
+        if self._liveness is not None:
+            self._liveness.forget(player_id)
+        for room in self._memberships.pop(player_id, ()):
+            if room.is_in_room(player):
+                room.leave(player)
+                self._index_room(room)
+
+    def _restore_room(self, record: list) -> None:
+        """
+        Adds a room from the journal, or updates it, so that it seats the
+        players of the record that are still registered.
+        """
+        identifier, name, capacity, tick_rate, player_ids = record
+        room = self._rooms.get(identifier)
+        if room is None:
+            room = self._rooms[identifier] = Room(
+                capacity=capacity,
+                name=name,
+                identifier=identifier,
+                tick_rate=tick_rate,
+                created_at=monotonic(),
+            )
+        elif room.n_players:
+            seated = set(player_ids)
+            for player in room.players:
+                if player.identifier not in seated:
+                    room.leave(player)
+                    rooms = self._memberships.get(player.identifier)
+                    if rooms is not None:
+                        rooms.discard(room)
+                        if not rooms:
+                            del self._memberships[player.identifier]
+        players = self._players
+        memberships = self._memberships
+        for player_id in player_ids:
+            player = players.get(player_id)
+            if player is None or room.is_in_room(player) or room.is_full():
+                continue
+            room.join(player)
+            rooms = memberships.get(player_id)
+            if rooms is None:
+                memberships[player_id] = {room}
+            else:
+                rooms.add(room)
+        self._index_room(room)
+
+    def _remove_room(self, room_id: str) -> None:
+        """
+        Removes a room the journal says was reclaimed.
+        """
+        room = self._rooms.pop(room_id, None)
+        if room is None:
+            return
+        room.close()
+        self._unindex_room(room)
+        for player in room.players:
+            rooms = self._memberships.get(player.identifier)
+            if rooms is not None:
+                rooms.discard(room)
+
+    def checkpoint(self) -> int:
+        """
+        Writes a snapshot of the registry to the journal, which from then on
+        only needs the changes made after it, and returns how many records it
+        holds. The registry keeps changing while the snapshot is written:
+        changes made meanwhile are in both, and replaying them over it
+        changes nothing.
+        """
+        if self._journal is None:
+            raise ValueError("Rooms has no journal")
+        segment = self._journal.rotate(self._registry_lock)
+        return self._journal.write_snapshot(segment, self._snapshot_records())
+
+    def _snapshot_records(self) -> Iterator[list]:
+        """
+        Yields the records of a snapshot of the registry, players first, a
+        chunk of them at a time. Takes no lock.
+        """
+        players = list(self._players.values())
+        for start in range(0, len(players), SNAPSHOT_CHUNK):
+            yield ["players", [
+                _player_record(player) for player in players[start:start + SNAPSHOT_CHUNK]]]
+        rooms = list(self._rooms.values())
+        for start in range(0, len(rooms), SNAPSHOT_CHUNK):
+            yield ["rooms", [
+                _room_record(room) for room in rooms[start:start + SNAPSHOT_CHUNK]]]
+
+    def observe(self, observer: Callable[[str], None]) -> None:
+        """
+        Adds a function called with the identifier of every room created,
+        removed, joined or left. It is called with the registry lock held,
+        so it must be quick and must not call back into the registry.
+        """
+        self._observers.append(observer)
+
+    def summarize(self) -> List[dict]:
+        """
+        Get the summary of every room, oldest first, as listed by
+        `get_rooms`.
+        """
+        return [_summarize(room) for room in self.rooms]
+
+    def summarize_room(self, room_id: str) -> Optional[dict]:
+        """
+        Get the summary of a room, or `None` if it does not exist.
+        """
+        room = self.get_room(room_id)
+        if room is None or room.closed:
+            return None
+        return _summarize(room)
+
+    def get_open_room(self) -> Room:
+        """
+        Get an open room according to the autojoin policy, or `None` if
+        every room is full.
+        """
+        with self._registry_lock:
+            return self._get_open_room()
+
+    def get_player(self, player_id: str) -> Player:
+        """
+        Get a player by its identifier, which may come straight from a client
+        and so be of any type.
+        """
+        if not isinstance(player_id, str):
+            return None
+        return self._players.get(player_id)
+
     def get_any_room(self, room_id: str = None) -> Room:
         """
         Get a room by its identifier.
         """
         # Try to match room ID
-        for room in self._rooms:
-            if room.identifier == room_id:
-                return room
+        room = self.get_room(room_id)
+        if room is not None:
+            return room
 
-        # Try to find any not full room
-        for room in self._rooms:
-            if not room.is_full():
+        with self._registry_lock:
+            # Try to find any not full room
+            room = self._get_open_room()
+            if room is not None:
                 return room
 
-        # Create a new room
-        room = Room(capacity=self._capacity)
-        self._rooms.append(room)
-        return room
+            # Create a new room
+            return self._add_room()
 
     def get_room(self, room_id: str = None) -> Room:
         """
-        Get a room by its identifier.
+        Get a room by its identifier, which may come straight from a client
+        and so be of any type.
         """
-        # Try to match room ID
-        for room in self._rooms:
-            if room.identifier == room_id:
-                return room
-        return None
+        if not isinstance(room_id, str):
+            return None
+        return self._rooms.get(room_id)
 
-    def register(
+    def register(  # pylint: disable=too-many-arguments
         self,
         address: Tuple[str, int],
-        udp_port: Union[int, str],
+        udp_port: Union[int, str, None],
+        codec: Codec = JSON,
+        reliable: bool = False,
+        batching: bool = False,
     ) -> Player:
         """
-        Register a player.
+        Register a player. Players registered without a UDP port are reached
+        wherever their datagrams come from, see `Player.learn_address`.
         """
         player = Player(
             address,
             udp_port,
+            codec,
+            identifier=new_identifier(self._shard),
+            reliable=reliable,
+            batching=batching,
         )
-        found = False
-        # for registered_player in self._players:
-        #     if player.address == registered_player.address:
-        #         player = registered_player
-        #         found = True
-        #         break
+        with self._registry_lock:
+            self._players[player.identifier] = player
+            if self._journal is not None:
+                self._journal.append(["player", _player_record(player)])
+        if self._liveness is not None:
+            self._liveness.track(player.identifier)
+        return player
 
-        if not found:
-            self._players.append(player)
+    def adopt(self, player: Player) -> Player:
+        """
+        Adds a player registered somewhere else, e.g. by another shard. If a
+        player with the same identifier is already known, it is kept.
+        Adopted players are not tracked for liveness, evicting them is up to
+        the place they were registered at.
+        """
+        with self._registry_lock:
+            known = self._players.setdefault(player.identifier, player)
+            if known is player and self._journal is not None:
+                self._journal.append(["player", _player_record(player)])
+            return known
 
+    def unregister(self, player_id: str) -> Player:
+        """
+        Removes a player from every room it is in, then from the registry.
+        Returns the player, or `None` if it was not registered.
+        """
+        with self._registry_lock:
+            player = self._players.pop(player_id, None)
+            rooms = self._memberships.pop(player_id, ())
+            if player is not None and self._journal is not None:
+                self._journal.append(["unregister", player_id])
+        if player is None:
+            return None
+        if self._liveness is not None:
+            self._liveness.forget(player_id)
+        self._reliable.forget(player_id)
+        for room in rooms:
+            with room.lock:
+                if room.is_in_room(player):
+                    room.leave(player)
+                    with self._registry_lock:
+                        self._index_room(room)
+                    if room.game is not None:
+                        self._publish_game(room)
         return player
 
+    def touch(self, player_id: str) -> None:
+        """
+        Records that a player was just heard from.
+        """
+        if self._liveness is not None:
+            self._liveness.touch(player_id)
+
+    def reap(self) -> List[str]:
+        """
+        Advances the liveness tracker by one tick and evicts every player
+        that timed out. Returns their identifiers.
+        """
+        if self._liveness is None:
+            return []
+        evicted = self._liveness.advance()
+        for player_id in evicted:
+            self.unregister(player_id)
+        return evicted
+
+    def _seat(self, player: Player, room: Room) -> None:
+        """
+        Adds a player to a room, as long as it is still registered. Must be
+        called with the registry lock held, and with the room lock held too
+        if anybody else can see the room.
+        """
+        if self._players.get(player.identifier) is not player:
+            raise PlayerNotFoundError()
+        room.join(player)
+        self._index_room(room)
+        self._memberships.setdefault(player.identifier, set()).add(room)
+
+    def _join_room(self, player: Player, room: Room) -> None:
+        """
+        Adds a player to a room. Must be called with the room lock held.
+        """
+        if room.closed:
+            raise RoomNotFoundError()
+        with self._registry_lock:
+            self._seat(player, room)
+
     def join(
         self,
         player_id: str,
@@ -133,12 +720,19 @@ class Rooms:
             room = self.get_room(room_id)
             if room is None:
                 raise RoomNotFoundError()
-            if room.is_full():
-                raise RoomFullError()
-        else:
-            room = self.get_any_room(room_id)
-        room.join(player)
-        return room
+            with room.lock:
+                self._join_room(player, room)
+            return room
+
+        # Another player may take the last seat between picking a room and
+        # locking it, in which case we just pick again
+        while True:
+            room = self.get_any_room()
+            with room.lock:
+                if room.closed or room.is_full():
+                    continue
+                self._join_room(player, room)
+                return room
 
     def leave(
         self,
@@ -154,53 +748,120 @@ class Rooms:
         room = self.get_room(room_id)
         if room is None:
             raise RoomNotFoundError()
-        if player not in room.players:
-            raise PlayerNotInRoomError()
-        room.leave(player)
+        with room.lock:
+            if not room.is_in_room(player):
+                raise PlayerNotInRoomError()
+            room.leave(player)
+            with self._registry_lock:
+                self._index_room(room)
+                rooms = self._memberships.get(player_id)
+                if rooms is not None:
+                    rooms.discard(room)
+                    if not rooms:
+                        del self._memberships[player_id]
+            if room.game is not None:
+                self._publish_game(room)
+        self._reliable.forget_channel(player_id, room_id)
         return room
 
-    def create(self, room_name: str = None) -> Room:
+    def create(
+        self,
+        room_name: str = None,
+        player_id: str = None,
+        tick_rate: int = 0,
+    ) -> Room:
         """
-        Creates a new room.
+        Creates a new room, which holds its messages back until its next
+        tick if it has a tick rate. If a player is given, it joins the room
+        before anybody else can see it. Raises `ValueError` if the name is
+        not a string.
         """
-        room = Room(
-            capacity=self._capacity,
-            name=room_name,
-        )
-        self._rooms.append(room)
+        if room_name is not None and not isinstance(room_name, str):
+            raise ValueError(f"Invalid room name: {room_name!r}")
+        if player_id is None:
+            with self._registry_lock:
+                return self._add_room(room_name, tick_rate)
+        player = self.get_player(player_id)
+        if player is None:
+            raise PlayerNotFoundError()
+        room = self._new_room(room_name, tick_rate)
+        with self._registry_lock:
+            self._seat(player, room)
+            self._rooms[room.identifier] = room
         return room
 
+    def reclaim(self, limit: int = None, grace: float = 0) -> List[Room]:
+        """
+        Removes up to `limit` rooms that have been empty for at least `grace`
+        seconds, oldest first, and returns them. Only looks at the rooms it
+        removes, so its cost does not depend on how many rooms there are.
+        """
+        deadline = monotonic() - grace
+        reclaimed = []
+        while limit is None or len(reclaimed) < limit:
+            with self._registry_lock:
+                if not self._empty_rooms:
+                    break
+                room_id, since = next(iter(self._empty_rooms.items()))
+                if since > deadline:
+                    break
+                room = self._rooms[room_id]
+            with room.lock:
+                with self._registry_lock:
+                    # Somebody may have joined, or the room may have been
+                    # emptied again, since we looked at it
+                    if self._empty_rooms.get(room_id) != since or not room.is_empty():
+                        continue
+                    room.close()
+                    self._unindex_room(room)
+                    del self._rooms[room_id]
+            reclaimed.append(room)
+        return reclaimed
+
     def clear_empty_rooms(self) -> None:
         """
         Remove all empty rooms.
         """
-        for room in self._rooms:
-            if room.is_empty():
-                self._rooms.remove(room)
+        self.reclaim()
 
     def send(
         self,
         player_id: str,
         room_id: str,
-        message: str
+        message: str,
+        reliable: bool = False,
     ):
         """
-        Send a message to a room.
+        Send a message to a room, through its reliable channel if asked to.
         """
         room = self.get_room(room_id)
         if room is None:
             raise RoomNotFoundError()
-        self.sendto(player_id, room_id, room.players, message)
+        player = self.get_player(player_id)
+        if player is None:
+            raise PlayerNotFoundError()
+        with room.lock:
+            if not room.is_in_room(player):
+                raise PlayerNotInRoomError()
+            if reliable:
+                self._reliable.send(player_id, room_id, message, room.players)
+            elif room.tick_rate:
+                self._hold(room, player_id, message, room.players)
+            else:
+                self._fanout.send(player_id, message, room.players)
 
     def sendto(
         self,
         player_id: str,
         room_id: str,
-        recipients: Union[List[Player], Player],
+        recipients: Union[Iterable[Union[Player, str]], Player, str],
         message: str,
+        reliable: bool = False,
     ):
         """
-        Send a message to a player.
+        Send a message to a player, through the reliable channel of the room
+        if asked to. Recipients may be given either as players or as player
+        identifiers.
         """
         room = self.get_room(room_id)
         if room is None:
@@ -208,13 +869,141 @@ class Rooms:
         player = self.get_player(player_id)
         if player is None:
             raise PlayerNotFoundError()
-        if player not in room.players:
-            raise PlayerNotInRoomError()
-        if isinstance(recipients, str):
-            recipients: List[Player] = [recipients]
-        recipient_ids = [recipient.identifier for recipient in recipients]
-        for player in room.players:
-            if player.identifier in recipient_ids:
-                log(
-                    f"Sending message to {player.udp_address}", "debug")
-                player.send_udp(player_id, message)
+        if isinstance(recipients, (str, Player)):
+            recipients = [recipients]
+        recipient_ids = {
+            recipient.identifier if isinstance(recipient, Player) else recipient
+            for recipient in recipients
+        }
+        with room.lock:
+            if not room.is_in_room(player):
+                raise PlayerNotInRoomError()
+            targets = []
+            for recipient_id in recipient_ids:
+                target = room.get_player(recipient_id)
+                if target is not None:
+                    targets.append(target)
+            if reliable:
+                self._reliable.send(player_id, room_id, message, targets)
+            elif room.tick_rate:
+                self._hold(room, player_id, message, targets)
+            else:
+                self._fanout.send(player_id, message, targets)
+
+    def _hold(
+        self,
+        room: Room,
+        player_id: str,
+        message: str,
+        recipients: List[Player],
+    ) -> None:
+        """
+        Holds a message back until the next tick of its room, or sends every
+        message held back right away if there are too many. Must be called
+        with the room lock held.
+        """
+        held = room.hold(player_id, message, recipients)
+        if held >= MAX_TICK_MESSAGES:
+            self._fanout.send_batch(room.release())
+        elif held == 1:
+            self._ticks.schedule(room.identifier, room.next_tick(monotonic()))
+
+    def _get_member_room(self, player_id: str, room_id: str) -> Tuple[Player, Room]:
+        """
+        Get a player and a room, which must both exist. Whether the player
+        is in the room must be checked with the room lock held.
+        """
+        room = self.get_room(room_id)
+        if room is None:
+            raise RoomNotFoundError()
+        player = self.get_player(player_id)
+        if player is None:
+            raise PlayerNotFoundError()
+        return player, room
+
+    def start_game(
+        self,
+        player_id: str,
+        room_id: str,
+        rules: str,
+        options: dict = None,
+    ) -> dict:
+        """
+        Starts a game between the players of a room, see
+        `card_game_server.game`, and returns it as seen by the player.
+        """
+        player, room = self._get_member_room(player_id, room_id)
+        with room.lock:
+            if not room.is_in_room(player):
+                raise PlayerNotInRoomError()
+            game = Game(get_rules(rules), list(room.player_ids), options)
+            room.start_game(game)
+            self._publish_game(room, player_id)
+            return game.view(player_id)
+
+    def play(self, player_id: str, room_id: str, move: object) -> dict:
+        """
+        Makes a move in the game of a room, and returns the game as seen by
+        the player.
+        """
+        player, room = self._get_member_room(player_id, room_id)
+        with room.lock:
+            if not room.is_in_room(player):
+                raise PlayerNotInRoomError()
+            game = room.game
+            if game is None:
+                raise GameNotFoundError()
+            game.play(player_id, move)
+            self._publish_game(room, player_id)
+            return game.view(player_id)
+
+    def get_game(self, player_id: str, room_id: str) -> dict:
+        """
+        Get the game of a room as seen by a player.
+        """
+        player, room = self._get_member_room(player_id, room_id)
+        with room.lock:
+            if not room.is_in_room(player):
+                raise PlayerNotInRoomError()
+            if room.game is None:
+                raise GameNotFoundError()
+            return room.game.view(player_id)
+
+    def acknowledge_game(self, player_id: str, room_id: str, version: int) -> bool:
+        """
+        Records that a player applied a version of the game of a room, from
+        which the next views it is sent are deltas, see
+        `card_game_server.snapshots`. Returns whether the version was known.
+        """
+        player, room = self._get_member_room(player_id, room_id)
+        with room.lock:
+            if not room.is_in_room(player):
+                raise PlayerNotInRoomError()
+            return room.snapshots.acknowledge(player_id, version)
+
+    def _publish_game(self, room: Room, player_id: str = None) -> None:
+        """
+        Sends every player of a room, but the one given, its own view of the
+        game of the room, as a delta from the last version it acknowledged.
+        Must be called with the room lock held.
+        """
+        game = room.game
+        snapshots = room.snapshots
+        self._fanout.transmit([
+            (player.codec.encode({
+                GAME_SENDER: snapshots.update(player.identifier, game.view(player.identifier)),
+            }), player.udp_address)
+            for player in room.players
+            if player.identifier != player_id
+        ])
+
+    def flush(self, room_id: str) -> int:
+        """
+        Sends the messages a room held back until its tick, and returns how
+        many datagrams were sent.
+        """
+        room = self.get_room(room_id)
+        if room is None:
+            return 0
+        with room.lock:
+            return self._fanout.send_batch(room.release())
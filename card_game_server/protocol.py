@@ -0,0 +1,89 @@
+"""
+Wire protocol for persistent TCP sessions.
+
+A client opens a session by sending `SESSION_MAGIC` right after connecting.
+After that, both sides exchange frames made of a 4-byte big-endian length
+followed by a message encoded with any codec from `card_game_server.codec`,
+and the connection stays open for as many requests as the client wants.
+Requests carry a `request_id` that is echoed back in the matching reply, so
+several requests may be in flight at once and replies may arrive in any
+order. Replies are encoded with the same codec as their request.
+
+Connections that do not start with `SESSION_MAGIC` are handled in the legacy
+one-shot mode: a single JSON request, a single reply, then the server closes
+the connection.
+
+UDP datagrams carry exactly one message each, so they need no framing.
+"""
+
+import struct
+from typing import Any, List, Optional, Tuple
+
+from card_game_server.codec import JSON, Codec, sniff
+from card_game_server.exceptions import ProtocolError
+
+SESSION_MAGIC = b"CGS\x02"
+
+# Largest frame accepted from a peer before dropping the session
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Largest legacy one-shot request accepted before giving up on it
+MAX_REQUEST_SIZE = 64 * 1024
+
+# Largest datagram we expect to receive
+MAX_DATAGRAM_SIZE = 65535
+
+_HEADER = struct.Struct(">I")
+
+
+def session_preamble(data: bytes) -> Optional[bool]:
+    """
+    Tells whether the first bytes of a connection open a session. Returns
+    `None` while there are not enough bytes to decide.
+    """
+    if data.startswith(SESSION_MAGIC):
+        return True
+    if SESSION_MAGIC.startswith(data):
+        return None
+    return False
+
+
+def encode_frame(data: Any, codec: Codec = JSON) -> bytes:
+    """
+    Encodes a single frame.
+    """
+    body = codec.encode(data)
+    return _HEADER.pack(len(body)) + body
+
+
+class FrameDecoder:
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        """
+        Incremental decoder for a stream of frames.
+        """
+        self._buffer: bytearray = bytearray()
+        self._max_frame_size: int = max_frame_size
+
+    def feed(self, data: bytes) -> List[Tuple[Any, Codec]]:
+        """
+        Adds bytes read from the stream and returns every complete frame,
+        along with the codec it was encoded with.
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= _HEADER.size:
+            (size,) = _HEADER.unpack_from(buffer, offset)
+            if size > self._max_frame_size:
+                raise ProtocolError("Frame too large")
+            end = offset + _HEADER.size + size
+            if end > len(buffer):
+                break
+            body = bytes(buffer[offset + _HEADER.size:end])
+            codec = sniff(body)
+            frames.append((codec.decode(body), codec))
+            offset = end
+        del buffer[:offset]
+        return frames
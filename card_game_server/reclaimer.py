@@ -0,0 +1,79 @@
+"""
+Scheduled reclamation of empty rooms.
+
+`Rooms` keeps its empty rooms in the order they became empty, so each pass
+only looks at the rooms it actually removes. A room is only removed after it
+has stayed empty for a grace period, so a player that leaves and comes right
+back does not get its room torn down and created again, and each pass
+removes a bounded number of rooms, so it never holds the registry for long.
+"""
+
+import sys
+from threading import Event, Thread
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from card_game_server.logger import log
+from card_game_server.metrics import METRICS
+
+if TYPE_CHECKING:
+    from card_game_server.models.rooms import Rooms  # pylint: disable=cyclic-import
+
+# Defaults for the seconds between passes, the seconds a room must have been
+# empty for, and the largest number of rooms removed per pass
+RECLAIM_INTERVAL = 5.0
+RECLAIM_GRACE = 30.0
+RECLAIM_BATCH = 1000
+
+
+class Reclaimer(Thread):
+
+    def __init__(
+        self,
+        rooms: "Rooms",
+        interval: float = RECLAIM_INTERVAL,
+        grace: float = RECLAIM_GRACE,
+        batch: int = RECLAIM_BATCH,
+    ):
+        """
+        Removes the rooms that have been empty for `grace` seconds, at most
+        `batch` of them every `interval` seconds.
+        """
+        super().__init__(daemon=True)
+        if interval <= 0 or grace < 0 or batch < 1:
+            raise ValueError(
+                f"Invalid interval {interval}, grace {grace} or batch {batch}")
+        self._rooms: "Rooms" = rooms
+        self._interval: float = interval
+        self._grace: float = grace
+        self._batch: int = batch
+        self._stopped: Event = Event()
+
+    def reclaim(self) -> int:
+        """
+        Runs a single pass and returns how many rooms it removed.
+        """
+        reclaimed = self._rooms.reclaim(self._batch, self._grace)
+        if reclaimed:
+            freed = sum(sys.getsizeof(room) for room in reclaimed)
+            METRICS.rooms_reclaimed.inc(len(reclaimed))
+            METRICS.reclaimed_bytes.inc(freed)
+            log("Reclaimed {} empty rooms ({} bytes)", "debug", len(reclaimed), freed)
+        return len(reclaimed)
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        deadline = monotonic()
+        while True:
+            deadline += self._interval
+            if self._stopped.wait(max(0, deadline - monotonic())):
+                break
+            self.reclaim()
+
+    def stop(self):
+        """
+        Stop the reclaimer.
+        """
+        self._stopped.set()
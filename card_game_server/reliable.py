@@ -0,0 +1,543 @@
+"""
+Reliable, ordered delivery over UDP.
+
+Reliable messages go through channels, one per room and direction, within the
+session of a player, from its registration to its eviction. Each channel
+numbers its messages from 1 and delivers them in order independently of the
+other channels, so a lost datagram only holds back the messages of its own
+room, never those of the other rooms as a TCP connection would. Unreliable
+datagrams keep working as before, for state that is cheaper to send again
+than to acknowledge, such as cursors or typing indicators.
+
+A client opts in by registering with `"reliable": True`, and the reply tells
+whether the server supports it. It then sends `send` and `sendto` datagrams
+with `epoch` and `seq` fields, which the server acknowledges with:
+
+    {"ack": {"channel": room_id, "epoch": 1, "seq": 12, "sack": [[14, 15], [18, 18]]}}
+
+`seq` acknowledges every message up to it and `sack` the ranges received past
+it, so the sender only retransmits what was actually lost. Reliable messages
+from the server come as:
+
+    {"reliable": {"channel": room_id, "epoch": 1, "seq": 3, "sender": player_id,
+                  "message": ...}}
+
+and are acknowledged by the client with an `ack` action, with a payload of
+`{"epoch": ..., "seq": ..., "sack": [...]}`, on the `room_id` of the channel.
+Players that did not opt in get the messages of reliable channels as plain
+datagrams. A sender that starts a channel over, e.g. after giving up on it,
+numbers it from 1 again under a greater epoch, which resets the receiving
+side.
+
+Retransmission timers follow RFC 6298: the timeout is derived from the
+smoothed round-trip time and its variation, only measured on messages that
+were never retransmitted. Each message has its own timer, doubled on each of
+its timeouts, so a lost message never slows down the others. A channel is
+dropped after `MAX_RETRANSMISSIONS` timeouts of the same message.
+"""
+
+from collections import deque
+from itertools import count
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from card_game_server.fanout import FanOut
+from card_game_server.logger import log
+from card_game_server.metrics import METRICS
+from card_game_server.models.player import Player
+
+# Senders of the acknowledgements and reliable messages, as seen by clients
+ACK_SENDER = "ack"
+RELIABLE_SENDER = "reliable"
+
+# Bounds of the retransmission timeout, in seconds. RFC 6298 starts at one
+# second, far too long for a game
+INITIAL_RTO = 0.25
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+
+# Resolution of the retransmission timers, in seconds
+RETRANSMIT_TICK = 0.01
+
+# Timeouts of the same message before giving up on its channel
+MAX_RETRANSMISSIONS = 8
+
+# Most messages in flight, and held for reordering, on a channel
+WINDOW = 256
+
+# Most ranges reported by a selective acknowledgement
+MAX_SACK_RANGES = 16
+
+
+def parse_seq(value: Any) -> int:
+    """
+    Validates a sequence number.
+    """
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError(f"Invalid sequence number: {value!r}")
+    return value
+
+
+def parse_sack(value: Any) -> List[Tuple[int, int]]:
+    """
+    Validates the ranges of a selective acknowledgement.
+    """
+    if value is None:
+        return []
+    if not isinstance(value, list) or len(value) > MAX_SACK_RANGES:
+        raise ValueError(f"Invalid selective acknowledgement: {value!r}")
+    ranges = []
+    for bounds in value:
+        if not isinstance(bounds, list) or len(bounds) != 2:
+            raise ValueError(f"Invalid selective acknowledgement: {value!r}")
+        start, end = parse_seq(bounds[0]), parse_seq(bounds[1])
+        if end < start or end - start >= WINDOW:
+            raise ValueError(f"Invalid selective acknowledgement: {value!r}")
+        ranges.append((start, end))
+    return ranges
+
+
+class RttEstimator:
+
+    def __init__(self):
+        """
+        Round-trip time estimator of RFC 6298, giving the retransmission
+        timeout.
+        """
+        self._srtt: Optional[float] = None
+        self._rttvar: float = 0
+        self._rto: float = INITIAL_RTO
+
+    @property
+    def rto(self) -> float:
+        return self._rto
+
+    @property
+    def srtt(self) -> Optional[float]:
+        return self._srtt
+
+    def sample(self, rtt: float) -> None:
+        """
+        Records the round-trip time of a message sent only once.
+        """
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        self._rto = min(MAX_RTO, max(
+            MIN_RTO, self._srtt + max(RETRANSMIT_TICK, 4 * self._rttvar)))
+
+    def backoff(self, retransmissions: int) -> float:
+        """
+        Get the timeout of a message retransmitted that many times.
+        """
+        return min(MAX_RTO, self._rto * 2 ** retransmissions)
+
+
+class _InFlight:  # pylint: disable=too-few-public-methods
+
+    __slots__ = ("data", "sent_at", "deadline", "retransmissions")
+
+    def __init__(self, data: bytes, sent_at: float, deadline: float):
+        self.data: bytes = data
+        self.sent_at: float = sent_at
+        self.deadline: float = deadline
+        self.retransmissions: int = 0
+
+
+class SendWindow:
+
+    def __init__(self, rtt: RttEstimator, epoch: int):
+        """
+        Sending side of a channel. Holds every message until it is
+        acknowledged, with at most `WINDOW` of them in flight, the others
+        waiting for room.
+        """
+        self._rtt: RttEstimator = rtt
+        self._epoch: int = epoch
+        self._next_seq: int = 1
+        self._in_flight: Dict[int, _InFlight] = {}
+        self._waiting: Deque[Tuple[int, bytes]] = deque()
+
+    def __len__(self) -> int:
+        return len(self._in_flight) + len(self._waiting)
+
+    @property
+    def epoch(self) -> int:
+        return self._epoch
+
+    def send(self, encode: Callable[[int, int], bytes], now: float) -> Optional[bytes]:
+        """
+        Numbers a message, given the function encoding it with its epoch and
+        sequence number. Returns the datagram to send right away, or `None`
+        if the window is full.
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+        data = encode(self._epoch, seq)
+        if len(self._in_flight) >= WINDOW:
+            self._waiting.append((seq, data))
+            return None
+        self._in_flight[seq] = _InFlight(data, now, now + self._rtt.rto)
+        return data
+
+    def acknowledge(
+        self,
+        epoch: int,
+        seq: int,
+        sack: List[Tuple[int, int]],
+        now: float,
+    ) -> List[bytes]:
+        """
+        Forgets the messages acknowledged, and returns the datagrams of the
+        waiting messages that now fit in the window. Acknowledgements of
+        another epoch are ignored.
+        """
+        if epoch != self._epoch:
+            return []
+        newest_seq, newest_sent_at = 0, None
+        for acked in [acked for acked in self._in_flight if acked <= seq or any(
+                start <= acked <= end for start, end in sack)]:
+            message = self._in_flight.pop(acked)
+            # Karn's algorithm: retransmitted messages tell nothing of the RTT
+            if message.retransmissions == 0 and acked > newest_seq:
+                newest_seq, newest_sent_at = acked, message.sent_at
+        if newest_sent_at is not None:
+            self._rtt.sample(now - newest_sent_at)
+        sent = []
+        while self._waiting and len(self._in_flight) < WINDOW:
+            waiting_seq, data = self._waiting.popleft()
+            self._in_flight[waiting_seq] = _InFlight(data, now, now + self._rtt.rto)
+            sent.append(data)
+        return sent
+
+    def due(self, now: float) -> Optional[List[bytes]]:
+        """
+        Returns the datagrams to send again because their timer expired, or
+        `None` if one of them was retransmitted too many times already.
+        """
+        expired = [message for message in self._in_flight.values() if message.deadline <= now]
+        for message in expired:
+            if message.retransmissions >= MAX_RETRANSMISSIONS:
+                return None
+            message.retransmissions += 1
+            message.deadline = now + self._rtt.backoff(message.retransmissions)
+        return [message.data for message in expired]
+
+
+class ReceiveWindow:
+
+    def __init__(self):
+        """
+        Receiving side of a channel. Holds the messages received out of
+        order until the ones before them arrive.
+        """
+        self._epoch: int = 0
+        self._next_seq: int = 1
+        self._held: Dict[int, Any] = {}
+
+    def receive(self, epoch: int, seq: int, message: Any) -> List[Any]:
+        """
+        Records a message and returns every message that can now be
+        delivered, in order. Duplicates, messages of a previous epoch and
+        messages too far ahead to be held are ignored.
+        """
+        if epoch > self._epoch:
+            # The sender started the channel over
+            self._epoch = epoch
+            self._next_seq = 1
+            self._held = {}
+        if epoch < self._epoch or seq < self._next_seq or seq >= self._next_seq + WINDOW:
+            return []
+        self._held[seq] = message
+        delivered = []
+        while self._next_seq in self._held:
+            delivered.append(self._held.pop(self._next_seq))
+            self._next_seq += 1
+        return delivered
+
+    def ack(self) -> dict:
+        """
+        Builds the acknowledgement of everything received so far.
+        """
+        ranges: List[List[int]] = []
+        for seq in sorted(self._held):
+            if ranges and ranges[-1][1] == seq - 1:
+                ranges[-1][1] = seq
+            elif len(ranges) < MAX_SACK_RANGES:
+                ranges.append([seq, seq])
+            else:
+                break
+        return {"epoch": self._epoch, "seq": self._next_seq - 1, "sack": ranges}
+
+
+class ReliablePeer:
+
+    def __init__(self):
+        """
+        Reliable channels shared with a single peer, keyed by room, along
+        with the round-trip time to it. Safe to use from any thread.
+        """
+        self._rtt: RttEstimator = RttEstimator()
+        self._epochs = count(1)
+        self._sending: Dict[str, SendWindow] = {}
+        self._receiving: Dict[str, ReceiveWindow] = {}
+        self._lock: Lock = Lock()
+
+    @property
+    def rtt(self) -> RttEstimator:
+        return self._rtt
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Get the number of messages not acknowledged yet.
+        """
+        with self._lock:
+            return sum(len(window) for window in self._sending.values())
+
+    def send(self, channel: str, encode: Callable[[int, int], bytes]) -> Optional[bytes]:
+        """
+        Numbers a message of a channel, see `SendWindow.send`.
+        """
+        with self._lock:
+            window = self._sending.get(channel)
+            if window is None:
+                window = self._sending[channel] = SendWindow(self._rtt, next(self._epochs))
+            return window.send(encode, monotonic())
+
+    def receive(
+        self,
+        channel: str,
+        epoch: int,
+        seq: int,
+        message: Any,
+    ) -> Tuple[List[Any], dict]:
+        """
+        Records a message of a channel. Returns the messages that can now be
+        delivered, in order, and the acknowledgement to send back.
+        """
+        with self._lock:
+            window = self._receiving.get(channel)
+            if window is None:
+                window = self._receiving[channel] = ReceiveWindow()
+            delivered = window.receive(epoch, seq, message)
+            return delivered, {"channel": channel, **window.ack()}
+
+    def acknowledge(
+        self,
+        channel: str,
+        epoch: int,
+        seq: int,
+        sack: List[Tuple[int, int]],
+    ) -> List[bytes]:
+        """
+        Records an acknowledgement of a channel, see
+        `SendWindow.acknowledge`.
+        """
+        with self._lock:
+            window = self._sending.get(channel)
+            if window is None:
+                return []
+            return window.acknowledge(epoch, seq, sack, monotonic())
+
+    def due(self) -> Tuple[List[bytes], List[str]]:
+        """
+        Returns the datagrams to send again, and the channels given up on,
+        which are forgotten.
+        """
+        now = monotonic()
+        datagrams, failed = [], []
+        with self._lock:
+            for channel, window in self._sending.items():
+                due = window.due(now)
+                if due is None:
+                    failed.append(channel)
+                else:
+                    datagrams.extend(due)
+            for channel in failed:
+                del self._sending[channel]
+        return datagrams, failed
+
+    def forget(self, channel: str) -> None:
+        """
+        Forgets both directions of a channel.
+        """
+        with self._lock:
+            self._sending.pop(channel, None)
+            self._receiving.pop(channel, None)
+
+
+class ReliableChannels:
+
+    def __init__(self, fanout: FanOut):
+        """
+        Reliable channels of every player, sending through `fanout`.
+        """
+        self._fanout: FanOut = fanout
+        self._peers: Dict[str, Tuple[Player, ReliablePeer]] = {}
+        # Players with messages in flight, the only ones retransmitting
+        self._active: Set[str] = set()
+        self._lock: Lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def _get_peer(self, player: Player) -> ReliablePeer:
+        with self._lock:
+            entry = self._peers.get(player.identifier)
+            if entry is None:
+                entry = self._peers[player.identifier] = (player, ReliablePeer())
+            return entry[1]
+
+    def receive(  # pylint: disable=too-many-arguments
+        self,
+        player: Player,
+        channel: str,
+        epoch: int,
+        seq: int,
+        message: Any,
+    ) -> List[Any]:
+        """
+        Records a reliable message from a player and acknowledges it.
+        Returns the messages of the channel that can now be handled, in
+        order.
+        """
+        delivered, ack = self._get_peer(player).receive(channel, epoch, seq, message)
+        self._fanout.transmit([(player.codec.encode({ACK_SENDER: ack}), player.udp_address)])
+        return delivered
+
+    def acknowledge(self, player_id: str, channel: str, payload: Any) -> None:
+        """
+        Records an acknowledgement from a player, given the payload of its
+        `ack` action.
+        """
+        if not isinstance(payload, dict):
+            raise ValueError(f"Invalid acknowledgement: {payload!r}")
+        epoch, seq = parse_seq(payload.get("epoch")), parse_seq(payload.get("seq"))
+        sack = parse_sack(payload.get("sack"))
+        with self._lock:
+            entry = self._peers.get(player_id)
+        if entry is None:
+            return
+        player, peer = entry
+        self._fanout.transmit([
+            (data, player.udp_address) for data in peer.acknowledge(channel, epoch, seq, sack)])
+
+    def send(
+        self,
+        sender_id: str,
+        channel: str,
+        message: Any,
+        recipients: Iterable[Player],
+    ) -> int:
+        """
+        Sends a message from a player to every recipient, reliably to those
+        that opted in and as a plain datagram to the others. Returns how many
+        datagrams were sent.
+        """
+        unreliable = []
+        datagrams = []
+        for player in recipients:
+            if not player.reliable:
+                unreliable.append(player)
+                continue
+            codec = player.codec
+
+            def encode(epoch: int, seq: int, codec=codec) -> bytes:
+                return codec.encode({RELIABLE_SENDER: {
+                    "channel": channel,
+                    "epoch": epoch,
+                    "seq": seq,
+                    "sender": sender_id,
+                    "message": message,
+                }})
+
+            data = self._get_peer(player).send(channel, encode)
+            with self._lock:
+                self._active.add(player.identifier)
+            if data is not None:
+                datagrams.append((data, player.udp_address))
+        return self._fanout.transmit(datagrams) + self._fanout.send(
+            sender_id, message, unreliable)
+
+    def retransmit(self) -> int:
+        """
+        Sends again every message whose timer expired, and returns how many
+        were sent.
+        """
+        with self._lock:
+            active = [
+                self._peers[player_id] for player_id in self._active
+                if player_id in self._peers]
+        datagrams = []
+        idle = []
+        for player, peer in active:
+            due, failed = peer.due()
+            for channel in failed:
+                METRICS.reliable_failures.inc()
+                log("Gave up on reliable channel {} of {}", "error", channel, player,
+                    room=channel, player=player.identifier)
+            datagrams.extend((data, player.udp_address) for data in due)
+            if not peer.in_flight:
+                idle.append(player.identifier)
+        if idle:
+            with self._lock:
+                self._active.difference_update(idle)
+        METRICS.retransmissions.inc(len(datagrams))
+        return self._fanout.transmit(datagrams)
+
+    def forget_channel(self, player_id: str, channel: str) -> None:
+        """
+        Forgets a channel of a player, e.g. once it left the room.
+        """
+        with self._lock:
+            entry = self._peers.get(player_id)
+        if entry is not None:
+            entry[1].forget(channel)
+
+    def forget(self, player_id: str) -> None:
+        """
+        Forgets every channel of a player.
+        """
+        with self._lock:
+            self._peers.pop(player_id, None)
+            self._active.discard(player_id)
+
+
+class Retransmitter(Thread):
+
+    def __init__(self, channels: ReliableChannels, tick: float = RETRANSMIT_TICK):
+        """
+        Retransmits the reliable messages that were not acknowledged in
+        time, checking every `tick` seconds.
+        """
+        super().__init__(daemon=True)
+        if tick <= 0:
+            raise ValueError(f"Invalid tick {tick}")
+        self._channels: ReliableChannels = channels
+        self._tick: float = tick
+        self._stopped: Event = Event()
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        deadline = monotonic()
+        while True:
+            deadline += self._tick
+            if self._stopped.wait(max(0, deadline - monotonic())):
+                break
+            try:
+                self._channels.retransmit()
+            except Exception as exc:  # pylint: disable=broad-except
+                log("Failed to retransmit reliable messages: {!r}", "error", exc)
+
+    def stop(self):
+        """
+        Stop the retransmitter.
+        """
+        self._stopped.set()
@@ -1,18 +1,27 @@
 import atexit
-import json
 import socket
-from threading import Thread, Lock
-from typing import Tuple, Union
+from threading import Thread
+from typing import List, Tuple, Union
 
+from card_game_server.codec import JSON, decode
 from card_game_server.exceptions import (
-    PlayerNotInRoomError,
-    RoomFullError,
+    ProtocolError,
     RoomNotFoundError,
     UdpServerFailedToSendError,
 )
+from card_game_server.handler import Handler, encode_reply
 from card_game_server.logger import log
+from card_game_server.metrics import METRICS
 from card_game_server.models.rooms import Rooms
 from card_game_server.models.message import Message
+from card_game_server.protocol import (
+    MAX_DATAGRAM_SIZE,
+    MAX_REQUEST_SIZE,
+    SESSION_MAGIC,
+    FrameDecoder,
+    encode_frame,
+    session_preamble,
+)
 
 
 class UdpServer(Thread):
@@ -20,7 +29,6 @@ class UdpServer(Thread):
         self,
         udp_port: Union[str, int],
         rooms: Rooms,
-        lock: Lock
     ):
         """
         UDP server.
@@ -28,55 +36,16 @@ class UdpServer(Thread):
         super().__init__()
         self._udp_port: int = int(udp_port)
         self._rooms: Rooms = rooms
-        self._lock: Lock = lock
+        self._handler: Handler = Handler(rooms)
         self._listening: bool = True
         self._sock: socket.socket = None
         atexit.register(self.stop)
 
-    def handle(self, message: Message):
+    def handle(self, message: Message, address: Tuple[str, int]):
         """
         Implements message handling
         """
-        if message.room_id not in self._rooms.room_ids:
-            log(f"Room with id {message.room_id} not found when handling message "
-                f"from player {message.identifier}", "error")
-            raise RoomNotFoundError()
-        self._lock.acquire()
-        try:
-            if message.action == "send":
-                log(f"Sending message {message.payload} to {message.room_id}", "debug")
-                try:
-                    self._rooms.send(
-                        message.identifier,
-                        message.room_id,
-                        message.payload["message"]
-                    )
-                    log(
-                        f"Message successfully sent to {message.room_id}", "debug")
-                except Exception as exc:
-                    log(
-                        f"Failed to send message to {message.room_id}: {exc}", "error")
-                    raise UdpServerFailedToSendError() from exc
-            elif message.action == "sendto":
-                log(
-                    f'Sending message {message.payload} to {message.payload["recipients"]}', "debug"
-                )
-                try:
-                    self._rooms.sendto(
-                        message.identifier,
-                        message.room_id,
-                        message.payload["recipients"],
-                        message.payload["message"]
-                    )
-                    log(
-                        f"Message successfully sent to {message.payload['recipients']}", "debug")
-                except Exception as exc:
-                    log(
-                        f"Failed to send message to {message.payload['recipients']}: {exc}", "error"
-                    )
-                    raise UdpServerFailedToSendError() from exc
-        finally:
-            self._lock.release()
+        self._handler.handle_udp(message, address)
 
     def run(self):
         """
@@ -86,19 +55,32 @@ class UdpServer(Thread):
         self._sock.bind(('0.0.0.0', self._udp_port))
         self._sock.setblocking(0)
         self._sock.settimeout(5)
+        # Messages to players go out through this very socket
+        self._rooms.fanout.bind(self._sock.sendto)
         while self._listening:
             try:
-                data, address = self._sock.recvfrom(1024)
-                data = json.loads(data.decode('utf-8'))
-                log(f"Received message from {address}: {data}", "debug")
+                data, address = self._sock.recvfrom(MAX_DATAGRAM_SIZE)
+                METRICS.datagrams_received.inc()
+                METRICS.bytes_received.inc(len(data))
+                data = decode(data)
+                message: Message = Message(data)
             except socket.timeout:
                 continue
+            except ProtocolError:
+                METRICS.decode_failures.inc(1, "udp")
+                log("Failed to decode datagram from {}", "error", address)
+                continue
 
-            message: Message = Message(data)
+            log("Received message from {}: {}", "debug", address, data,
+                room=message.room_id, player=message.identifier)
             try:
-                self.handle(message)
+                self.handle(message, address)
             except RoomNotFoundError:
-                log(f"Room with id {message.room_id} not found", "error")
+                log("Room with id {} not found", "error", message.room_id)
+            except UdpServerFailedToSendError:
+                log("Failed to deliver message from {}", "error", address)
+            except Exception as exc:  # pylint: disable=broad-except
+                log("Failed to handle datagram from {}: {!r}", "error", address, exc)
         self._sock.close()
 
     def stop(self):
@@ -108,12 +90,62 @@ class UdpServer(Thread):
         self._listening = False
 
 
+class TcpSession(Thread):
+    def __init__(
+        self,
+        sock: socket.socket,
+        address: Tuple[str, int],
+        handler: Handler,
+        buffer: bytes,
+    ):
+        """
+        Serves a persistent TCP session in its own thread.
+        """
+        super().__init__(daemon=True)
+        self._sock: socket.socket = sock
+        self._address: Tuple[str, int] = address
+        self._handler: Handler = handler
+        self._buffer: bytes = buffer
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        log("Session opened by {}", "debug", self._address)
+        decoder = FrameDecoder()
+        data = self._buffer
+        try:
+            while True:
+                for frame, codec in decoder.feed(data):
+                    message: Message = Message(frame)
+                    reply = self._handler.handle_request(self._address, message)
+                    self._sock.sendall(encode_frame(reply, codec))
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+        except (OSError, ProtocolError) as exc:
+            if isinstance(exc, ProtocolError):
+                METRICS.decode_failures.inc(1, "tcp")
+            log("Session with {} failed: {!r}", "error", self._address, exc)
+        finally:
+            self._sock.close()
+        log("Session closed by {}", "debug", self._address)
+
+    def stop(self):
+        """
+        Closes the session.
+        """
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
 class TcpServer(Thread):
     def __init__(
         self,
         tcp_port: Union[str, int],
         rooms: Rooms,
-        lock: Lock
     ):
         """
         TCP server.
@@ -121,15 +153,12 @@ class TcpServer(Thread):
         super().__init__()
         self._tcp_port: int = int(tcp_port)
         self._rooms: Rooms = rooms
-        self._lock: Lock = lock
+        self._handler: Handler = Handler(rooms)
         self._listening: bool = True
-        self._message: dict = {
-            'success': None,
-            'message': None,
-        }
         self._sock: socket.socket = None
+        self._sessions: List[TcpSession] = []
 
-    def handle(  # pylint: disable=too-many-statements
+    def handle(
         self,
         sock: socket.socket,
         address: Tuple[str, int],
@@ -138,112 +167,10 @@ class TcpServer(Thread):
         """
         Implements message handling
         """
-        # If we want to register a player, just do it and return
-        if message.action == "register":
-            log(f"Registering player with UDP port {message.payload}", "debug")
-            client = self._rooms.register(address, int(message.payload))
-            log(f"Registered player {client}", "debug")
-            client.send_tcp(True, client.identifier, sock)
-            log(f"Sent registration confirmation to {client}", "debug")
-            return
-
-        # If we have a Player ID
-        if message.identifier is not None:
-
-            # Check if it is registered, if it's not, send a failure message
-            if not self._rooms.get_player(message.identifier):
-                log(f"Unknown Player ID {message.identifier} for {address}", "error")
-                message = self._message.copy()
-                message['success'] = False
-                message['message'] = "Unknown Player ID"
-                sock.send(json.dumps(message).encode())
-                return
-
-            # If it is, get the player object
-            client = self._rooms.get_player(message.identifier)
-
-            # If the action asks to join a room
-            if message.action == "join":
-                # Tries to find a room and join it
-                try:
-                    if not self._rooms.get_room(message.payload):
-                        log(f"Player {client} tried to join room {message.payload} "
-                            "but it doesn't exist", "error")
-                        raise RoomNotFoundError()
-                    log(f"Player {client} is joining room {message.payload}", "debug")
-                    self._rooms.join(message.identifier, message.payload)
-                    log(f"Player {client} joined room {message.payload}", "debug")
-                    client.send_tcp(True, message.payload, sock)
-                    log(f"Sent join confirmation to {client}", "debug")
-                except RoomNotFoundError:
-                    client.send_tcp(False, message.payload, sock)
-                    log(
-                        f"Sent join failure (RoomNotFound) to {client}", "debug")
-                except RoomFullError:
-                    client.send_tcp(False, message.payload, sock)
-                    log(f"Sent join failure (RoomFull) to {client}", "debug")
-
-            # If the action asks to join ANY room
-            elif message.action == "autojoin":
-                log(f"Player {client} is trying to autojoin ANY room", "debug")
-                room_id = self._rooms.join(message.identifier)
-                log(f"Player {client} joined room {room_id}", "debug")
-                client.send_tcp(True, room_id, sock)
-                log(f"Sent autojoin confirmation to {client}", "debug")
-
-            # If the action asks to list rooms
-            elif message.action == "get_rooms":
-                log(f"Player {client} is trying to list rooms", "debug")
-                rooms = []
-                for room in self._rooms.rooms:
-                    rooms.append({
-                        "id": room.identifier,
-                        "name": room.name,
-                        "n_players": len(room.players),
-                        "capacity": room.capacity,
-                    })
-                client.send_tcp(True, rooms, sock)
-                log(f"Sent rooms list to {client}", "debug")
-
-            # If the action asks to create a room
-            elif message.action == "create":
-                log(f"Player {client} is trying to create a room", "debug")
-                room_id = self._rooms.create(message.payload).identifier
-                log(f"Player {client} created room {room_id}", "debug")
-                self._rooms.join(client.identifier, room_id)
-                log(f"Player {client} joined room {room_id}", "debug")
-                client.send_tcp(True, room_id, sock)
-                log(f"Sent create confirmation to {client}", "debug")
-
-            # If the action asks to leave a room
-            elif message.action == "leave":
-                log(f"Player {client} is trying to leave a room", "debug")
-                try:
-                    if not self._rooms.get_room(message.room_id):
-                        log(f"Player {client} tried to leave room {message.room_id} but "
-                            "it doesn't exist", "error")
-                        raise RoomNotFoundError()
-                    self._rooms.leave(message.identifier, message.room_id)
-                    log(f"Player {client} left room {message.room_id}", "debug")
-                    client.send_tcp(True, message.room_id, sock)
-                    log(f"Sent leave confirmation to {client}", "debug")
-                except RoomNotFoundError:
-                    client.send_tcp(False, message.room_id, sock)
-                    log(
-                        f"Sent leave failure (RoomNotFound) to {client}", "debug")
-                except PlayerNotInRoomError:
-                    client.send_tcp(False, message.room_id, sock)
-                    log(
-                        f"Sent leave failure (PlayerNotInRoom) to {client}", "debug")
-
-            # Otherwise, user must register
-            else:
-                log(f"Player {client} sent an unknown action {message.action}", "error")
-                message = self._message.copy()
-                message['success'] = False
-                message['message'] = "You must register"
-                sock.send(json.dumps(message).encode())
-                log(f"Sent failure to {client}", "debug")
+        success, data = self._handler.handle_tcp(address, message)
+        sock.sendall(encode_reply(success, data))
+        log("Sent reply to {} for action {}", "debug", address, message.action,
+            player=message.identifier)
 
     def run(self):
         """
@@ -253,30 +180,76 @@ class TcpServer(Thread):
         self._sock.bind(('0.0.0.0', self._tcp_port))
         self._sock.setblocking(0)
         self._sock.settimeout(5)
-        self._sock.listen(1)
+        self._sock.listen(socket.SOMAXCONN)
 
         while self._listening:
             try:
                 conn, address = self._sock.accept()
             except socket.timeout:
                 continue
-            data = conn.recv(1024)
-            data = json.loads(data.decode('utf-8'))
-            log(f"Received message from {address}: {data}", "debug")
-
+            conn.settimeout(5)
+            try:
+                is_session, data = self.read_preamble(conn)
+                if is_session:
+                    conn.settimeout(None)
+                    session = TcpSession(conn, address, self._handler, data)
+                    self._sessions = [
+                        session for session in self._sessions if session.is_alive()]
+                    self._sessions.append(session)
+                    session.start()
+                    continue
+                while True:
+                    try:
+                        data = JSON.decode(data)
+                        break
+                    except ProtocolError:
+                        if len(data) >= MAX_REQUEST_SIZE:
+                            raise
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        raise ValueError("Incomplete request")
+                    data += chunk
+                if not isinstance(data, dict):
+                    raise ValueError("Request is not an object")
+            except (OSError, ValueError, ProtocolError) as exc:
+                if isinstance(exc, ProtocolError):
+                    METRICS.decode_failures.inc(1, "tcp")
+                log("Dropping connection from {}: {!r}", "error", address, exc)
+                conn.close()
+                continue
             message: Message = Message(data)
-            self._lock.acquire()
+            log("Received message from {}: {}", "debug", address, data,
+                room=message.room_id, player=message.identifier)
             try:
                 self.handle(
                     conn,
                     address,
                     message,
                 )
-            finally:
-                self._lock.release()
+            except OSError as exc:
+                log("Failed to reply to {}: {!r}", "error", address, exc)
             conn.close()
+        for session in self._sessions:
+            session.stop()
         self._sock.close()
 
+    def read_preamble(self, conn: socket.socket) -> Tuple[bool, bytes]:  # pylint: disable=no-self-use
+        """
+        Reads the first bytes of a connection and tells whether it opens a
+        session. Also returns whatever was read past the preamble.
+        """
+        buffer = b""
+        is_session = None
+        while is_session is None:
+            chunk = conn.recv(4096)
+            if not chunk:
+                raise ValueError("Connection closed before any request")
+            buffer += chunk
+            is_session = session_preamble(buffer)
+        if is_session:
+            return True, buffer[len(SESSION_MAGIC):]
+        return False, buffer
+
     def stop(self):
         """
         Stop the server.
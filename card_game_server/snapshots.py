@@ -0,0 +1,249 @@
+"""
+Delta-compressed state snapshots.
+
+Some state, such as the view of the game of a room (see
+`card_game_server.game`), is pushed through UDP to every player after each
+change. Rather than the whole state, a player is sent only what changed
+since the last version it acknowledged, its baseline:
+
+    {"version": 9, "base": 7,
+     "changed": [[["turn"], player_id], [["hands", player_id], 4]],
+     "removed": [["piles", "stock"]]}
+
+Every entry of `changed` sets the value at a path of keys, and every entry of
+`removed` deletes the key at a path. A player without a baseline, because it
+just joined or because the last version it acknowledged is older than
+`SNAPSHOT_HISTORY` versions, is sent the whole state instead:
+
+    {"version": 9, "state": {...}}
+
+Players acknowledge every version they apply with a `game_ack` datagram
+carrying the version as payload, and the room of the state as `room_id`.
+Since every delta is relative to a version the player acknowledged, and so
+still has, a lost delta costs nothing but the bytes: the next one carries its
+changes too. A player that cannot apply a delta acknowledges version 0, which
+drops its baseline so that the next update is a whole state.
+
+States are dicts whose keys are strings, as they must be to go through JSON.
+They are never changed once given: `diff` and `patch` share whatever did not
+change between two versions.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+# Most versions kept for every player, and so the oldest baseline a delta can
+# be built from
+SNAPSHOT_HISTORY = 32
+
+
+def parse_version(value: Any) -> int:
+    """
+    Validates the version of a snapshot, 0 meaning no baseline.
+    """
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError(f"Invalid snapshot version: {value!r}")
+    return value
+
+
+def _diff(old: dict, new: dict, path: List[str], changed: list, removed: list) -> None:
+    """
+    Implements `diff`, adding the changes below a path.
+    """
+    for key, value in new.items():
+        if key in old:
+            previous = old[key]
+            if previous is value or previous == value:
+                continue
+            if isinstance(previous, dict) and isinstance(value, dict):
+                _diff(previous, value, path + [key], changed, removed)
+                continue
+        changed.append([path + [key], value])
+    for key in old:
+        if key not in new:
+            removed.append(path + [key])
+
+
+def diff(old: dict, new: dict) -> dict:
+    """
+    Get the changes turning a state into another, as the `changed` and
+    `removed` entries of a delta, which are left out when empty.
+    """
+    changed = []
+    removed = []
+    _diff(old, new, [], changed, removed)
+    delta = {}
+    if changed:
+        delta["changed"] = changed
+    if removed:
+        delta["removed"] = removed
+    return delta
+
+
+def patch(state: dict, delta: dict) -> dict:
+    """
+    Applies the changes of a delta to a state, and returns the new state.
+    The given state is left as is: only the dicts along the changed paths are
+    copied. Raises `ValueError` if the delta does not fit the state.
+    """
+    result = dict(state)
+    copied = {id(result)}
+
+    def parent(path: Any) -> dict:
+        if not isinstance(path, list) or not path:
+            raise ValueError(f"Invalid path: {path!r}")
+        target = result
+        for key in path[:-1]:
+            child = target.get(key)
+            if not isinstance(child, dict):
+                raise ValueError(f"No dict at {path!r}")
+            if id(child) not in copied:
+                child = target[key] = dict(child)
+                copied.add(id(child))
+            target = child
+        return target
+
+    try:
+        for path, value in delta.get("changed", ()):
+            parent(path)[path[-1]] = value
+        for path in delta.get("removed", ()):
+            parent(path).pop(path[-1], None)
+    except TypeError as exc:
+        raise ValueError(f"Invalid delta: {exc}") from exc
+    return result
+
+
+class SnapshotSender:
+
+    def __init__(self, history: int = SNAPSHOT_HISTORY):
+        """
+        Versions of a state sent to players, each with its own versions and
+        baseline. Must be used with the lock of whatever owns the state held.
+        """
+        self._history: int = history
+        self._versions: Dict[str, int] = {}
+        self._sent: Dict[str, 'OrderedDict[int, dict]'] = {}
+        self._baselines: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+    def baseline(self, player_id: str) -> Optional[int]:
+        """
+        Get the last version a player acknowledged, if it is still known.
+        """
+        return self._baselines.get(player_id)
+
+    def update(self, player_id: str, state: dict) -> dict:
+        """
+        Gets the next version of the state of a player as a message, either
+        a delta from its baseline or the whole state.
+        """
+        version = self._versions.get(player_id, 0) + 1
+        self._versions[player_id] = version
+        sent = self._sent.get(player_id)
+        if sent is None:
+            sent = self._sent[player_id] = OrderedDict()
+        base = self._baselines.get(player_id)
+        if base is not None and base in sent:
+            message = {"version": version, "base": base}
+            message.update(diff(sent[base], state))
+        else:
+            message = {"version": version, "state": state}
+        sent[version] = state
+        while len(sent) > self._history:
+            oldest, _ = sent.popitem(last=False)
+            if oldest == base:
+                del self._baselines[player_id]
+        return message
+
+    def acknowledge(self, player_id: str, version: int) -> bool:
+        """
+        Records that a player applied a version, which becomes its baseline
+        unless it has a later one. Version 0 drops the baseline instead.
+        Returns whether the version was known.
+        """
+        sent = self._sent.get(player_id)
+        if version == 0:
+            self._baselines.pop(player_id, None)
+            return True
+        if sent is None or version not in sent:
+            return False
+        if version <= self._baselines.get(player_id, 0):
+            return True
+        self._baselines[player_id] = version
+        # Older versions will never be a baseline again
+        while next(iter(sent)) < version:
+            sent.popitem(last=False)
+        return True
+
+    def forget(self, player_id: str) -> None:
+        """
+        Forgets a player, whose next update will be a whole state.
+        """
+        self._versions.pop(player_id, None)
+        self._sent.pop(player_id, None)
+        self._baselines.pop(player_id, None)
+
+
+class SnapshotReceiver:
+
+    def __init__(self, history: int = SNAPSHOT_HISTORY):
+        """
+        Versions of a state received from the server, from which the deltas
+        that follow are applied.
+        """
+        self._history: int = history
+        self._states: 'OrderedDict[int, dict]' = OrderedDict()
+        self._version: int = 0
+        self._lock: Lock = Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def state(self) -> Optional[dict]:
+        """
+        Get the latest state, if any.
+        """
+        with self._lock:
+            return self._states.get(self._version)
+
+    def receive(self, message: dict) -> Optional[dict]:
+        """
+        Applies a message of `SnapshotSender`, and returns the state it
+        brings, or `None` if its baseline is unknown, in which case version 0
+        should be acknowledged. Raises `ValueError` if the message is
+        invalid.
+        """
+        if not isinstance(message, dict):
+            raise ValueError(f"Invalid snapshot: {message!r}")
+        version = parse_version(message.get("version"))
+        with self._lock:
+            state = self._states.get(version)
+            if state is not None:
+                return state
+            if "state" in message:
+                state = message["state"]
+                if not isinstance(state, dict):
+                    raise ValueError(f"Invalid snapshot state: {state!r}")
+            else:
+                base = self._states.get(message.get("base"))
+                if base is None:
+                    return None
+                state = patch(base, message)
+            self._states[version] = state
+            while len(self._states) > self._history:
+                self._states.popitem(last=False)
+            self._version = max(self._version, version)
+            return state
+
+    def reset(self) -> None:
+        """
+        Forgets every state, as when leaving the room of the state.
+        """
+        with self._lock:
+            self._states.clear()
+            self._version = 0
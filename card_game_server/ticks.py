@@ -0,0 +1,157 @@
+"""
+Tick-based message coalescing.
+
+A room created with a tick rate, in ticks per second, does not forward its
+messages as they come. It buffers them, and at every tick of the room sends
+each recipient the messages it got during the tick, packed into as few
+datagrams of at most `MAX_BATCH_BYTES` as they fit in:
+
+    {"batch": [{sender_id: message}, {sender_id: message}, ...]}
+
+Messages keep the order they were sent in. A recipient with a single message
+in a datagram, for instance because the message is too large to share one,
+gets it as a plain `{sender_id: message}` datagram. Players that did not ask
+for batches when they registered get every message as its own plain datagram,
+only held back until the tick.
+
+A room where players send messages faster than the tick rate thus costs one
+datagram per recipient and tick, instead of one per recipient and message.
+
+The ticks of every room are driven by a single `TickScheduler`. A room is
+only scheduled when a tick of it has something to send, so idle rooms cost
+nothing. Reliable messages are never held back, see
+`card_game_server.reliable`.
+"""
+
+import heapq
+from threading import Condition, Event, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, List, Set, Tuple
+
+from card_game_server.logger import log
+
+# Sender of the batches, as seen by the players
+BATCH_SENDER = "batch"
+
+# Bounds of the tick rate of a room, in ticks per second
+MIN_TICK_RATE = 1
+MAX_TICK_RATE = 120
+
+# Largest batch, which fits in a single packet on any path carrying IPv6
+MAX_BATCH_BYTES = 1200
+
+# Most messages held back in a room, after which they are sent before the tick
+MAX_TICK_MESSAGES = 1024
+
+# Longest the scheduler sleeps without looking at its queue
+MAX_IDLE_WAIT = 0.5
+
+
+def parse_tick_rate(value: Any) -> int:
+    """
+    Validates the tick rate of a room, 0 meaning no ticks.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"Invalid tick rate: {value!r}")
+    if value != 0 and not MIN_TICK_RATE <= value <= MAX_TICK_RATE:
+        raise ValueError(
+            f"Tick rate must be between {MIN_TICK_RATE} and {MAX_TICK_RATE}: {value}")
+    return value
+
+
+class Ticks:
+
+    def __init__(self, flush: Callable[[str], Any]):
+        """
+        Queue of the rooms waiting for their next tick, in the order of their
+        deadlines. `flush` is called with the identifier of every room whose
+        tick came.
+        """
+        self._flush: Callable[[str], Any] = flush
+        self._queue: List[Tuple[float, str]] = []
+        self._scheduled: Set[str] = set()
+        self._lock: Lock = Lock()
+        self._changed: Condition = Condition(self._lock)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def schedule(self, room_id: str, deadline: float) -> None:
+        """
+        Flushes a room at a monotonic deadline, unless it is already
+        scheduled.
+        """
+        with self._lock:
+            if room_id in self._scheduled:
+                return
+            self._scheduled.add(room_id)
+            heapq.heappush(self._queue, (deadline, room_id))
+            if self._queue[0][1] == room_id:
+                # The scheduler may be sleeping until a later deadline
+                self._changed.notify()
+
+    def run_due(self, now: float = None) -> int:
+        """
+        Flushes every room whose deadline passed, and returns how many.
+        """
+        if now is None:
+            now = monotonic()
+        due = []
+        with self._lock:
+            while self._queue and self._queue[0][0] <= now:
+                _, room_id = heapq.heappop(self._queue)
+                self._scheduled.discard(room_id)
+                due.append(room_id)
+        for room_id in due:
+            try:
+                self._flush(room_id)
+            except Exception as exc:  # pylint: disable=broad-except
+                log("Failed to flush room {}: {!r}", "error", room_id, exc, room=room_id)
+        return len(due)
+
+    def wait(self, timeout: float = MAX_IDLE_WAIT) -> None:
+        """
+        Sleeps until the earliest deadline, an earlier room is scheduled,
+        `wake` is called, or `timeout` seconds passed.
+        """
+        with self._lock:
+            if self._queue:
+                timeout = min(timeout, self._queue[0][0] - monotonic())
+            if timeout > 0:
+                self._changed.wait(timeout)
+
+    def wake(self) -> None:
+        """
+        Wakes up whoever waits on the queue.
+        """
+        with self._lock:
+            self._changed.notify_all()
+
+
+class TickScheduler(Thread):
+
+    def __init__(self, ticks: Ticks):
+        """
+        Flushes the rooms of a tick queue as their ticks come, for every room
+        of the server.
+        """
+        super().__init__(daemon=True)
+        self._ticks: Ticks = ticks
+        self._stopped: Event = Event()
+
+    def run(self):
+        """
+        Thread run method.
+        """
+        while not self._stopped.is_set():
+            self._ticks.run_due()
+            self._ticks.wait()
+
+    def stop(self):
+        """
+        Stop the scheduler.
+        """
+        self._stopped.set()
+        self._ticks.wake()